@@ -1 +1 @@
-__all__ = ["bili_webup", "bili_webup_sync"]
+__all__ = ["bili_webup", "bili_webup_sync", "upload_buffer", "upload_concurrency", "upload_cover", "upload_journal", "upload_line", "upload_runtime", "upload_telemetry"]
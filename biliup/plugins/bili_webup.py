@@ -1,11 +1,13 @@
 import asyncio
 import base64
 import hashlib
+import itertools
 import json
 import math
+import mmap
 import os
+import random
 import re
-import sys
 import time
 import urllib.parse
 from dataclasses import asdict, dataclass, field, InitVar
@@ -24,6 +26,13 @@ from requests.adapters import HTTPAdapter, Retry
 import logging
 from typing import NamedTuple
 
+from .upload_journal import UploadJournal
+from .upload_concurrency import AsyncAimdLimiter, HedgePolicy
+from .upload_cover import CoverCache, crop_cover, read_image
+from .upload_line import LineScoreboard, probe_lines
+from .upload_runtime import UploadRuntime
+from .upload_telemetry import (ChunkEnd, ChunkHedged, ChunkRetry, ChunkStart, FileEnd, FileStart, LineChosen,
+                               MergeEnd, ProgressPrinter, UploadTelemetry)
 
 logger = logging.getLogger('biliup')
 
@@ -33,6 +42,63 @@ class FileInfo(NamedTuple):
     danmaku: Optional[str] = None
 
 
+class Chunk(NamedTuple):
+    index: int
+    start: int
+    end: int
+
+    @property
+    def size(self):
+        return self.end - self.start
+
+
+class ChunkReader:
+    """
+    按 chunk_size 预先计算分块表，通过 mmap 映射文件，按偏移量返回 memoryview 切片，
+    分块数据不再复制成新的 bytes，多个上传协程也不再共享同一个文件读写位置
+    """
+
+    def __init__(self, file, chunk_size: int):
+        self.chunk_size = chunk_size
+        self.total_size = os.fstat(file.fileno()).st_size
+        # 空文件无法 mmap
+        self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if self.total_size else None
+        self.chunks = [Chunk(index, start, min(start + chunk_size, self.total_size))
+                       for index, start in enumerate(range(0, self.total_size, chunk_size))]
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def read(self, chunk: Chunk) -> memoryview:
+        """返回分块对应的只读视图，使用完毕后需 release，否则无法关闭映射"""
+        return memoryview(self._mmap)[chunk.start:chunk.end]
+
+    def close(self):
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # 被取消的重发请求或连接的发送缓冲区可能仍引用着分块视图，此时无法关闭映射，
+                # 不再持有映射，待最后一个视图释放后由垃圾回收解除映射，避免掩盖上传本身的结果
+                logger.debug('分块视图仍在使用，延迟关闭文件映射')
+            self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, e_t, e_v, t_b):
+        self.close()
+
+
+def backoff(attempt: int, base=2.0, cap=60.0) -> float:
+    """第 attempt 次重试前等待的秒数，指数增长并加入随机抖动，避免多个上传同时重试"""
+    delay = min(cap, base * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
 class BiliWeb:
     def __init__(
         self,
@@ -52,6 +118,9 @@ class BiliWeb:
         cover_path=None,
         description='',
         credits=[],
+        parallel_files: int = 1,
+        max_threads: int = 16,
+        telemetry: Optional[Callable] = None,
     ):
         """
         :param principal:
@@ -63,12 +132,15 @@ class BiliWeb:
         :param dtime: 延时发布时间。需距离提交大于4小时，格式为10位时间戳
         :param dynamic:
         :param lines: 上传线路
-        :param threads: 上传线程数
+        :param threads: 初始上传线程数，上传时根据吞吐量自动调整
         :param tid: 稿件分区
         :param tags: 稿件标签
         :param cover_path: 稿件封面路径
         :param description: 视频简介
         :param credits: ???
+        :param parallel_files: 同时上传的分P数量，大于1时多个文件共享同一个分块并发额度
+        :param max_threads: 自动调整时上传线程数的上限
+        :param telemetry: 上传事件回调，接收 upload_telemetry 中定义的事件，例如 TelemetryAggregator 实例
         """
         self.principal = principal
         self.data: dict = data
@@ -91,6 +163,9 @@ class BiliWeb:
         self.dynamic = dynamic
         self.copyright = copyright
         self.dtime = dtime
+        self.parallel_files = parallel_files
+        self.max_threads = max_threads
+        self.telemetry = telemetry
 
     def upload(
         self,
@@ -110,8 +185,15 @@ class BiliWeb:
             bili.app_key = self.user.get('app_key')
             bili.appsec = self.user.get('appsec')
             bili.login(self.persistence_path, self.user_cookie)
-            for file in file_list:
-                video_part = bili.upload_file(file.video, self.lines, self.threads)  # 上传视频
+            if self.telemetry:
+                bili.telemetry.subscribe(self.telemetry)
+            if self.parallel_files > 1:
+                video_parts = bili.upload_files([file.video for file in file_list], self.lines, self.threads,
+                                                self.parallel_files, self.max_threads)
+            else:
+                video_parts = (bili.upload_file(file.video, self.lines, self.threads, self.max_threads)
+                               for file in file_list)
+            for video_part in video_parts:  # 上传视频
                 video_part['title'] = video_part['title'][:80]
                 video.append(video_part)  # 添加已经上传的视频
             video.title = self.data["format_title"][:80]  # 稿件标题限制80字
@@ -188,7 +270,17 @@ class BiliBili:
         self.account = None
         self.__bili_jct = None
         self._auto_os = None
+        self._preferred_upos_cdn = None
         self.persistence_path = 'engine/bili.cookie'
+        self.journal: Optional[UploadJournal] = None
+        self.scoreboard: Optional[LineScoreboard] = None
+        self.cover_cache: Optional[CoverCache] = None
+        self.concurrency: Optional[AsyncAimdLimiter] = None  # 最近一次上传使用的分块并发控制，limit 为当前并发数
+        self._runtime: Optional[UploadRuntime] = None
+        self._api_session: Optional[aiohttp.ClientSession] = None
+        self._line_lock: Optional[asyncio.Lock] = None
+        self.hedge_factor: Optional[float] = 3.0  # 分块耗时超过中位数的倍数后重发，为 None 时不重发
+        self.telemetry = UploadTelemetry(ProgressPrinter())  # 上传事件，可通过 subscribe 添加统计回调
 
     def check_tag(self, tag):
         r = self.__session.get("https://member.bilibili.com/x/vupre/web/topic/tag/check?tag=" + tag).json()
@@ -241,6 +333,14 @@ class BiliBili:
 
     def login(self, persistence_path, user_cookie):
         self.persistence_path = user_cookie
+        # 断点记录、线路记录和封面缓存与cookie文件放在同一目录
+        state_dir = os.path.dirname(os.path.abspath(user_cookie))
+        if self.journal is None:
+            self.journal = UploadJournal.open(os.path.join(state_dir, 'upload_journal.json'))
+        if self.scoreboard is None:
+            self.scoreboard = LineScoreboard.open(os.path.join(state_dir, 'upload_lines.json'))
+        if self.cover_cache is None:
+            self.cover_cache = CoverCache.open(os.path.join(state_dir, 'cover_cache'))
         if os.path.isfile(self.persistence_path):
             print('使用持久化内容上传')
             self.load()
@@ -363,39 +463,111 @@ class BiliBili:
         if r and r["code"] == 0:
             return r['data']['hash'], rsa.PublicKey.load_pkcs1_openssl_pem(r['data']['key'].encode())
 
-    def probe(self):
+    def probe(self, fast_enough: Optional[float] = None):
+        """
+        选择上传线路，优先根据历史上传记录选择，没有记录时并发测速所有线路，选择耗时最短的线路
+        :param fast_enough: 出现耗时不超过该值（秒）的线路时立即选用
+        """
         ret = self.__session.get('https://member.bilibili.com/preupload?r=probe', timeout=5).json()
         logger.info(f"线路:{ret['lines']}")
-        data, auto_os = None, None
-        min_cost = 0
-        if ret['probe'].get('get'):
-            method = 'get'
-        else:
-            method = 'post'
-            data = bytes(int(1024 * 0.1 * 1024))
-        for line in ret['lines']:
-            start = time.perf_counter()
-            test = self.__session.request(method, f"https:{line['probe_url']}", data=data, timeout=30)
-            cost = time.perf_counter() - start
-            print(line['query'], cost)
-            if test.status_code != 200:
-                return
-            if not min_cost or min_cost > cost:
-                auto_os = line
-                min_cost = cost
-        auto_os['cost'] = min_cost
-        return auto_os
+        if self.scoreboard:
+            auto_os = self.scoreboard.choose(ret['lines'])
+            if auto_os:
+                return auto_os
+        return probe_lines(self.__session, ret, fast_enough=fast_enough)
 
-    def upload_file(self, filepath: str, lines='AUTO', tasks=3):
+    def upload_file(self, filepath: str, lines='AUTO', tasks=3, max_tasks=16):
         """上传本地视频文件,返回视频信息dict
         b站目前支持4种上传线路upos, kodo, gcs, bos
         gcs: {"os":"gcs","query":"bucket=bvcupcdngcsus&probe_version=20221109",
         "probe_url":"//storage.googleapis.com/bvcupcdngcsus/OK"},
         bos: {"os":"bos","query":"bucket=bvcupcdnboshb&probe_version=20221109",
         "probe_url":"??"}
+        分块并发数从 tasks 开始，根据吞吐量和失败情况在 1 到 max_tasks 之间自动调整
         """
-        preferred_upos_cdn = None
-        if not self._auto_os:
+        return self.runtime.run(self._upload_file(filepath, lines, tasks, max_tasks=max_tasks))
+
+    def upload_files(self, filepaths: List[str], lines='AUTO', tasks=3, files=2, max_tasks=16):
+        """
+        同时上传多个本地视频文件，所有文件共享同一个分块并发额度
+        :param filepaths: 视频文件路径列表
+        :param lines: 上传线路
+        :param tasks: 所有文件合计同时上传的初始分块数
+        :param files: 同时上传的文件数
+        :param max_tasks: 自动调整时分块并发数的上限
+        :return: 与 filepaths 顺序一致的视频信息列表
+        """
+        return self.runtime.run(self._upload_files(filepaths, lines, tasks, files, max_tasks))
+
+    @property
+    def runtime(self) -> UploadRuntime:
+        """进程内共享的上传事件循环和连接池，close 时释放"""
+        if self._runtime is None:
+            self._runtime = UploadRuntime.acquire()
+        return self._runtime
+
+    async def _request(self, method: str, url: str, timeout=15, raw=False, retries=5, **kwargs):
+        """
+        通过共享连接池发起请求，携带与 requests 会话相同的请求头和cookie，只能在上传事件循环中调用
+        与 requests 会话的 Retry(total=5) 一致，连接失败时退避重试，幂等请求读取超时或连接中断也重试
+        :param raw: 为 True 时返回响应体 bytes，否则按 json 解析
+        :param retries: 最多重试次数
+        """
+        if self._api_session is None or self._api_session.closed:
+            self._api_session = self.runtime.session()
+        idempotent = method.upper() in ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+        attempt = 0
+        while True:
+            # 每次请求时读取会话当前的请求头和cookie，登录或更新请求头后立即生效
+            headers = self.__session.headers.copy()
+            headers.update(kwargs.get('headers') or {})
+            try:
+                async with self._api_session.request(
+                        method, url, cookies=self.__session.cookies.get_dict(),
+                        timeout=aiohttp.ClientTimeout(total=timeout), **{**kwargs, 'headers': headers}) as r:
+                    if raw:
+                        return await r.read()
+                    return await r.json(content_type=None)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                # 非幂等请求只在连接未建立时重试，避免重复提交
+                if attempt >= retries or not (idempotent or isinstance(e, aiohttp.ClientConnectorError)):
+                    raise
+                attempt += 1
+                logger.debug(f'{method} {url} 请求失败，第{attempt}次重试: {e!r}')
+                await asyncio.sleep(backoff(attempt, base=0.25, cap=5))
+
+    def _new_limiter(self, tasks, max_tasks):
+        # 沿用上一次上传调整后的并发数
+        initial = self.concurrency.limit if self.concurrency else tasks
+        self.concurrency = AsyncAimdLimiter(initial, max(max_tasks, tasks))
+        return self.concurrency
+
+    async def _upload_files(self, filepaths, lines, tasks, files, max_tasks=16):
+        limiter = self._new_limiter(tasks, max_tasks)
+        file_limiter = asyncio.Semaphore(files)
+
+        async def upload_one(filepath):
+            async with file_limiter:
+                return await self._upload_file(filepath, lines, tasks, limiter=limiter)
+
+        uploads = [asyncio.ensure_future(upload_one(filepath)) for filepath in filepaths]
+        try:
+            # gather 按传入顺序返回结果，分P顺序与 filepaths 一致
+            return await asyncio.gather(*uploads)
+        finally:
+            # 任一文件失败时取消其余文件，等待退出后再返回，避免继续占用连接和并发额度
+            for upload in uploads:
+                upload.cancel()
+            await asyncio.gather(*uploads, return_exceptions=True)
+
+    async def _select_line(self, lines='AUTO'):
+        """选择上传线路，同时上传的多个文件只测速一次，测速在线程中进行，不阻塞事件循环"""
+        if self._line_lock is None:
+            self._line_lock = asyncio.Lock()
+        async with self._line_lock:
+            if self._auto_os:
+                return
+            preferred_upos_cdn = None
             if lines == 'bda':
                 self._auto_os = {"os": "upos", "query": "upcdn=bda&probe_version=20221109",
                                  "probe_url": "//upos-cs-upcdnbda.bilivideo.com/OK"}
@@ -425,8 +597,23 @@ class BiliBili:
                                  "probe_url": "//upos-cs-upcdntxa.bilivideo.com/OK"}
                 preferred_upos_cdn = 'txa'
             else:
-                self._auto_os = self.probe()
+                self._auto_os = await asyncio.to_thread(self.probe)
+            self._preferred_upos_cdn = preferred_upos_cdn
             logger.info(f"线路选择 => {self._auto_os['os']}: {self._auto_os['query']}. time: {self._auto_os.get('cost')}")
+            if self.telemetry:
+                self.telemetry.emit(LineChosen(self._auto_os['os'], self._auto_os['query'], self._auto_os.get('cost')))
+
+    async def preupload(self, query: dict):
+        """在当前线路上申请上传，返回上传地址、鉴权信息和分块大小等"""
+        ret = await self._request('GET', f"https://member.bilibili.com/preupload?{self._auto_os['query']}",
+                                  params=query, timeout=5)
+        logger.debug(f"preupload: {ret}")
+        return ret
+
+    async def _upload_file(self, filepath: str, lines='AUTO', tasks=3, limiter=None, max_tasks=16):
+        if limiter is None:
+            limiter = self._new_limiter(tasks, max_tasks)
+        await self._select_line(lines)
         if self._auto_os['os'] == 'upos':
             upload = self.upos
         # elif self._auto_os['os'] == 'cos':
@@ -441,6 +628,10 @@ class BiliBili:
         logger.info(f"os: {self._auto_os['os']}")
         total_size = os.path.getsize(filepath)
         with open(filepath, 'rb') as f:
+            resumed = self.journal.get(UploadJournal.key(filepath)) if self.journal else None
+            if resumed and self._auto_os['os'] == 'upos':
+                logger.info(f"{filepath} 继续上次未完成的上传，已完成 {len(resumed['parts'])} 个分块")
+                return await upload(f, total_size, resumed['ret'], tasks=tasks, limiter=limiter)
             query = {
                 'r': self._auto_os['os'] if self._auto_os['os'] != 'cos-internal' else 'cos',
                 'profile': 'ugcupos/bup' if 'upos' == self._auto_os['os'] else "ugcupos/bupfetch",
@@ -450,11 +641,8 @@ class BiliBili:
                 'name': f.name,
                 'size': total_size,
             }
-            resp = self.__session.get(
-                f"https://member.bilibili.com/preupload?{self._auto_os['query']}", params=query,
-                timeout=5)
-            ret = resp.json()
-            logger.debug(f"preupload: {ret}")
+            ret = await self.preupload(query)
+            preferred_upos_cdn = self._preferred_upos_cdn
             if preferred_upos_cdn:
                 original_endpoint: str = ret['endpoint']
                 if re.match(r'//upos-(sz|cs)-upcdn(bda2|ws|qn)\.bilivideo\.com', original_endpoint):
@@ -467,9 +655,9 @@ class BiliBili:
                         logger.error(f"Unrecognized preferred_upos_cdn: {preferred_upos_cdn}")
                 else:
                     logger.warning(f"Assigned UpOS endpoint {original_endpoint} was never seen before, something else might have changed, so will not modify it")
-            return asyncio.run(upload(f, total_size, ret, tasks=tasks))
+            return await upload(f, total_size, ret, tasks=tasks, limiter=limiter)
 
-    async def cos(self, file, total_size, ret, chunk_size=10485760, tasks=3, internal=False):
+    async def cos(self, file, total_size, ret, chunk_size=10485760, tasks=3, internal=False, limiter=None):
         filename = file.name
         url = ret["url"]
         if internal:
@@ -482,34 +670,33 @@ class BiliBili:
             "Authorization": ret["put_auth"],
         }
 
-        initiate_multipart_upload_result = ET.fromstring(self.__session.post(f'{url}?uploads&output=json', timeout=5,
-                                                                             headers=post_headers).content)
+        initiate_multipart_upload_result = ET.fromstring(await self._request(
+            'POST', f'{url}?uploads&output=json', timeout=5, raw=True, headers=post_headers))
         upload_id = initiate_multipart_upload_result.find('UploadId').text
         # 开始上传
-        parts = []  # 分块信息
+        parts = {}  # 分块信息，重发的慢分块按分块编号去重
         chunks = math.ceil(total_size / chunk_size)  # 获取分块数量
 
-        async def upload_chunk(session, chunks_data, params):
+        async def upload_chunk(session, chunks_data, params, url=url):
             async with session.put(url, params=params, raise_for_status=True,
                                    data=chunks_data, headers=put_headers) as r:
-                end = time.perf_counter() - start
-                parts.append({"Part": {"PartNumber": params['chunk'] + 1, "ETag": r.headers['Etag']}})
-                sys.stdout.write(f"\r{params['end'] / 1000 / 1000 / end:.2f}MB/s "
-                                 f"=> {params['partNumber'] / chunks:.1%}")
+                parts[params['partNumber']] = {"Part": {"PartNumber": params['chunk'] + 1, "ETag": r.headers['Etag']}}
 
+        if self.telemetry:
+            self.telemetry.emit(FileStart(filename, total_size, chunks, self._auto_os['query'], url))
         start = time.perf_counter()
         await self._upload({
             'uploadId': upload_id,
             'chunks': chunks,
             'total': total_size
-        }, file, chunk_size, upload_chunk, tasks=tasks)
+        }, file, chunk_size, upload_chunk, tasks=tasks, limiter=limiter)
         cost = time.perf_counter() - start
         fetch_headers = {
             "X-Upos-Fetch-Source": ret["fetch_headers"]["X-Upos-Fetch-Source"],
             "X-Upos-Auth": ret["fetch_headers"]["X-Upos-Auth"],
             "Fetch-Header-Authorization": ret["fetch_headers"]["Fetch-Header-Authorization"]
         }
-        parts = sorted(parts, key=lambda x: x['Part']['PartNumber'])
+        parts = sorted(parts.values(), key=lambda x: x['Part']['PartNumber'])
         complete_multipart_upload = ET.Element('CompleteMultipartUpload')
         for part in parts:
             part_et = ET.SubElement(complete_multipart_upload, 'Part')
@@ -518,32 +705,37 @@ class BiliBili:
             e_tag = ET.SubElement(part_et, 'ETag')
             e_tag.text = part['Part']['ETag']
         xml = ET.tostring(complete_multipart_upload)
+        merge_start = time.perf_counter()
         ii = 0
         while ii <= 3:
             try:
-                res = self.__session.post(url, params={'uploadId': upload_id}, data=xml, headers=post_headers,
-                                          timeout=15)
-                if res.status_code == 200:
-                    break
-                raise IOError(res.text)
-            except IOError:
+                await self._request('POST', url, params={'uploadId': upload_id}, data=xml, headers=post_headers,
+                                    timeout=15, raw=True, raise_for_status=True)
+                break
+            except (asyncio.TimeoutError, aiohttp.ClientError):
                 ii += 1
                 logger.info("请求合并分片出现问题，尝试重连，次数：" + str(ii))
-                time.sleep(15)
+                await asyncio.sleep(backoff(ii))
         ii = 0
         while ii <= 3:
             try:
-                res = self.__session.post("https:" + ret["fetch_url"], headers=fetch_headers, timeout=15).json()
+                res = await self._request('POST', "https:" + ret["fetch_url"], headers=fetch_headers, timeout=15)
                 if res.get('OK') == 1:
                     logger.info(f'{filename} uploaded >> {total_size / 1000 / 1000 / cost:.2f}MB/s. {res}')
+                    if self.telemetry:
+                        self.telemetry.emit(MergeEnd(filename, time.perf_counter() - merge_start, True))
+                        self.telemetry.emit(FileEnd(filename, total_size, time.perf_counter() - start, True))
                     return {"title": splitext(os.path.basename(filename))[0], "filename": ret["bili_filename"], "desc": ""}
                 raise IOError(res)
-            except IOError:
+            except (IOError, ValueError, asyncio.TimeoutError, aiohttp.ClientError):
                 ii += 1
                 logger.info("上传出现问题，尝试重连，次数：" + str(ii))
-                time.sleep(15)
+                await asyncio.sleep(backoff(ii))
+        if self.telemetry:
+            self.telemetry.emit(MergeEnd(filename, time.perf_counter() - merge_start, False))
+            self.telemetry.emit(FileEnd(filename, total_size, time.perf_counter() - start, False))
 
-    async def kodo(self, file, total_size, ret, chunk_size=4194304, tasks=3):
+    async def kodo(self, file, total_size, ret, chunk_size=4194304, tasks=3, limiter=None):
         filename = file.name
         bili_filename = ret['bili_filename']
         key = ret['key']
@@ -556,32 +748,35 @@ class BiliBili:
             'Authorization': f"UpToken {token}",
         }
         # 开始上传
-        parts = []  # 分块信息
+        parts = {}  # 分块信息，重发的慢分块按分块编号去重
         chunks = math.ceil(total_size / chunk_size)  # 获取分块数量
 
-        async def upload_chunk(session, chunks_data, params):
+        async def upload_chunk(session, chunks_data, params, url=url):
             async with session.post(f'{url}/{len(chunks_data)}',
                                     data=chunks_data, headers=headers) as response:
-                end = time.perf_counter() - start
                 ctx = await response.json()
-                parts.append({"index": params['chunk'], "ctx": ctx['ctx']})
-                sys.stdout.write(f"\r{params['end'] / 1000 / 1000 / end:.2f}MB/s "
-                                 f"=> {params['partNumber'] / chunks:.1%}")
+                parts[params['chunk']] = {"index": params['chunk'], "ctx": ctx['ctx']}
 
+        if self.telemetry:
+            self.telemetry.emit(FileStart(filename, total_size, chunks, self._auto_os['query'], endpoint))
         start = time.perf_counter()
-        await self._upload({}, file, chunk_size, upload_chunk, tasks=tasks)
+        await self._upload({}, file, chunk_size, upload_chunk, tasks=tasks, limiter=limiter)
         cost = time.perf_counter() - start
 
         logger.info(f'{filename} uploaded >> {total_size / 1000 / 1000 / cost:.2f}MB/s')
-        parts.sort(key=lambda x: x['index'])
-        self.__session.post(f"{endpoint}/mkfile/{total_size}/key/{base64.urlsafe_b64encode(key.encode()).decode()}",
-                            data=','.join(map(lambda x: x['ctx'], parts)), headers=headers, timeout=10)
-        r = self.__session.post(f"https:{fetch_url}", headers=fetch_headers, timeout=5).json()
+        parts = sorted(parts.values(), key=lambda x: x['index'])
+        merge_start = time.perf_counter()
+        await self._request('POST', f"{endpoint}/mkfile/{total_size}/key/{base64.urlsafe_b64encode(key.encode()).decode()}",
+                            data=','.join(map(lambda x: x['ctx'], parts)), headers=headers, timeout=10, raw=True)
+        r = await self._request('POST', f"https:{fetch_url}", headers=fetch_headers, timeout=5)
+        if self.telemetry:
+            self.telemetry.emit(MergeEnd(filename, time.perf_counter() - merge_start, r["OK"] == 1))
+            self.telemetry.emit(FileEnd(filename, total_size, time.perf_counter() - start, r["OK"] == 1))
         if r["OK"] != 1:
             raise Exception(r)
         return {"title": splitext(os.path.basename(filename))[0], "filename": bili_filename, "desc": ""}
 
-    async def upos(self, file, total_size, ret, tasks=3):
+    async def upos(self, file, total_size, ret, tasks=3, limiter=None):
         filename = file.name
         chunk_size = ret['chunk_size']
         auth = ret["auth"]
@@ -592,27 +787,55 @@ class BiliBili:
         headers = {
             "X-Upos-Auth": auth
         }
-        # 向上传地址申请上传，得到上传id等信息
-        upload_id = self.__session.post(f'{url}?uploads&output=json', timeout=15,
-                                        headers=headers).json()["upload_id"]
+        journal_key = UploadJournal.key(filename) if self.journal else None
+        resumed = self.journal.get(journal_key) if self.journal else None
+        if resumed and resumed['ret']['upos_uri'] == upos_uri:
+            # 沿用上次的上传id，跳过已经完成的分块
+            upload_id = resumed['upload_id']
+            done = set(resumed['parts'])
+        else:
+            resumed = None
+            # 向上传地址申请上传，得到上传id等信息
+            upload_id = (await self._request('POST', f'{url}?uploads&output=json', timeout=15,
+                                             headers=headers))["upload_id"]
+            done = set()
+            if self.journal:
+                self.journal.begin(journal_key, ret, upload_id)
+                await self.journal.save()
+        recorder = self.scoreboard.recorder(self._auto_os['query'], endpoint) if self.scoreboard else None
         # 开始上传
-        parts = []  # 分块信息
+        # 分块信息，重发的慢分块按分块编号去重
+        parts = {part_number: {"partNumber": part_number, "eTag": "etag"} for part_number in done}
         chunks = math.ceil(total_size / chunk_size)  # 获取分块数量
+        if self._preferred_upos_cdn:
+            # 指定了线路时只在同一 endpoint 的新连接上重发慢分块
+            hedge_urls = []
+        else:
+            hedge_urls = [f"https:{e}/{upos_uri.replace('upos://', '')}"
+                          for e in ret.get('endpoints', []) if e != endpoint]
 
-        async def upload_chunk(session, chunks_data, params):
+        async def upload_chunk(session, chunks_data, params, url=url):
             async with session.put(url, params=params, raise_for_status=True,
                                    data=chunks_data, headers=headers):
-                end = time.perf_counter() - start
-                parts.append({"partNumber": params['chunk'] + 1, "eTag": "etag"})
-                sys.stdout.write(f"\r{params['end'] / 1000 / 1000 / end:.2f}MB/s "
-                                 f"=> {params['partNumber'] / chunks:.1%}")
+                parts[params['partNumber']] = {"partNumber": params['chunk'] + 1, "eTag": "etag"}
+                if self.journal:
+                    self.journal.complete_part(journal_key, params['partNumber'])
+                    await self.journal.save(force=False)
 
+        if self.telemetry:
+            self.telemetry.emit(FileStart(filename, total_size, chunks, self._auto_os['query'], endpoint))
         start = time.perf_counter()
-        await self._upload({
-            'uploadId': upload_id,
-            'chunks': chunks,
-            'total': total_size
-        }, file, chunk_size, upload_chunk, tasks=tasks)
+        try:
+            await self._upload({
+                'uploadId': upload_id,
+                'chunks': chunks,
+                'total': total_size
+            }, file, chunk_size, upload_chunk, tasks=tasks, limiter=limiter, skip=done, recorder=recorder,
+                hedge_urls=hedge_urls)
+        finally:
+            if self.journal:
+                # 上传结束或中断时把尚未落盘的分块写入记录
+                await asyncio.shield(self.journal.save())
         cost = time.perf_counter() - start
         p = {
             'name': filename,
@@ -621,51 +844,147 @@ class BiliBili:
             'output': 'json',
             'profile': 'ugcupos/bup'
         }
+        parts = sorted(parts.values(), key=lambda x: x['partNumber'])
+        merge_start = time.perf_counter()
         attempt = 0
         while attempt <= 5:  # 一旦放弃就会丢失前面所有的进度，多试几次吧
             try:
-                r = self.__session.post(url, params=p, json={"parts": parts}, headers=headers, timeout=15).json()
+                r = await self._request('POST', url, params=p, json={"parts": parts}, headers=headers, timeout=15)
                 if r.get('OK') == 1:
+                    if recorder:
+                        await recorder.merge(True)
+                    if self.telemetry:
+                        self.telemetry.emit(MergeEnd(filename, time.perf_counter() - merge_start, True))
+                        self.telemetry.emit(FileEnd(filename, total_size, time.perf_counter() - start, True))
+                    if self.journal:
+                        self.journal.finish(journal_key)
+                        await self.journal.save()
                     logger.info(f'{filename} uploaded >> {total_size / 1000 / 1000 / cost:.2f}MB/s. {r}')
                     return {"title": splitext(os.path.basename(filename))[0], "filename": splitext(basename(upos_uri))[0], "desc": ""}
                 raise IOError(r)
-            except IOError:
+            except (IOError, ValueError, asyncio.TimeoutError, aiohttp.ClientError):
                 attempt += 1
                 logger.info(f"请求合并分片时出现问题，尝试重连，次数：" + str(attempt))
-                time.sleep(15)
-
-    @staticmethod
-    async def _upload(params, file, chunk_size, afunc, tasks=3):
-        params['chunk'] = -1
-
-        async def upload_chunk():
-            while True:
-                chunks_data = file.read(chunk_size)
-                if not chunks_data:
-                    return
-                params['chunk'] += 1
-                params['size'] = len(chunks_data)
-                params['partNumber'] = params['chunk'] + 1
-                params['start'] = params['chunk'] * chunk_size
-                params['end'] = params['start'] + params['size']
-                clone = params.copy()
-                for i in range(10):
-                    try:
-                        await afunc(session, chunks_data, clone)
-                        break
-                    except (asyncio.TimeoutError, aiohttp.ClientError) as e:
-                        logger.error(f"retry chunk{clone['chunk']} >> {i + 1}. {e}")
-
-        async with aiohttp.ClientSession() as session:
-            await asyncio.gather(*[upload_chunk() for _ in range(tasks)])
+                await asyncio.sleep(backoff(attempt))
+        if recorder:
+            await recorder.merge(False)
+        if self.telemetry:
+            self.telemetry.emit(MergeEnd(filename, time.perf_counter() - merge_start, False))
+            self.telemetry.emit(FileEnd(filename, total_size, time.perf_counter() - start, False))
+        if resumed:
+            # 续传后仍无法合并，上次的上传id可能已经失效，下次重新上传
+            logger.error(f"{filename} 续传后合并失败，清除断点记录")
+            self.journal.finish(journal_key)
+            await self.journal.save()
+
+    async def _upload(self, params, file, chunk_size, afunc, tasks=3, limiter=None, skip=(), recorder=None,
+                      hedge_urls=()):
+        """
+        :param afunc: 上传单个分块的协程函数 afunc(session, chunks_data, params, url=...)，可能被并发调用两次
+        :param hedge_urls: 重发慢分块时依次使用的上传地址，为空时在原地址的新连接上重发
+        """
+        # limiter 为自适应的分块并发额度，可由多个文件共享，未指定时固定为 tasks
+        if limiter is None:
+            limiter = AsyncAimdLimiter(tasks, tasks)
+        hedge = HedgePolicy(self.hedge_factor)
+        alternates = itertools.cycle(hedge_urls) if hedge_urls else None
+        telemetry = self.telemetry
+        filename = file.name
+
+        async def send(session, chunks_data, clone):
+            first = asyncio.ensure_future(afunc(session, chunks_data, clone))
+            attempts = {first}
+            try:
+                delay = hedge.delay()
+                done, _ = await asyncio.wait(attempts, timeout=delay)
+                if done:
+                    return first.result()
+                if alternates:
+                    url = next(alternates)
+                    logger.info(f"分块{clone['partNumber']}超过 {delay:.2f}s 未完成，在 {url} 上重发")
+                    second = asyncio.ensure_future(afunc(session, chunks_data, clone, url=url))
+                else:
+                    url = None
+                    logger.info(f"分块{clone['partNumber']}超过 {delay:.2f}s 未完成，在新连接上重发")
+                    second = asyncio.ensure_future(afunc(session, chunks_data, clone))
+                if telemetry:
+                    telemetry.emit(ChunkHedged(filename, clone['partNumber'], delay, url))
+                attempts.add(second)
+                pending = attempts
+                while pending:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        if task.exception() is None:
+                            return
+                # 两次都失败时抛出原请求的异常
+                return first.result()
+            finally:
+                # 取消仍在进行的请求，并等待其释放连接和分块数据
+                for task in attempts:
+                    task.cancel()
+                await asyncio.gather(*attempts, return_exceptions=True)
+
+        with ChunkReader(file, chunk_size) as reader:
+            # 所有协程共享同一个分块表迭代器，每个分块只会被取出一次
+            chunk_iter = (chunk for chunk in reader if chunk.index + 1 not in skip)
+
+            async def upload_chunk():
+                for chunk in chunk_iter:
+                    clone = {
+                        **params,
+                        'chunk': chunk.index,
+                        'size': chunk.size,
+                        'partNumber': chunk.index + 1,
+                        'start': chunk.start,
+                        'end': chunk.end,
+                    }
+                    async with limiter:
+                        # 分块是文件映射的视图，不占用进程内存，并发由 limiter 控制，不计入 ByteBudget
+                        with reader.read(chunk) as chunks_data:
+                            if telemetry:
+                                telemetry.emit(ChunkStart(filename, clone['partNumber'], chunk.size))
+                            for i in range(10):
+                                chunk_start = time.perf_counter()
+                                try:
+                                    await send(session, chunks_data, clone)
+                                    chunk_cost = time.perf_counter() - chunk_start
+                                    limiter.success(chunk.size, chunk_cost)
+                                    hedge.record(chunk_cost)
+                                    if recorder:
+                                        recorder.chunk(chunk.size, chunk_cost)
+                                    if telemetry:
+                                        telemetry.emit(ChunkEnd(filename, clone['partNumber'], chunk.size, chunk_cost))
+                                    break
+                                except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+                                    limiter.failure()
+                                    if recorder:
+                                        recorder.error()
+                                    if telemetry:
+                                        telemetry.emit(ChunkRetry(filename, clone['partNumber'], i + 1, str(e)))
+                                    logger.error(f"retry chunk{clone['chunk']} >> {i + 1}. {e}")
+                                    await asyncio.sleep(backoff(i, base=0.5, cap=10))
+
+            async with self.runtime.session() as session:
+                # 按上限启动协程，实际同时上传的分块数由 limiter 控制
+                workers = [asyncio.ensure_future(upload_chunk()) for _ in range(limiter.maximum)]
+                try:
+                    await asyncio.gather(*workers)
+                finally:
+                    # 出错或被取消时等待所有协程退出，释放分块视图后才能关闭文件映射
+                    for worker in workers:
+                        worker.cancel()
+                    await asyncio.gather(*workers, return_exceptions=True)
 
     def submit(self, submit_api: Optional[str] = 'web'):
+        return self.runtime.run(self.submit_async(submit_api))
+
+    async def submit_async(self, submit_api: Optional[str] = 'web'):
         if not self.video.title:
             self.video.title = self.video.videos[0]["title"]
-        self.__session.get('https://member.bilibili.com/x/geetest/pre/add', timeout=5)
+        await self._request('GET', 'https://member.bilibili.com/x/geetest/pre/add', timeout=5, raw=True)
 
         if submit_api is None:
-            total_info = self.__session.get('http://api.bilibili.com/x/space/myinfo', timeout=15).json()
+            total_info = await self._request('GET', 'http://api.bilibili.com/x/space/myinfo', timeout=15)
             if total_info.get('data') is None:
                 logger.error(total_info)
             total_info = total_info.get('data')
@@ -677,7 +996,7 @@ class BiliBili:
             submit_api = 'web'
         ret = None
         if submit_api == 'web':
-            ret = self.submit_web()
+            ret = await self.submit_web_async()
             if ret["code"] != 0:
                 logger.error(f'网页端接口提交失败: {ret}')
                 raise Exception(ret)
@@ -686,23 +1005,29 @@ class BiliBili:
         return ret
 
     def submit_web(self):
+        return self.runtime.run(self.submit_web_async())
+
+    async def submit_web_async(self):
         logger.info('使用网页端api提交')
-        return self.__session.post(f'https://member.bilibili.com/x/vu/web/add?csrf={self.__bili_jct}', timeout=5,
-                                   json=asdict(self.video)).json()
+        return await self._request('POST', f'https://member.bilibili.com/x/vu/web/add?csrf={self.__bili_jct}',
+                                   timeout=5, json=asdict(self.video))
 
     def submit_client(self):
+        return self.runtime.run(self.submit_client_async())
+
+    async def submit_client_async(self):
         logger.info('使用客户端api端提交')
         if not self.access_token:
             if self.account is None:
                 raise RuntimeError("Access token is required, but account and access_token does not exist!")
-            self.login_by_password(**self.account)
+            await asyncio.to_thread(self.login_by_password, **self.account)
             self.store()
         while True:
-            ret = self.__session.post(f'http://member.bilibili.com/x/vu/client/add?access_key={self.access_token}',
-                                      timeout=5, json=asdict(self.video)).json()
+            ret = await self._request('POST', f'http://member.bilibili.com/x/vu/client/add?access_key={self.access_token}',
+                                      timeout=5, json=asdict(self.video))
             if ret['code'] == -101:
                 logger.info(f'刷新token{ret}')
-                self.login_by_password(**config['user']['account'])
+                await asyncio.to_thread(self.login_by_password, **self.account)
                 self.store()
                 continue
             return ret
@@ -712,31 +1037,36 @@ class BiliBili:
         :param img: img path or stream
         :return: img URL
         """
-        from PIL import Image
-        from io import BytesIO
-
-        with Image.open(img) as im:
-            # 宽和高,需要16：10
-            xsize, ysize = im.size
-            if xsize / ysize > 1.6:
-                delta = xsize - ysize * 1.6
-                region = im.crop((delta / 2, 0, xsize - delta / 2, ysize))
-            else:
-                delta = ysize - xsize * 10 / 16
-                region = im.crop((0, delta / 2, xsize, ysize - delta / 2))
-            buffered = BytesIO()
-            region.save(buffered, format=im.format)
-        r = self.__session.post(
-            url='https://member.bilibili.com/x/vu/web/cover/up',
-            data={
-                'cover': b'data:image/jpeg;base64,' + (base64.b64encode(buffered.getvalue())),
-                'csrf': self.__bili_jct
-            }, timeout=30
-        )
-        buffered.close()
-        res = r.json()
+        return self.runtime.run(self.cover_up_async(img))
+
+    async def cover_up_async(self, img: str):
+        """
+        :param img: img path or stream
+        :return: img URL
+        """
+        source = await asyncio.to_thread(read_image, img)
+        key = CoverCache.key(source)
+        cover = None
+        # 封面缓存的读写都会访问磁盘，放到线程中进行，不阻塞其他上传
+        if self.cover_cache:
+            url = await asyncio.to_thread(self.cover_cache.get_url, key)
+            if url:
+                logger.info(f'使用已上传的封面: {url}')
+                return url
+            cover = await asyncio.to_thread(self.cover_cache.get_image, key)
+        if cover is None:
+            # 图片解码和裁剪是 CPU 密集操作，放到线程中进行
+            cover = await asyncio.to_thread(crop_cover, source)
+            if self.cover_cache:
+                await asyncio.to_thread(self.cover_cache.put, key, image=cover)
+        res = await self._request('POST', 'https://member.bilibili.com/x/vu/web/cover/up', data={
+            'cover': 'data:image/jpeg;base64,' + base64.b64encode(cover).decode(),
+            'csrf': self.__bili_jct
+        }, timeout=30)
         if res.get('data') is None:
             raise Exception(res)
+        if self.cover_cache:
+            await asyncio.to_thread(self.cover_cache.put, key, url=res['data']['url'])
         return res['data']['url']
 
     def get_tags(self, upvideo, typeid="", desc="", cover="", groupid=1, vfea=""):
@@ -957,6 +1287,12 @@ class BiliBili:
     def close(self):
         """Closes all adapters and as such the session"""
         self.__session.close()
+        if self._runtime is not None:
+            if self._api_session is not None:
+                self._runtime.run(self._api_session.close())
+                self._api_session = None
+            self._runtime.release()
+            self._runtime = None
 
 
 @dataclass
@@ -1,5 +1,6 @@
 import asyncio
 import base64
+import collections
 import concurrent.futures
 import hashlib
 import json
@@ -19,14 +20,20 @@ from typing import Callable, Dict, Union, Any, List, NamedTuple, Optional
 from urllib import parse
 from urllib.parse import quote
 
-# import aiohttp
 from concurrent.futures.thread import ThreadPoolExecutor
 import concurrent
+import aiohttp
 import requests.utils
 import rsa
 import xml.etree.ElementTree as ET
 from requests.adapters import HTTPAdapter, Retry
 
+from .upload_buffer import ByteBudget, ChunkAssembler, DiskRing, SpilledChunk, StreamQueue, TeeWriter
+from .upload_concurrency import AsyncAimdLimiter
+from .upload_cover import CoverCache, crop_cover, read_image
+from .upload_line import LineScoreboard, probe_lines
+from .upload_runtime import UploadRuntime
+from .upload_telemetry import ChunkEnd, ChunkRetry, ChunkStart, FileEnd, FileStart, LineChosen, MergeEnd, UploadTelemetry
 
 
 logger = logging.getLogger('biliup.engine.bili_web_sync')
@@ -42,8 +49,19 @@ class BiliWebAsync:
             self, principal, data, submit_api=None, copyright=2, postprocessor=None, dtime=None,
             dynamic='', lines='AUTO', threads=3, tid=122, tags=None, cover_path=None, description='',
             dolby=0, hires=0, no_reprint=0, is_only_self=0, charging_pay=0, credits=None,
-            user_cookie='cookies.json', copyright_source=None, extra_fields="", video_queue=None
+            user_cookie='cookies.json', copyright_source=None, extra_fields="", video_queue=None, max_threads=16,
+            telemetry=None, queue_max_bytes=64 * 1024 * 1024, queue_policy='spill', ring_dir=None,
+            save_dir=None, save_preallocate=None
     ):
+        """
+        :param video_queue: 录制数据队列，为 None 时创建按字节数限制的 StreamQueue
+        :param queue_max_bytes: 每个分P上传队列在内存中最多缓存的字节数
+        :param queue_policy: 上传跟不上录制时的处理方式，见 StreamQueue；
+            为 'ring' 时每个分P使用 ring_dir 下大小为 queue_max_bytes 的 DiskRing，上传中断时数据留在磁盘上
+        :param ring_dir: DiskRing 缓冲文件目录，为 None 时使用当前目录
+        :param save_dir: 同时保存分P本地副本的目录（配置项 sync_save_dir），为 None 时不保存
+        :param save_preallocate: 为本地副本预先分配的空间（字节，配置项 sync_save_preallocate）
+        """
         self.principal = principal
         self.data: dict = data
         self.persistence_path = 'bili.cookie'
@@ -55,6 +73,8 @@ class BiliWebAsync:
         self.lines = lines
         self.submit_api = submit_api
         self.threads = threads
+        self.max_threads = max_threads
+        self.telemetry = telemetry
         self.tid = tid
         self.tags = tags
         self.dtime = dtime
@@ -77,15 +97,73 @@ class BiliWebAsync:
         self.extra_fields = extra_fields
 
         self.user_cookie = user_cookie
-        self.video_queue: queue.SimpleQueue = video_queue
+        self.queue_max_bytes = queue_max_bytes
+        self.queue_policy = queue_policy
+        self.ring_dir = ring_dir
+        self.save_dir = save_dir
+        self.save_preallocate = save_preallocate
+        if video_queue is None:
+            video_queue = StreamQueue(queue_max_bytes, 'spill' if queue_policy == 'ring' else queue_policy)
+        self.video_queue: Union[queue.SimpleQueue, StreamQueue] = video_queue
+
+    def _open_part_queue(self, file_name: str) -> Union[StreamQueue, DiskRing]:
+        if self.queue_policy != 'ring':
+            return StreamQueue(self.queue_max_bytes, self.queue_policy)
+        directory = self.ring_dir or '.'
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f'{os.path.basename(file_name)}.ring')
+        if os.path.exists(path):
+            # 同名文件是之前上传失败的分P留下的数据，与本次直播无关，不能拼接到新数据前面。
+            # 这里不做恢复，只是改名保留，需要时用 DiskRing 打开后手动读出
+            kept = self._unused_path(f"{path}.{time.strftime('%Y%m%d%H%M%S')}")
+            os.rename(path, kept)
+            logger.warning(f"{path} 为之前未上传完的数据，已改名为 {kept} 保留，不会上传")
+        return DiskRing(path, self.queue_max_bytes)
+
+    @staticmethod
+    def _put_part(part_queue, data, upload: concurrent.futures.Future, stop_event: threading.Event) -> bool:
+        """
+        写入分P的上传队列，队列已满时每秒检查一次分P上传是否已经结束或需要停止
+        :return: 写入成功时为 True；上传端已不再读取队列时为 False，不会一直阻塞录制
+        """
+        while True:
+            try:
+                part_queue.put(data, timeout=1)
+                return True
+            except queue.Full:
+                if upload.done() or stop_event.is_set():
+                    return False
+
+    @staticmethod
+    def _drain_part(part_queue) -> list:
+        """取出已结束的分P上传队列中没有读取的分包"""
+        items = []
+        while True:
+            try:
+                items.append(part_queue.get_nowait())
+            except queue.Empty:
+                return items
+
+    @staticmethod
+    def _unused_path(prefix: str) -> str:
+        """返回以 prefix 开头且不存在的文件名，不覆盖之前保留的文件"""
+        path = prefix
+        index = 1
+        while os.path.exists(path):
+            path = f'{prefix}.{index}'
+            index += 1
+        return path
 
     def upload(self, total_size: int, stop_event: threading.Event, output_prefix: str, file_name_callback: Callable[[str], None] = None, database_row_id=0) -> List[FileInfo]:
         # print("开始同步上传")
         logger.info(f"开始同步上传 {database_row_id}")
         file_index = 1
         videos = Data()
-        bili = BiliBili(videos)
+        bili = BiliBili(videos, save_dir=self.save_dir, save_preallocate=self.save_preallocate)
         bili.database_row_id = database_row_id
+        bili.threads, bili.max_threads = self.threads, max(self.max_threads, self.threads)
+        if self.telemetry:
+            bili.telemetry.subscribe(self.telemetry)
 
         bili.login(self.persistence_path, self.user_cookie)
         videos.title = self.data["format_title"][:80]  # 稿件标题限制80字
@@ -117,8 +195,16 @@ class BiliWebAsync:
         videos.is_only_self = self.is_only_self
         videos.charging_pay = self.charging_pay
 
-        thread_list = []
-        while True:
+        # 所有分P在共享的上传事件循环中运行
+        upload_list = []
+        queue_list = []
+        # 在当前分P上传期间提前为下一个分P申请上传，切换分P时不用等待 preupload
+        prewarm = ThreadPoolExecutor(max_workers=1, thread_name_prefix='upload_prepare')
+        prepared = prewarm.submit(bili.prepare_stream, f"{output_prefix}_{file_index}.mkv", total_size, self.lines)
+        pending = collections.deque()  # 上一个分P结束后没有读取的分包，按顺序写入下一个分P
+        part_sizes = {}
+        stopped = False
+        while not stopped:
             # 调试使用 分p 强制停止
             # if file_index > 10:
             #     logger.info(f"[consumer debug] 停止下载回调")
@@ -130,41 +216,82 @@ class BiliWebAsync:
             # if file_name_callback:
             # file_name_callback(file_name)
             data_size = 0
-            video_upload_queue = queue.SimpleQueue()
+            # 上传跟不上时按 queue_policy 限制内存中缓存的数据量
+            video_upload_queue = self._open_part_queue(file_name)
+            queue_list.append((file_name, video_upload_queue))
 
-            t = threading.Thread(target=bili.upload_stream, args=(video_upload_queue,
-                                 file_name, total_size, self.lines, videos, stop_event, file_name_callback), daemon=True, name=f"upload_{file_index}")
-            thread_list.append(t)
-            t.start()
+            future = asyncio.run_coroutine_threadsafe(bili.upload_stream_async(
+                video_upload_queue, file_name, total_size, self.lines, videos, stop_event, file_name_callback,
+                prepared=prepared, ticket=bili.submitter.begin()), bili.runtime.loop)
+            upload_list.append((file_name, future))
+            next_name = f"{output_prefix}_{file_index + 1}.mkv"
+            prepared = prewarm.submit(bili.prepare_stream, next_name, total_size, self.lines)
 
             while True:
-                try:
-                    data = self.video_queue.get(timeout=10)
-                except queue.Empty:
-                    break
+                # 分P时间较长时，在提前申请的上传过期前重新申请
+                prepared = bili.refresh_prepared(prewarm, prepared, next_name, total_size, self.lines)
+                if pending:
+                    data = pending.popleft()
+                else:
+                    try:
+                        data = self.video_queue.get(timeout=10)
+                    except queue.Empty:
+                        break
 
+                if future.done() or not self._put_part(video_upload_queue, data, future, stop_event):
+                    if stop_event.is_set():
+                        logger.info(f"[consumer] {file_name} 已停止上传")
+                        stopped = True
+                        break
+                    # 分P已达到 total_size、空闲超时或上传已结束，队列中没有读取的数据交给下一个分P
+                    leftover = self._drain_part(video_upload_queue)
+                    data_size -= sum(len(item) for item in leftover if item is not None)
+                    pending.extendleft(reversed(leftover + [data]))
+                    logger.warning(f"[consumer] {file_name} 已不再读取上传队列，{len(pending)} 个分包写入下一个分P")
+                    break
                 if data is None:
-                    video_upload_queue.put(None)
                     break
-
-                video_upload_queue.put(data)
                 # print(video_upload_queue.empty())
                 data_size += len(data)
             # print(f"[consumer] 读取 {file_name} {data_size} 字节")
             logger.info(f"[consumer] 读取 {file_name} {data_size} 字节")
+            part_sizes[file_name] = data_size
             file_index += 1
             # print("[consumer] bili.video.videos", bili.video.videos)
             logger.info(f"[consumer] bili.video.videos {bili.video.videos}")
-            if data_size < 100:
+            if data_size < 100 and not pending:
                 # print(f"[consumer] 停止下载回调")
                 # n = video_upload_queue.get()
                 logger.info(f"[consumer] 停止下载回调")
                 stop_event.set()
                 break
 
-        logger.info("等待上传线程结束")
-        for t in thread_list:
-            t.join()
+        # 最后一次提前申请的上传不会被使用
+        bili.abort_prepared(prepared)
+        prewarm.shutdown(wait=False)
+        logger.info("等待上传结束")
+        failed = set()  # 没有交给 submitter 投稿的分P，其缓冲文件需要保留
+        for file_name, future in upload_list:
+            try:
+                if not future.result():
+                    failed.add(file_name)
+            except Exception:
+                failed.add(file_name)
+                logger.exception(f"{file_name} 上传出错")
+        bili.close()
+        for file_name, video_upload_queue in queue_list:
+            stats = video_upload_queue.stats()
+            logger.info(f"{file_name} 上传队列: {stats}")
+            if isinstance(video_upload_queue, DiskRing):
+                # 有数据的分P上传失败时保留缓冲文件，其中未上传的数据可以用 DiskRing 打开后手动读出
+                keep = file_name in failed and part_sizes.get(file_name, 0) > 0
+                if keep:
+                    logger.warning(f"{file_name} 未上传的数据保留在 {video_upload_queue.path}")
+                video_upload_queue.close(remove=not keep)
+                continue
+            if stats['dropped_bytes']:
+                logger.warning(f"{file_name} 丢弃了 {stats['dropped_bytes']} 字节, 位置: {video_upload_queue.gaps}")
+            video_upload_queue.close()
 
         # ret = bili.submit(self.submit_api)  # 提交视频
         # logger.info(f"上传成功: {ret}")
@@ -204,8 +331,82 @@ class BiliWebAsync:
         return desc_v2
 
 
+class SubmitCoordinator:
+    """
+    同一场直播的分P投稿协调
+    分P上传完成后交给协调器按开始上传的顺序排队，等待 debounce 秒合并期间完成的分P后只提交一次 add/edit，
+    同一时间只有一个提交在进行；前面的分P仍在上传时，后面完成的分P等待其完成或失败后再按顺序提交
+    """
+
+    def __init__(self, bili: 'BiliBili', debounce=3.0):
+        """
+        :param debounce: 提交前等待合并其他分P的时间（秒）
+        """
+        self.bili = bili
+        self.debounce = debounce
+        self._cond = threading.Condition()
+        self._next_ticket = 0
+        self._done = 0  # 编号小于 _done 的分P都已处理
+        self._parts: Dict[int, Optional[tuple]] = {}  # 已完成的分P，None 表示上传失败
+        self._worker: Optional[threading.Thread] = None
+
+    def begin(self) -> int:
+        """分P开始上传时调用，返回排队编号"""
+        with self._cond:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            return ticket
+
+    def cancel(self, ticket: int):
+        """分P上传失败，不再等待该分P"""
+        with self._cond:
+            self._parts[ticket] = None
+            self._wake()
+
+    def submit(self, ticket: int, video_part: dict, videos: 'Data', submit_api=None) -> concurrent.futures.Future:
+        """提交上传完成的分P，返回的 Future 在包含该分P的投稿完成后得到接口返回值"""
+        future = concurrent.futures.Future()
+        with self._cond:
+            self._parts[ticket] = (video_part, videos, submit_api, future)
+            self._wake()
+        return future
+
+    def _wake(self):
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._run, daemon=True, name='upload_submit')
+            self._worker.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: False, self.debounce)
+                end = self._done
+                while end in self._parts:
+                    end += 1
+                items = [self._parts.pop(ticket) for ticket in range(self._done, end)]
+                self._done = end
+                items = [item for item in items if item is not None]
+                if not items:
+                    self._worker = None
+                    return
+            parts = [item[0] for item in items]
+            _, videos, submit_api, _ = items[-1]
+            try:
+                ret = self.bili.submit_parts(parts, videos, submit_api)
+            except Exception as e:
+                for item in items:
+                    item[3].set_exception(e)
+            else:
+                for item in items:
+                    item[3].set_result(ret)
+
+
 class BiliBili:
-    def __init__(self, video: 'Data'):
+    def __init__(self, video: 'Data', save_dir: Optional[str] = None, save_preallocate: Optional[int] = None):
+        """
+        :param save_dir: 直播分P同时保存本地副本的目录，为 None 时不保存
+        :param save_preallocate: 为本地副本预先分配的空间（字节），写入结束后截断为实际大小
+        """
         self.app_key = None
         self.appsec = None
         # if self.app_key is None or self.appsec is None:
@@ -226,13 +427,27 @@ class BiliBili:
         self.__bili_jct = None
         self._auto_os = None
         self.persistence_path = 'engine/bili.cookie'
+        self.scoreboard: Optional[LineScoreboard] = None
+        self.cover_cache: Optional[CoverCache] = None
 
-        self.save_dir = config.get('sync_save_dir', None)
-        self.save_path = ''
+        self.save_dir = save_dir
+        self.save_preallocate = save_preallocate
         if self.save_dir and not os.path.exists(self.save_dir):
             os.makedirs(self.save_dir)
 
         self.database_row_id = 0
+        # 分块并发数的初始值和上限，同一场直播的所有分P共享 stream_concurrency 的并发额度
+        self.threads = 3
+        self.max_threads = 16
+        self.stream_concurrency: Optional[AsyncAimdLimiter] = None  # upos_stream_async 使用的并发控制
+        self._runtime: Optional[UploadRuntime] = None
+        self.telemetry = UploadTelemetry()  # 上传事件，可通过 subscribe 添加统计回调
+        self.prepared_ttl = 30 * 60  # 提前申请的上传超过该时间（秒）未使用时重新申请
+        self.repair_rounds = 2  # 合并前重传失败分块的轮数
+        self.submitter = SubmitCoordinator(self)  # 合并同一稿件各分P的投稿
+        self._user_weight = None
+        # 所有实例共享的在途分块内存预算，可通过 ByteBudget.configure 调整上限
+        self.budget = ByteBudget.shared()
 
     def myinfo(self, cookies: dict = None):
         if cookies:
@@ -242,6 +457,12 @@ class BiliBili:
 
     def login(self, persistence_path, user_cookie):
         self.persistence_path = user_cookie
+        # 线路记录和封面缓存与cookie文件放在同一目录
+        state_dir = os.path.dirname(os.path.abspath(user_cookie))
+        if self.scoreboard is None:
+            self.scoreboard = LineScoreboard.open(os.path.join(state_dir, 'upload_lines.json'))
+        if self.cover_cache is None:
+            self.cover_cache = CoverCache.open(os.path.join(state_dir, 'cover_cache'))
         if os.path.isfile(user_cookie):
             print('使用持久化内容上传')
             self.load()
@@ -335,45 +556,24 @@ class BiliBili:
         if r and r["code"] == 0:
             return r['data']['hash'], rsa.PublicKey.load_pkcs1_openssl_pem(r['data']['key'].encode())
 
-    def probe(self):
+    def probe(self, fast_enough: Optional[float] = None):
+        """
+        选择上传线路，优先根据历史上传记录选择，没有记录时并发测速所有线路，选择耗时最短的线路
+        :param fast_enough: 出现耗时不超过该值（秒）的线路时立即选用
+        """
         ret = self.__session.get('https://member.bilibili.com/preupload?r=probe', timeout=5).json()
         logger.info(f"线路:{ret['lines']}")
-        data, auto_os = None, None
-        min_cost = 0
-        if ret['probe'].get('get'):
-            method = 'get'
-        else:
-            method = 'post'
-            data = bytes(int(1024 * 0.1 * 1024))
-        for line in ret['lines']:
-            start = time.perf_counter()
-            test = self.__session.request(method, f"https:{line['probe_url']}", data=data, timeout=30)
-            cost = time.perf_counter() - start
-            print(line['query'], cost)
-            if test.status_code != 200:
-                return
-            if not min_cost or min_cost > cost:
-                auto_os = line
-                min_cost = cost
-        auto_os['cost'] = min_cost
-        return auto_os
+        if self.scoreboard:
+            auto_os = self.scoreboard.choose(ret['lines'])
+            if auto_os:
+                return auto_os
+        return probe_lines(self.__session, ret, fast_enough=fast_enough)
 
-    def upload_stream(
-            self,
-            stream_queue: queue.SimpleQueue,
-            file_name,
-            total_size,
-            lines='AUTO',
-            videos: 'Data' = None,
-            stop_event: threading.Event = None,
-            file_name_callback: Callable[[str], None] = None,
-            submit_api: Callable[[str], None] = None
-    ):
-        from biliup.app import context
-
-        logger.info(f"{file_name} 开始上传")
-        if self.save_dir:
-            self.save_path = os.path.join(self.save_dir, file_name)
+    def prepare_stream(self, file_name, total_size, lines='AUTO') -> Optional[dict]:
+        """
+        选择线路并为直播分P申请上传（preupload 和 ?uploads），可以在上一个分P上传期间提前执行
+        :return: preupload 的返回值，附带 upload_id；失败时返回 None
+        """
         cs_upcdn = ['alia', 'bda', 'bda2', 'bldsa', 'qn', 'tx', 'txa']
         jd_upcdn = ['jd-alia', 'jd-bd', 'jd-bldsa', 'jd-tx', 'jd-txa']
         preferred_upos_cdn = None
@@ -390,9 +590,9 @@ class BiliBili:
             else:
                 self._auto_os = self.probe()
             logger.info(f"线路选择 => {self._auto_os['os']}: {self._auto_os['query']}. time: {self._auto_os.get('cost')}")
-        if self._auto_os['os'] == 'upos':
-            upload = self.upos_stream
-        else:
+            if self.telemetry:
+                self.telemetry.emit(LineChosen(self._auto_os['os'], self._auto_os['query'], self._auto_os.get('cost')))
+        if self._auto_os['os'] != 'upos':
             logger.error(f"NoSearch:{self._auto_os['os']}")
             raise NotImplementedError(self._auto_os['os'])
         logger.info(f"os: {self._auto_os['os']}")
@@ -410,7 +610,7 @@ class BiliBili:
             timeout=5)
         ret = resp.json()
         if "chunk_size" not in ret:
-            stop_event.set()
+            logger.error(f"{file_name} preupload 失败: {ret}")
             return
         logger.debug(f"preupload: {ret}")
         if preferred_upos_cdn:
@@ -423,232 +623,393 @@ class BiliBili:
                         break
                 else:
                     logger.warning(f"选择的线路 {self._auto_os['os']} 没有返回对应 endpoint，不做修改")
-        video_part = asyncio.run(upload(stream_queue, file_name, total_size, ret))
-        if video_part is None:
-            stop_event.set()
-            # print("异常流 直接退出")
+        ret['upload_id'] = self.upos_init(ret)
+        ret['name'] = file_name
+        ret['prepared_at'] = time.time()
+        return ret
+
+    def refresh_prepared(self, executor: ThreadPoolExecutor, prepared: concurrent.futures.Future, file_name,
+                         total_size, lines='AUTO', margin=60) -> concurrent.futures.Future:
+        """
+        提前申请的上传距离 prepared_ttl 不足 margin 秒时放弃，在 executor 中重新申请
+        :return: 仍然可用的 prepared，或重新申请的 Future
+        """
+        if not prepared.done() or prepared.cancelled() or prepared.exception() is not None:
+            return prepared
+        ret = prepared.result()
+        if ret is None or time.time() - ret['prepared_at'] < self.prepared_ttl - margin:
+            return prepared
+        logger.info(f"{file_name} 提前申请的上传即将过期，重新申请")
+        self.abort_prepared(prepared)
+        return executor.submit(self.prepare_stream, file_name, total_size, lines)
+
+    def abort_prepared(self, prepared: concurrent.futures.Future):
+        """放弃不再使用的提前申请，还未开始时直接取消，已经得到 upload_id 时通知服务端取消上传"""
+        if prepared.cancel():
             return
-        video_part['title'] = video_part['title'][:80]
 
-        if str(self.database_row_id) in context["sync_downloader_map"]:
-            context_data = context["sync_downloader_map"][str(self.database_row_id)].copy()
+        def abort(future):
+            if not future.cancelled() and future.exception() is None and future.result():
+                self.upos_abort(future.result())
+        prepared.add_done_callback(abort)
+
+    def upload_stream(
+            self,
+            stream_queue: queue.SimpleQueue,
+            file_name,
+            total_size,
+            lines='AUTO',
+            videos: 'Data' = None,
+            stop_event: threading.Event = None,
+            file_name_callback: Callable[[str], None] = None,
+            submit_api: Callable[[str], None] = None,
+            prepared: Optional[concurrent.futures.Future] = None,
+            ticket: Optional[int] = None
+    ):
+        """
+        在 runtime 的事件循环中执行 upload_stream_async，阻塞到该分P投稿完成
+        :param prepared: 预先执行的 prepare_stream，为 None、失败、文件名不符或已过期时重新申请
+        :param ticket: submitter.begin 返回的排队编号，为 None 时在这里取号
+        """
+        return self.runtime.run(self.upload_stream_async(
+            stream_queue, file_name, total_size, lines, videos, stop_event, file_name_callback, submit_api,
+            prepared, ticket))
+
+    def _open_save_file(self, file_name: str) -> Optional[TeeWriter]:
+        """设置了 sync_save_dir 时在独立线程中写入分P的本地副本"""
+        if not self.save_dir:
+            return None
+        return TeeWriter(os.path.join(self.save_dir, file_name), preallocate=self.save_preallocate or None)
+
+    def submit_parts(self, parts: List[dict], videos: 'Data', submit_api=None):
+        """把上传完成的分P加入稿件，稿件还未创建时投稿，否则编辑稿件追加分P"""
+        from biliup.app import context
+
+        key = str(self.database_row_id)
+        if key in context["sync_downloader_map"]:
+            context_data = context["sync_downloader_map"][key].copy()
             context_data.pop('subtitle', None)
+            # 提交失败时不影响已记录的分P列表
+            context_data['videos'] = list(context_data['videos'])
             videos = Data(**context_data)
 
-        videos.append(video_part)  # 添加已经上传的视频
+        for video_part in parts:
+            videos.append(video_part)  # 添加已经上传的视频
         edit = False if videos.aid is None else True
         ret = self.submit(submit_api=submit_api, edit=edit, videos=videos)
-        # logger.info(f"上传成功: {ret}")
         if edit:
             logger.info(f"编辑添加成功: {ret}")
         else:
             logger.info(f"上传成功: {ret}")
         aid = ret['data']['aid']
         videos.aid = aid
-        context['sync_downloader_map'][str(self.database_row_id)] = videos.__dict__
-        logger.info(f"上传完成 {file_name} {context['sync_downloader_map'][str(self.database_row_id)] }")
-        if file_name_callback:
-            file_name_callback(self.save_path)
+        context['sync_downloader_map'][key] = videos.__dict__
+        logger.info(f"上传完成 {[part['title'] for part in parts]} {context['sync_downloader_map'][key]}")
+        return ret
+
+    def upos_init(self, ret):
+        """向上传地址申请上传，返回 upload_id"""
+        url = f"https:{ret['endpoint']}/{ret['upos_uri'].replace('upos://', '')}"
+        return self.__session.post(f'{url}?uploads&output=json', timeout=15,
+                                   headers={"X-Upos-Auth": ret['auth']}).json()["upload_id"]
+
+    def upos_abort(self, ret):
+        """取消 upos_init 申请的上传，失败时只记录日志，未合并的上传最终会在服务端过期"""
+        url = f"https:{ret['endpoint']}/{ret['upos_uri'].replace('upos://', '')}"
+        try:
+            self.__session.delete(url, params={'uploadId': ret['upload_id'], 'output': 'json'}, timeout=5,
+                                  headers={"X-Upos-Auth": ret['auth']})
+        except requests.RequestException as e:
+            logger.warning(f"{ret['name']} 取消上传 {ret['upload_id']} 失败: {e}")
 
     async def upos_stream(self, stream_queue, file_name, total_size, ret):
-        # print("--------------, ", file_name)
+        """
+        在任意事件循环中调用 upos_stream_async，分块上传始终在 runtime 的事件循环和连接池中进行
+        """
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(
+            self.upos_stream_async(stream_queue, file_name, total_size, ret), self.runtime.loop))
+
+    @property
+    def runtime(self) -> UploadRuntime:
+        """进程内共享的上传事件循环和连接池，close 时释放"""
+        if self._runtime is None:
+            self._runtime = UploadRuntime.acquire()
+        return self._runtime
+
+    def _stream_limiter(self) -> AsyncAimdLimiter:
+        # 同一场直播的所有分P共享，在事件循环中创建
+        if self.stream_concurrency is None:
+            self.stream_concurrency = AsyncAimdLimiter(self.threads, self.max_threads)
+        return self.stream_concurrency
+
+    async def upload_stream_async(
+            self,
+            stream_queue: StreamQueue,
+            file_name,
+            total_size,
+            lines='AUTO',
+            videos: 'Data' = None,
+            stop_event: threading.Event = None,
+            file_name_callback: Callable[[str], None] = None,
+            submit_api: Callable[[str], None] = None,
+            prepared: Optional[concurrent.futures.Future] = None,
+            ticket: Optional[int] = None
+    ):
+        """
+        upload_stream 的协程版本，在 runtime 的事件循环中运行
+        :return: 分P合并后已交给 submitter 投稿时为 True，申请上传或合并失败时为 False
+        """
+        logger.info(f"{file_name} 开始上传")
+        if ticket is None:
+            ticket = self.submitter.begin()
+        # 本地副本属于当前分P，相邻分P的上传时间重叠时也不会互相覆盖
+        save_file = self._open_save_file(file_name)
+        try:
+            try:
+                ret = None
+                if prepared is not None:
+                    try:
+                        ret = await asyncio.wrap_future(prepared)
+                    except Exception:
+                        logger.exception(f"{file_name} 预先申请上传失败")
+                    if ret and (ret['name'] != file_name or time.time() - ret['prepared_at'] > self.prepared_ttl):
+                        logger.info(f"{file_name} 预先申请的上传不可用，重新申请")
+                        await asyncio.to_thread(self.upos_abort, ret)
+                        ret = None
+                if ret is None:
+                    ret = await asyncio.to_thread(self.prepare_stream, file_name, total_size, lines)
+                video_part = ret and await self.upos_stream_async(stream_queue, file_name, total_size, ret, save_file)
+            except BaseException:
+                self.submitter.cancel(ticket)
+                raise
+            if not video_part:
+                self.submitter.cancel(ticket)
+                if stop_event is not None:
+                    stop_event.set()
+                return False
+            video_part['title'] = video_part['title'][:80]
+
+            await asyncio.wrap_future(self.submitter.submit(ticket, video_part, videos, submit_api))
+        finally:
+            if save_file is not None:
+                # 无论上传是否成功都等待本地副本写完，释放写入线程
+                save_file.close(wait=False)
+                await asyncio.to_thread(save_file.join)
+                logger.info(f"{save_file.path} 本地副本: {save_file.stats()}")
+        if file_name_callback:
+            if save_file is not None and not save_file.complete:
+                logger.error(f"{save_file.path} 本地副本写入出错，文件不完整")
+            else:
+                await asyncio.to_thread(file_name_callback, save_file.path if save_file is not None else '')
+        return True
+
+    async def queue_reader_async(self, stream_queue, chunk_size: int, max_size: int, assembler: ChunkAssembler,
+                                 save_file: Optional[TeeWriter] = None, idle_timeout=10):
+        """
+        从 stream_queue 中读取数据并按 chunk_size 拼接成分块产出，最后一块按实际大小产出，不做补齐
+        stream_queue 为 StreamQueue 或 DiskRing 时等待数据不占用线程，为 queue.SimpleQueue 时在线程中等待
+        读到结束标记 None、数据总量达到 max_size 或队列空闲 idle_timeout 秒后结束，
+        结束后不再读取队列，生产者通过 BiliWebAsync._put_part 发现后把后续数据交给下一个分P
+        :param save_file: 同时写入的本地副本，读取结束时关闭，由调用方等待写完
+        """
+        remaining = max_size
+        idle = 0
+        try:
+            while remaining > 0:
+                try:
+                    if hasattr(stream_queue, 'get_async'):
+                        data = await stream_queue.get_async(timeout=1)
+                    else:
+                        data = await asyncio.to_thread(stream_queue.get, timeout=1)
+                except queue.Empty:
+                    idle += 1
+                    if idle >= idle_timeout:
+                        break
+                    continue
+                idle = 0
+                if data is None:
+                    break
+                if len(data) > remaining:
+                    logger.warning(f"数据量达到上限 {max_size}，丢弃超出的 {len(data) - remaining} 字节")
+                    data = memoryview(data)[:remaining]
+                remaining -= len(data)
+                save_file and save_file.write(data)
+                for chunk in assembler.feed(data):
+                    yield chunk
+            if assembler.pending > 0:
+                logger.info(f"最后一块 {assembler.pending} 字节")
+                yield assembler.flush()
+        finally:
+            save_file and save_file.close(wait=False)
+
+    async def upos_stream_async(self, stream_queue, file_name, total_size, ret,
+                                save_file: Optional[TeeWriter] = None):
+        """
+        直播分P的分块上传，分块为共享连接池上的协程，并发数由 stream_concurrency 控制
+        只能在 runtime 的事件循环中调用，其他事件循环中使用 upos_stream
+        :param save_file: 同时写入的本地副本，见 queue_reader_async
+        """
         chunk_size = ret['chunk_size']
-        auth = ret["auth"]
         endpoint = ret["endpoint"]
-        biz_id = ret["biz_id"]
         upos_uri = ret["upos_uri"]
         url = f"https:{endpoint}/{upos_uri.replace('upos://', '')}"  # 视频上传路径
         headers = {
-            "X-Upos-Auth": auth
+            "X-Upos-Auth": ret["auth"]
         }
-        # 向上传地址申请上传，得到上传id等信息
-        upload_id = self.__session.post(f'{url}?uploads&output=json', timeout=15,
-                                        headers=headers).json()["upload_id"]
-        # 开始上传
-        parts = []  # 分块信息
-        chunks = math.ceil(total_size / chunk_size)  # 获取分块数量
-
-        start = time.perf_counter()
-
-        # print("-----------")
-        # print(upload_id, chunks, chunk_size, total_size)
+        upload_id = ret.get('upload_id') or await asyncio.to_thread(self.upos_init, ret)
+        recorder = self.scoreboard.recorder(self._auto_os['query'], endpoint) if self.scoreboard else None
+        chunks = math.ceil(total_size / chunk_size)  # 分块数量上限
+        if self.telemetry:
+            self.telemetry.emit(FileStart(file_name, total_size, chunks, self._auto_os['query'], endpoint))
         logger.info(
             f"{file_name} - upload_id: {upload_id}, chunks: {chunks}, chunk_size: {chunk_size}, total_size: {total_size}")
+        start = time.perf_counter()
+        limiter = self._stream_limiter()
+        budget = self.budget
+        assembler = ChunkAssembler(chunk_size, max_free=limiter.maximum)
         n = 0
-        st = time.perf_counter()
-        max_workers = 3
-        semaphore = threading.Semaphore(max_workers)
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            futures = []
-            for index, chunk in enumerate(self.queue_reader_generator(stream_queue, chunk_size, total_size)):
-                if not chunk:
-                    break
-                const_time = time.perf_counter() - st
-                speed = len(chunk) * 8 / 1024 / 1024 / const_time
-                logger.info(f"{file_name} - chunks-({index+1}/{chunks}) - down - speed: {speed:.2f}Mbps")
-                n += len(chunk)
-                params = {
-                    'uploadId': upload_id,
-                    'chunks': chunks,
-                    'total': total_size,
-                    'chunk': index,
-                    'size': chunk_size,
-                    'partNumber': index + 1,
-                    'start': index * chunk_size,
-                    'end': index * chunk_size + chunk_size
-                }
-                params_clone = params.copy()
-                semaphore.acquire()
-                future = executor.submit(self.upload_chunk_thread,
-                                         url, chunk, params_clone, headers, file_name)
-                future.add_done_callback(lambda x: semaphore.release())
-                futures.append(future)
-                st = time.perf_counter()
-
-                for f in list(futures):
-                    if f.done():
-                        futures.remove(f)
-
-                # 等待所有分片上传完成，并按顺序收集结果
-            for future in concurrent.futures.as_completed(futures):
-                pass
-
-            results = [{
-                "partNumber": i + 1,
-                "eTag": "etag"
-            } for i in range(chunks)]
-            parts.extend(results)
-
-        if n == 0:
-            return None
-        logger.info(f"{file_name} - total_size: {total_size}, n: {n}")
-        cost = time.perf_counter() - start
-        p = {
-            'name': file_name,
-            'uploadId': upload_id,
-            'biz_id': biz_id,
-            'output': 'json',
-            'profile': 'ugcupos/bup'
-        }
-        attempt = 1
-        while attempt <= 3:  # 一旦放弃就会丢失前面所有的进度，多试几次吧
-            try:
-                r = self.__session.post(url, params=p, json={"parts": parts}, headers=headers, timeout=15).json()
-                if r.get('OK') == 1:
-                    logger.info(f'{file_name} uploaded >> {total_size / 1000 / 1000 / cost:.2f}MB/s. {r}')
-                    return {"title": splitext(file_name)[0], "filename": splitext(basename(upos_uri))[0], "desc": ""}
-                raise IOError(r)
-            except IOError:
-                logger.info(f"请求合并分片 {file_name} 时出现问题，尝试重连，次数：" + str(attempt))
-                attempt += 1
-                time.sleep(10)
-        pass
-
-    def upload_chunk_thread(self, url, chunk, params_clone, headers, file_name, max_retries=3, backoff_factor=1):
-        st = time.perf_counter()
-        retries = 0
-        while retries < max_retries:
-            try:
-                r = requests.put(url=url, params=params_clone, data=chunk, headers=headers)
-
-                # 如果上传成功，退出重试循环
-                if r.status_code == 200:
-                    const_time = time.perf_counter() - st
-                    speed = len(chunk) * 8 / 1024 / 1024 / const_time
-                    logger.info(
-                        f"{file_name} - chunks-{params_clone['chunk'] +1 } - up status: {r.status_code} - speed: {speed:.2f}Mbps"
-                    )
-                    return {
-                        "partNumber": params_clone['chunk'] + 1,
-                        "eTag": "etag"
-                    }
+        tasks = set()
+        uploaded = set()  # 上传成功的分块
+        failed = {}  # 重试后仍失败的分块，partNumber => (暂存的分块数据, 上传参数)
 
-                # 如果上传失败，但未达到最大重试次数，等待一段时间后重试
+        async def put_chunk(session, chunk, params):
+            try:
+                if await self._put_chunk_async(session, url, chunk, params, headers, file_name, limiter, recorder):
+                    uploaded.add(params['partNumber'])
                 else:
-                    retries += 1
-                    logger.warning(
-                        f"{file_name} - chunks-{params_clone['chunk']} - up failed: {r.status_code}. Retrying {retries}/{max_retries}")
-
-                    # 计算退避时间，逐步增加重试间隔
-                    backoff_time = backoff_factor ** retries
-                    time.sleep(backoff_time)
-
-            except Exception as e:
-                retries += 1
-                logger.error(f"upload_chunk_thread err {str(e)}. Retrying {retries}/{max_retries}")
-
-                # 计算退避时间，逐步增加重试间隔
-                backoff_time = backoff_factor ** retries
-                time.sleep(backoff_time)
-
-        # 如果重试了所有次数仍然失败，记录错误
-        logger.error(f"{file_name} - chunks-{params_clone['chunk']} - Upload failed after {max_retries} attempts.")
-        return None
-
-    def queue_reader_generator(self, simple_queue: queue.SimpleQueue, chunk_size: int, max_size: int):
-        """
-        从 simple_queue 中读取数据并按 chunk_size 大小分块产出 (yield)
-        当队列中获取到 None 或者数据总量达到 max_size 后，就用 0x00 补齐到 chunk_size
-
-        :param simple_queue: queue.SimpleQueue 实例，数据流会以多个分包 (bytes) 入队，最后以 None 表示结束
-        :param chunk_size: 消费者每次想要获取的数据块大小
-        :param max_size: 需要最终补齐的总大小（单位：字节），必须是 chunk_size 的整数倍
-        :return: 生成器，按 chunk_size 大小分批次产出数据
-        """
-        if max_size % chunk_size != 0:
-            raise ValueError("max_size must be a multiple of chunk_size")
-
-        total_chunks = max_size // chunk_size
-        chunks_yielded = 0
-        current_buffer = bytearray()
-        save_file = None
-        if self.save_dir:
-            save_file = open(self.save_path, "wb")
-
-        while chunks_yielded < total_chunks:
+                    # 保留失败分块的数据，合并前重传
+                    failed[params['partNumber']] = (SpilledChunk(chunk, budget.spill_dir), params)
+            finally:
+                await limiter.release()
+                budget.release(len(chunk))
+                assembler.recycle(chunk)
+
+        async with self.runtime.session() as session:
             try:
-                data = simple_queue.get(timeout=10)
-            except queue.Empty:
-                break
-
-            if data is None:
-                # 数据流结束，用0x00填充剩余的块
-                remaining_chunks = total_chunks - chunks_yielded
-                if remaining_chunks == total_chunks:
-                    # print("空包跳过")
+                index = 0
+                async for chunk in self.queue_reader_async(stream_queue, chunk_size, total_size, assembler,
+                                                           save_file):
+                    n += len(chunk)
+                    params = {
+                        'uploadId': upload_id,
+                        'chunks': chunks,
+                        'total': total_size,
+                        'chunk': index,
+                        'size': len(chunk),
+                        'partNumber': index + 1,
+                        'start': index * chunk_size,
+                        'end': index * chunk_size + len(chunk)
+                    }
+                    # 预算或并发额度用尽时不再读取队列，数据留在 StreamQueue 中
+                    await budget.acquire_async(len(chunk))
+                    try:
+                        await limiter.acquire()
+                    except BaseException:
+                        budget.release(len(chunk))
+                        raise
+                    task = asyncio.ensure_future(put_chunk(session, chunk, params))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                    del chunk
+                    index += 1
+                if tasks:
+                    await asyncio.gather(*tasks)
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+            if n == 0:
+                return None
+            for attempt in range(1, self.repair_rounds + 1):
+                if not failed:
                     break
-                if len(current_buffer) > 0:
-                    # 处理当前缓冲区中的最后一块数据
-                    padding_size = chunk_size - len(current_buffer)
-                    if padding_size > 0:
-                        current_buffer += b'\x00' * padding_size
-                        logger.info(f"最后一个包差了 {padding_size} 个字节")
-                    yield bytes(current_buffer)
-                    chunks_yielded += 1
-                    remaining_chunks -= 1
-                break
-                logger.info(f"还差 {remaining_chunks} 个完整包")
-
-                # 输出剩余的全0块
-                for _ in range(remaining_chunks):
-                    yield b'\x00' * chunk_size
-                    chunks_yielded += 1
-                break
-
-            save_file and save_file.write(data)
-
-            # 将新数据添加到缓冲区
-            current_buffer.extend(data)
-
-            # 输出完整的块
-            while len(current_buffer) >= chunk_size and chunks_yielded < total_chunks:
-                yield bytes(current_buffer[:chunk_size])
-                current_buffer = current_buffer[chunk_size:]
-                chunks_yielded += 1
-
-        # print("本段分p完成")
-        save_file and save_file.close()
-        yield None
+                logger.warning(f"{file_name} 重传 {len(failed)} 个失败的分块，第 {attempt}/{self.repair_rounds} 轮")
+                await asyncio.sleep(5 * attempt)
+                for number in sorted(failed):
+                    chunk, params = failed[number]
+                    data = await asyncio.to_thread(lambda: chunk.reader().read())
+                    if await self._put_chunk_async(session, url, data, params, headers, file_name, limiter,
+                                                   recorder):
+                        uploaded.add(number)
+                        del failed[number]
+                        chunk.close()
+            # 只合并确认上传成功的分块
+            parts = [{"partNumber": number, "eTag": "etag"} for number in sorted(uploaded)]
+            if failed:
+                logger.error(f"{file_name} 分块 {sorted(failed)} 重传后仍然失败，只合并其余 {len(parts)} 个分块")
+                for chunk, _ in failed.values():
+                    chunk.close()
+                if not parts:
+                    return None
+            logger.info(f"{file_name} - total_size: {total_size}, n: {n}, chunks: {len(parts)}")
+            cost = time.perf_counter() - start
+            p = {
+                'name': file_name,
+                'uploadId': upload_id,
+                'biz_id': ret["biz_id"],
+                'output': 'json',
+                'profile': 'ugcupos/bup'
+            }
+            merge_start = time.perf_counter()
+            for attempt in range(1, 4):  # 一旦放弃就会丢失前面所有的进度，多试几次吧
+                try:
+                    async with session.post(url, params=p, json={"parts": parts}, headers=headers,
+                                            timeout=aiohttp.ClientTimeout(total=15)) as r:
+                        r = await r.json(content_type=None)
+                    if r.get('OK') == 1:
+                        if recorder:
+                            await recorder.merge(True)
+                        if self.telemetry:
+                            self.telemetry.emit(MergeEnd(file_name, time.perf_counter() - merge_start, True))
+                            self.telemetry.emit(FileEnd(file_name, n, time.perf_counter() - start, True))
+                        logger.info(f'{file_name} uploaded >> {n / 1000 / 1000 / cost:.2f}MB/s. {r}')
+                        return {"title": splitext(file_name)[0], "filename": splitext(basename(upos_uri))[0],
+                                "desc": ""}
+                    raise IOError(r)
+                except (IOError, ValueError, asyncio.TimeoutError, aiohttp.ClientError):
+                    logger.info(f"请求合并分片 {file_name} 时出现问题，尝试重连，次数：{attempt}")
+                    await asyncio.sleep(10)
+        if recorder:
+            await recorder.merge(False)
+        if self.telemetry:
+            self.telemetry.emit(MergeEnd(file_name, time.perf_counter() - merge_start, False))
+            self.telemetry.emit(FileEnd(file_name, n, time.perf_counter() - start, False))
+
+    async def _put_chunk_async(self, session, url, chunk, params, headers, file_name, limiter, recorder,
+                               max_retries=3):
+        telemetry = self.telemetry
+        if telemetry:
+            telemetry.emit(ChunkStart(file_name, params['partNumber'], len(chunk)))
+        for retries in range(1, max_retries + 1):
+            st = time.perf_counter()
+            try:
+                async with session.put(url, params=params, data=chunk, headers=headers,
+                                       timeout=aiohttp.ClientTimeout(total=300)) as r:
+                    await r.read()
+                if r.status == 200:
+                    const_time = time.perf_counter() - st
+                    limiter.success(len(chunk), const_time)
+                    if recorder:
+                        recorder.chunk(len(chunk), const_time)
+                    if telemetry:
+                        telemetry.emit(ChunkEnd(file_name, params['partNumber'], len(chunk), const_time))
+                    logger.info(f"{file_name} - chunks-{params['chunk'] + 1} - up status: {r.status} - "
+                                f"speed: {len(chunk) * 8 / 1024 / 1024 / const_time:.2f}Mbps")
+                    return True
+                error = str(r.status)
+            except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+                error = str(e)
+            limiter.failure()
+            if recorder:
+                recorder.error()
+            if telemetry:
+                telemetry.emit(ChunkRetry(file_name, params['partNumber'], retries, error))
+            logger.warning(f"{file_name} - chunks-{params['chunk']} - up failed: {error}. "
+                           f"Retrying {retries}/{max_retries}")
+            await asyncio.sleep(1)
+        logger.error(f"{file_name} - chunks-{params['chunk']} - Upload failed after {max_retries} attempts.")
+        return False
 
     def submit(self, submit_api=None, edit=False, videos=None):
 
@@ -661,15 +1022,17 @@ class BiliBili:
         self.__session.get('https://member.bilibili.com/x/geetest/pre/add', timeout=5)
 
         if submit_api is None:
-            total_info = self.myinfo()
-            if total_info.get('data') is None:
-                logger.error(total_info)
-            total_info = total_info.get('data')
-            if total_info['level'] > 3 and total_info['follower'] > 1000:
-                user_weight = 2
-            else:
-                user_weight = 1
-            logger.info(f'推测的用户权重: {user_weight}')
+            # 用户权重在同一场直播中只查询一次
+            if self._user_weight is None:
+                total_info = self.myinfo()
+                if total_info.get('data') is None:
+                    logger.error(total_info)
+                total_info = total_info.get('data')
+                if total_info['level'] > 3 and total_info['follower'] > 1000:
+                    self._user_weight = 2
+                else:
+                    self._user_weight = 1
+                logger.info(f'推测的用户权重: {self._user_weight}')
             # submit_api = 'web' if user_weight == 2 else 'client'
             # web 目前（2025-01-26）全量分p功能
             submit_api = 'web'
@@ -724,31 +1087,31 @@ class BiliBili:
         :param img: img path or stream
         :return: img URL
         """
-        from PIL import Image
-        from io import BytesIO
-
-        with Image.open(img) as im:
-            # 宽和高,需要16：10
-            xsize, ysize = im.size
-            if xsize / ysize > 1.6:
-                delta = xsize - ysize * 1.6
-                region = im.crop((delta / 2, 0, xsize - delta / 2, ysize))
-            else:
-                delta = ysize - xsize * 10 / 16
-                region = im.crop((0, delta / 2, xsize, ysize - delta / 2))
-            buffered = BytesIO()
-            region.save(buffered, format=im.format)
+        source = read_image(img)
+        key = CoverCache.key(source)
+        cover = None
+        if self.cover_cache:
+            url = self.cover_cache.get_url(key)
+            if url:
+                logger.info(f'使用已上传的封面: {url}')
+                return url
+            cover = self.cover_cache.get_image(key)
+        if cover is None:
+            cover = crop_cover(source)
+            if self.cover_cache:
+                self.cover_cache.put(key, image=cover)
         r = self.__session.post(
             url='https://member.bilibili.com/x/vu/web/cover/up',
             data={
-                'cover': b'data:image/jpeg;base64,' + (base64.b64encode(buffered.getvalue())),
+                'cover': b'data:image/jpeg;base64,' + (base64.b64encode(cover)),
                 'csrf': self.__bili_jct
             }, timeout=30
         )
-        buffered.close()
         res = r.json()
         if res.get('data') is None:
             raise Exception(res)
+        if self.cover_cache:
+            self.cover_cache.put(key, url=res['data']['url'])
         return res['data']['url']
 
     def get_tags(self, upvideo, typeid="", desc="", cover="", groupid=1, vfea=""):
@@ -776,6 +1139,9 @@ class BiliBili:
     def close(self):
         """Closes all adapters and as such the session"""
         self.__session.close()
+        if self._runtime is not None:
+            self._runtime.release()
+            self._runtime = None
 
 
 @dataclass
@@ -0,0 +1,656 @@
+import asyncio
+import collections
+import logging
+import mmap
+import os
+import queue
+import struct
+import tempfile
+import threading
+import time
+from typing import Iterator, List, Optional, Tuple
+
+logger = logging.getLogger('biliup')
+
+
+class SpilledChunk:
+    """暂存到临时文件的分块，上传失败等待重传时不占用内存，重传时直接从文件读取"""
+
+    def __init__(self, data, directory: Optional[str] = None):
+        self.size = len(data)
+        self.file = tempfile.TemporaryFile(dir=directory, prefix='biliup_chunk_')
+        self.file.write(data)
+
+    def __len__(self):
+        return self.size
+
+    def reader(self):
+        """每次上传前回到文件开头，可用作 requests 的 data"""
+        self.file.seek(0)
+        return self.file
+
+    def close(self):
+        self.file.close()
+
+
+class ByteBudget:
+    """
+    进程内共享的在途上传数据预算（字节）
+    直播分P的分块在上传前通过 acquire_async 申请预算，上传完成后 release；预算用尽时协程等待，
+    不再读取上传队列，使同时上传的路数增加时内存占用仍然可控。
+    单个分块大于预算时，只要没有其他在途数据也允许申请，避免永远等待
+    """
+    _shared: Optional['ByteBudget'] = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, limit=512 * 1024 * 1024, spill_dir: Optional[str] = None):
+        """
+        :param limit: 预算上限（字节）
+        :param spill_dir: 上传失败等待重传的分块暂存到临时文件的目录，默认使用系统临时目录
+        """
+        self.limit = limit
+        self.spill_dir = spill_dir
+        self.used = 0
+        self.peak = 0
+        self.waiting = 0
+        self._lock = threading.Lock()
+        self._waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []  # acquire_async 的等待者
+
+    @classmethod
+    def shared(cls) -> 'ByteBudget':
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    @classmethod
+    def configure(cls, limit: Optional[int] = None, spill_dir: Optional[str] = None):
+        """调整共享预算，已经申请的预算不受影响"""
+        budget = cls.shared()
+        with budget._lock:
+            if limit is not None:
+                budget.limit = limit
+            if spill_dir is not None:
+                budget.spill_dir = spill_dir
+            budget._notify()
+        return budget
+
+    def _available(self, n: int):
+        return self.used == 0 or self.used + n <= self.limit
+
+    async def acquire_async(self, n: int):
+        """在协程中申请预算，等待时不占用线程，由 release 唤醒；取消时不会占用预算"""
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._lock:
+                if self._available(n):
+                    self.used += n
+                    self.peak = max(self.peak, self.used)
+                    return
+                waiter = loop.create_future()
+                self._waiters.append((loop, waiter))
+                self.waiting += 1
+            try:
+                await waiter
+            finally:
+                with self._lock:
+                    self.waiting -= 1
+                    if (loop, waiter) in self._waiters:
+                        self._waiters.remove((loop, waiter))
+
+    def _notify(self):
+        for loop, waiter in self._waiters:
+            loop.call_soon_threadsafe(lambda w=waiter: w.done() or w.set_result(None))
+        self._waiters.clear()
+
+    def release(self, n: int):
+        if not n:
+            return
+        with self._lock:
+            self.used -= n
+            self._notify()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'limit': self.limit,
+                'used': self.used,
+                'peak': self.peak,
+                'waiting': self.waiting,
+            }
+
+
+class ChunkAssembler:
+    """
+    把直播流的分包拼接为固定大小的分块
+    分包直接复制到预先分配的 chunk_size 缓冲区中，填满后以 memoryview 交给上传线程，
+    上传完成后通过 recycle 归还缓冲区，后续分块复用，避免逐块切片和重新分配
+    """
+
+    def __init__(self, chunk_size: int, max_free=4):
+        """
+        :param chunk_size: 分块大小
+        :param max_free: 最多缓存的空闲缓冲区数量，在途分块较多时按需分配
+        """
+        self.chunk_size = chunk_size
+        self.max_free = max_free
+        self._free: List[bytearray] = []
+        self._lock = threading.Lock()
+        self._buffer: Optional[bytearray] = None
+        self._view: Optional[memoryview] = None
+        self._filled = 0
+
+    @property
+    def pending(self) -> int:
+        """当前缓冲区中尚未组成完整分块的字节数"""
+        return self._filled
+
+    def _take_buffer(self):
+        with self._lock:
+            buffer = self._free.pop() if self._free else bytearray(self.chunk_size)
+        self._buffer = buffer
+        self._view = memoryview(buffer)
+        self._filled = 0
+
+    def _hand_off(self, size: int) -> memoryview:
+        chunk = memoryview(self._buffer)[:size]
+        self._view.release()
+        self._buffer = self._view = None
+        self._filled = 0
+        return chunk
+
+    def feed(self, data) -> Iterator[memoryview]:
+        """写入一个分包，依次产出填满的分块"""
+        data = memoryview(data)
+        offset = 0
+        while offset < len(data):
+            if self._buffer is None:
+                self._take_buffer()
+            n = min(self.chunk_size - self._filled, len(data) - offset)
+            self._view[self._filled:self._filled + n] = data[offset:offset + n]
+            self._filled += n
+            offset += n
+            if self._filled == self.chunk_size:
+                yield self._hand_off(self.chunk_size)
+
+    def flush(self) -> Optional[memoryview]:
+        """取出最后不足 chunk_size 的分块"""
+        if not self._filled:
+            return
+        return self._hand_off(self._filled)
+
+    def recycle(self, chunk: memoryview):
+        """归还上传完成的分块，分块或缓冲区仍有其他视图时放弃复用，避免覆盖还在使用的数据"""
+        buffer = chunk.obj
+        try:
+            chunk.release()
+        except BufferError:
+            return
+        if not isinstance(buffer, bytearray) or len(buffer) != self.chunk_size:
+            return
+        try:
+            # 存在切片等其他视图时 bytearray 不能改变大小；缩小一个字节再恢复不会重新分配内存
+            del buffer[-1:]
+        except BufferError:
+            return
+        buffer.append(0)
+        with self._lock:
+            if len(self._free) < self.max_free:
+                self._free.append(buffer)
+
+
+class _BlockingQueue:
+    """StreamQueue 和 DiskRing 共用的等待逻辑，get_async 在协程中等待时不占用线程"""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []  # get_async 的等待者
+
+    def _readable(self) -> bool:
+        raise NotImplementedError
+
+    def get(self, block=True, timeout: Optional[float] = None):
+        raise NotImplementedError
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def put_nowait(self, data):
+        return self.put(data, block=False)
+
+    def _notify(self):
+        self._cond.notify_all()
+        for loop, waiter in self._waiters:
+            loop.call_soon_threadsafe(lambda w=waiter: w.done() or w.set_result(None))
+        self._waiters.clear()
+
+    async def get_async(self, timeout: Optional[float] = None):
+        """在协程中读取，超时抛出 queue.Empty"""
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            with self._cond:
+                if self._readable():
+                    return self.get(block=False)
+                waiter = loop.create_future()
+                self._waiters.append((loop, waiter))
+            try:
+                await asyncio.wait_for(waiter, None if deadline is None else max(deadline - loop.time(), 0))
+            except asyncio.TimeoutError:
+                raise queue.Empty
+            finally:
+                with self._cond:
+                    if (loop, waiter) in self._waiters:
+                        self._waiters.remove((loop, waiter))
+
+
+class StreamQueue(_BlockingQueue):
+    """
+    按字节数限制的直播流队列，接口与 queue.SimpleQueue 相同，以 None 表示结束
+    内存中的数据超过 max_bytes 时按 policy 处理新入队的分包：
+    - block: 阻塞生产者直到有空间，超时抛出 queue.Full
+    - spill: 写入临时文件，消费者读完内存中的数据后按顺序从文件读出，文件读空后回到开头复用
+    - drop: 丢弃分包并记录丢弃的字节数和位置
+    结束标记 None 不受限制；high_water 等统计值可通过 stats 获取
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, policy='spill', spill_dir: Optional[str] = None):
+        """
+        :param max_bytes: 内存中最多缓存的字节数
+        :param policy: 队列已满时的处理方式，block、spill 或 drop
+        :param spill_dir: spill 使用的临时文件目录，默认使用系统临时目录
+        """
+        if policy not in ('block', 'spill', 'drop'):
+            raise ValueError(f'unknown policy: {policy}')
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.spill_dir = spill_dir
+        self.bytes = 0
+        self.high_water = 0
+        self.spilled_bytes = 0
+        self.spill_high_water = 0
+        self.dropped_bytes = 0
+        self.dropped_packets = 0
+        self.gaps: List[Tuple[int, int]] = []  # 丢弃的数据在流中的位置 (偏移, 长度)
+        self.blocked_seconds = 0.0
+        self._offset = 0  # 已入队的字节数（不含丢弃的数据）
+        self._memory = collections.deque()
+        self._spill = collections.deque()  # 文件中每个分包的长度，None 为结束标记
+        self._spill_file = None
+        self._read_pos = 0
+        self._write_pos = 0
+        super().__init__()
+
+    def qsize(self):
+        with self._cond:
+            return len(self._memory) + len(self._spill)
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def put(self, data, block=True, timeout: Optional[float] = None):
+        with self._cond:
+            if data is None:
+                if self._spill:
+                    self._spill.append(None)
+                else:
+                    self._memory.append(None)
+                self._notify()
+                return
+            n = len(data)
+            if self._spill:
+                # 文件中还有更早的数据，继续写入文件保证顺序
+                self._write_spill(data)
+            elif self.bytes == 0 or self.bytes + n <= self.max_bytes:
+                self._push(data)
+            elif self.policy == 'spill':
+                self._write_spill(data)
+            elif self.policy == 'drop':
+                if not self.gaps or self.gaps[-1][0] != self._offset:
+                    logger.warning(f'直播流队列已满 {self.bytes}/{self.max_bytes}，开始丢弃数据')
+                    self.gaps.append((self._offset, 0))
+                offset, length = self.gaps[-1]
+                self.gaps[-1] = (offset, length + n)
+                self.dropped_bytes += n
+                self.dropped_packets += 1
+                return
+            else:
+                if not block:
+                    raise queue.Full
+                start = time.perf_counter()
+                try:
+                    if not self._cond.wait_for(lambda: self.bytes == 0 or self.bytes + n <= self.max_bytes, timeout):
+                        raise queue.Full
+                finally:
+                    self.blocked_seconds += time.perf_counter() - start
+                self._push(data)
+            self._offset += n
+            self._notify()
+
+    def _readable(self):
+        return bool(self._memory or self._spill)
+
+    def _push(self, data):
+        self._memory.append(data)
+        self.bytes += len(data)
+        self.high_water = max(self.high_water, self.bytes)
+
+    def _write_spill(self, data):
+        if self._spill_file is None:
+            self._spill_file = tempfile.TemporaryFile(dir=self.spill_dir, prefix='biliup_stream_')
+            logger.info(f'直播流队列已满 {self.bytes}/{self.max_bytes}，后续数据暂存到临时文件')
+        self._spill_file.seek(self._write_pos)
+        self._spill_file.write(data)
+        self._write_pos += len(data)
+        self._spill.append(len(data))
+        self.spilled_bytes += len(data)
+        self.spill_high_water = max(self.spill_high_water, self.spilled_bytes)
+
+    def _read_spill(self, n: int):
+        self._spill_file.seek(self._read_pos)
+        data = self._spill_file.read(n)
+        self._read_pos += n
+        self.spilled_bytes -= n
+        if self._read_pos == self._write_pos:
+            # 文件已读空，从头复用
+            self._read_pos = self._write_pos = 0
+            self._spill_file.truncate(0)
+        return data
+
+    def get(self, block=True, timeout: Optional[float] = None):
+        with self._cond:
+            if not self._cond.wait_for(self._readable, timeout if block else 0):
+                raise queue.Empty
+            if self._memory:
+                data = self._memory.popleft()
+                if data is not None:
+                    self.bytes -= len(data)
+            else:
+                n = self._spill.popleft()
+                data = None if n is None else self._read_spill(n)
+            self._cond.notify_all()
+            return data
+
+    def close(self):
+        """释放临时文件"""
+        with self._cond:
+            if self._spill_file is not None:
+                self._spill_file.close()
+                self._spill_file = None
+            self._spill.clear()
+            self._read_pos = self._write_pos = self.spilled_bytes = 0
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                'max_bytes': self.max_bytes,
+                'policy': self.policy,
+                'bytes': self.bytes,
+                'high_water': self.high_water,
+                'spilled_bytes': self.spilled_bytes,
+                'spill_high_water': self.spill_high_water,
+                'dropped_bytes': self.dropped_bytes,
+                'dropped_packets': self.dropped_packets,
+                'blocked_seconds': self.blocked_seconds,
+            }
+
+
+class DiskRing(_BlockingQueue):
+    """
+    基于内存映射文件的定长环形缓冲区，接口与 StreamQueue 相同，以 None 表示结束
+    上传中断时录制数据写入磁盘而不是内存，线路恢复后上传按原顺序全速读出；
+    读写位置保存在文件头中，进程重启后用同一路径重新打开即可继续读出未上传的数据。
+    空间用尽时阻塞生产者，超时抛出 queue.Full，不丢弃数据
+    """
+    MAGIC = b'BLRING01'
+    HEADER = struct.Struct('<8sQQQ')  # magic, capacity, read, write
+    HEADER_SIZE = 4096
+    RECORD = struct.Struct('<I')  # 分包长度
+    END = 0xFFFFFFFF  # 结束标记
+
+    def __init__(self, path: str, capacity=1024 * 1024 * 1024):
+        """
+        :param path: 缓冲文件路径，已存在时恢复其中未读出的数据，capacity 以文件中记录的为准
+        :param capacity: 缓冲区大小（字节）
+        """
+        super().__init__()
+        self.path = path
+        self.high_water = 0
+        self.blocked_seconds = 0.0
+        self._file = open(path, 'r+b' if os.path.exists(path) else 'w+b')
+        try:
+            header = self._file.read(self.HEADER.size)
+            if len(header) == self.HEADER.size and header.startswith(self.MAGIC):
+                _, capacity, self._read, self._write = self.HEADER.unpack(header)
+                if self._write > self._read:
+                    logger.info(f'{path} 恢复 {self._write - self._read} 字节未上传的数据')
+            else:
+                self._read = self._write = 0
+                self._file.truncate(self.HEADER_SIZE + capacity)
+            self.capacity = capacity
+            self._mmap = mmap.mmap(self._file.fileno(), self.HEADER_SIZE + capacity)
+        except BaseException:
+            self._file.close()
+            raise
+        self._save()
+
+    @property
+    def used(self) -> int:
+        return self._write - self._read
+
+    def _save(self):
+        self.HEADER.pack_into(self._mmap, 0, self.MAGIC, self.capacity, self._read, self._write)
+
+    def _copy_in(self, pos: int, data):
+        offset = pos % self.capacity
+        n = min(len(data), self.capacity - offset)
+        start = self.HEADER_SIZE + offset
+        self._mmap[start:start + n] = data[:n]
+        if n < len(data):
+            self._mmap[self.HEADER_SIZE:self.HEADER_SIZE + len(data) - n] = data[n:]
+
+    def _copy_out(self, pos: int, size: int) -> bytes:
+        offset = pos % self.capacity
+        n = min(size, self.capacity - offset)
+        start = self.HEADER_SIZE + offset
+        data = self._mmap[start:start + n]
+        if n < size:
+            data += self._mmap[self.HEADER_SIZE:self.HEADER_SIZE + size - n]
+        return data
+
+    def qsize(self):
+        """未读出的字节数，分包数量不保存在文件中"""
+        with self._cond:
+            return self.used
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def put(self, data, block=True, timeout: Optional[float] = None):
+        size = self.RECORD.size + (0 if data is None else len(data))
+        if size > self.capacity:
+            raise ValueError(f'packet larger than ring capacity: {size}')
+        with self._cond:
+            if self.capacity - self.used < size:
+                if not block:
+                    raise queue.Full
+                start = time.perf_counter()
+                try:
+                    if not self._cond.wait_for(lambda: self.capacity - self.used >= size, timeout):
+                        raise queue.Full
+                finally:
+                    self.blocked_seconds += time.perf_counter() - start
+            if data is None:
+                self._copy_in(self._write, self.RECORD.pack(self.END))
+            else:
+                self._copy_in(self._write, self.RECORD.pack(len(data)))
+                self._copy_in(self._write + self.RECORD.size, memoryview(data).cast('B'))
+            # 数据写入后再更新写位置，中途退出时不会读到不完整的分包
+            self._write += size
+            self.high_water = max(self.high_water, self.used)
+            self._save()
+            self._notify()
+
+    def _readable(self):
+        return self._write > self._read
+
+    def get(self, block=True, timeout: Optional[float] = None):
+        with self._cond:
+            if not self._cond.wait_for(self._readable, timeout if block else 0):
+                raise queue.Empty
+            length, = self.RECORD.unpack(self._copy_out(self._read, self.RECORD.size))
+            if length == self.END:
+                data, size = None, self.RECORD.size
+            else:
+                data, size = self._copy_out(self._read + self.RECORD.size, length), self.RECORD.size + length
+            self._read += size
+            if self._read == self._write:
+                # 读空时回到开头，减少分包跨越文件末尾
+                self._read = self._write = 0
+            self._save()
+            self._notify()
+            return data
+
+    def flush(self):
+        """把缓冲区写入磁盘"""
+        with self._cond:
+            self._mmap.flush()
+
+    def close(self, remove=False):
+        """
+        :param remove: 删除缓冲文件，数据已全部上传时使用；否则保留以便重启后恢复
+        """
+        with self._cond:
+            if self._mmap.closed:
+                return
+            if not remove:
+                self._mmap.flush()
+            self._mmap.close()
+            self._file.close()
+        if remove:
+            os.remove(self.path)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                'capacity': self.capacity,
+                'used': self.used,
+                'high_water': self.high_water,
+                'blocked_seconds': self.blocked_seconds,
+            }
+
+
+class TeeWriter:
+    """
+    直播流的本地副本写入
+    分包放入按字节数限制的队列后立即返回，由独立线程合并为 block_size 大小的块写入文件，
+    本地磁盘缓慢时不影响上传；写入跟不上导致队列超过 max_bytes 时分包暂存到 spill_dir 的临时文件，
+    不会丢弃数据；写入出错时 complete 为 False，本地副本不完整。上传缓慢时也不影响本地副本的写入
+    """
+
+    def __init__(self, path: str, block_size=4 * 1024 * 1024, max_bytes=256 * 1024 * 1024,
+                 preallocate: Optional[int] = None, spill_dir: Optional[str] = None):
+        """
+        :param path: 本地副本路径
+        :param block_size: 合并写入的块大小
+        :param max_bytes: 内存中等待写入的数据上限
+        :param preallocate: 预先为文件分配的空间（字节），写入结束后截断为实际大小
+        :param spill_dir: 超过 max_bytes 时暂存数据的临时文件目录，默认使用系统临时目录
+        """
+        self.path = path
+        self.block_size = block_size
+        self.preallocate = preallocate
+        self.written = 0
+        self.writes = 0
+        self.write_seconds = 0.0
+        self.max_write_seconds = 0.0
+        self.max_lag_bytes = 0
+        self.error: Optional[BaseException] = None
+        self.complete = False  # 所有数据都已写入文件
+        self._closed = False
+        self._queue = StreamQueue(max_bytes, 'spill', spill_dir)
+        self._thread = threading.Thread(target=self._run, daemon=True, name='tee_writer')
+        self._thread.start()
+
+    def write(self, data):
+        if self._closed:
+            raise ValueError(f'{self.path} 本地副本已结束写入')
+        self._queue.put(data)
+        self.max_lag_bytes = max(self.max_lag_bytes, self._queue.bytes + self._queue.spilled_bytes)
+
+    def close(self, wait=True, timeout: Optional[float] = None):
+        """结束写入，可以重复调用，wait 为 False 时不等待剩余数据写完"""
+        if not self._closed:
+            self._closed = True
+            self._queue.put(None)
+        if wait:
+            self.join(timeout)
+
+    def join(self, timeout: Optional[float] = None):
+        self._thread.join(timeout)
+
+    def _allocate(self, f):
+        try:
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(f.fileno(), 0, self.preallocate)
+            else:
+                f.truncate(self.preallocate)
+        except OSError as e:
+            logger.warning(f'{self.path} 预分配空间失败: {e}')
+
+    def _flush(self, f, block: bytearray):
+        start = time.perf_counter()
+        f.write(block)
+        seconds = time.perf_counter() - start
+        self.written += len(block)
+        self.writes += 1
+        self.write_seconds += seconds
+        self.max_write_seconds = max(self.max_write_seconds, seconds)
+        del block[:]
+
+    def _run(self):
+        block = bytearray()
+        finished = False
+        try:
+            with open(self.path, 'wb') as f:
+                if self.preallocate:
+                    self._allocate(f)
+                while True:
+                    try:
+                        # 队列暂时为空时先写出已合并的数据
+                        data = self._queue.get(timeout=1 if block else None)
+                    except queue.Empty:
+                        self._flush(f, block)
+                        continue
+                    if data is None:
+                        finished = True
+                        break
+                    block += data
+                    if len(block) >= self.block_size:
+                        self._flush(f, block)
+                if block:
+                    self._flush(f, block)
+                if self.preallocate:
+                    f.truncate(self.written)
+            self.complete = True
+        except OSError as e:
+            self.error = e
+            logger.exception(f'写入本地副本 {self.path} 出错')
+            # 不再写入，丢弃后续数据
+            while not finished and self._queue.get() is not None:
+                pass
+        finally:
+            self._queue.close()
+        logger.debug(f'{self.path} 本地副本写入完成: {self.stats()}')
+
+    def stats(self) -> dict:
+        return {
+            'written': self.written,
+            'writes': self.writes,
+            'lag_bytes': self._queue.bytes + self._queue.spilled_bytes,
+            'max_lag_bytes': self.max_lag_bytes,
+            'spill_high_water': self._queue.spill_high_water,
+            'write_seconds': self.write_seconds,
+            'max_write_seconds': self.max_write_seconds,
+            'complete': self.complete,
+        }
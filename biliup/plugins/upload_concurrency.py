@@ -0,0 +1,120 @@
+import asyncio
+import logging
+import math
+import statistics
+import threading
+import time
+from collections import deque
+from typing import Optional
+
+logger = logging.getLogger('biliup')
+
+
+class AimdConcurrency:
+    """
+    分块并发数自适应调整（加性增、乘性减）
+    每完成 limit 个分块统计一次吞吐量，吞吐量上升时并发数加一，明显下降时减一；
+    出现超时、5xx 等失败时并发数减半，并发数始终在 [minimum, maximum] 之间
+    """
+
+    def __init__(self, initial=3, maximum=16, minimum=1):
+        self.maximum = max(maximum, 1)
+        self.minimum = min(max(minimum, 1), self.maximum)
+        self.limit = min(max(initial, self.minimum), self.maximum)
+        self.latency = 0.0  # 分块耗时的指数加权平均（秒）
+        self._lock = threading.Lock()
+        self._reset_window()
+        self._last_throughput = 0.0
+        self._last_decrease = 0.0
+
+    def _reset_window(self):
+        self._window_bytes = 0
+        self._window_chunks = 0
+        self._window_start = time.perf_counter()
+
+    def _set_limit(self, limit, reason):
+        limit = min(max(limit, self.minimum), self.maximum)
+        if limit != self.limit:
+            logger.info(f"分块并发数 {self.limit} => {limit} ({reason})")
+            self.limit = limit
+
+    def success(self, size: int, seconds: float):
+        with self._lock:
+            self.latency = seconds if not self.latency else self.latency + 0.2 * (seconds - self.latency)
+            self._window_bytes += size
+            self._window_chunks += 1
+            if self._window_chunks < self.limit:
+                return
+            throughput = self._window_bytes / max(time.perf_counter() - self._window_start, 1e-6)
+            if throughput > self._last_throughput * 1.05:
+                self._set_limit(self.limit + 1, f"{throughput / 1000 / 1000:.2f}MB/s")
+            elif throughput < self._last_throughput * 0.9:
+                self._set_limit(self.limit - 1, f"{throughput / 1000 / 1000:.2f}MB/s")
+            self._last_throughput = throughput
+            self._reset_window()
+
+    def failure(self):
+        with self._lock:
+            now = time.perf_counter()
+            # 同一批在途分块的失败只减半一次
+            if now - self._last_decrease < max(self.latency, 1.0):
+                return
+            self._last_decrease = now
+            self._set_limit(math.ceil(self.limit / 2), 'failure')
+            self._last_throughput = 0.0
+            self._reset_window()
+
+
+class AsyncAimdLimiter(AimdConcurrency):
+    """供协程使用的自适应并发限制"""
+
+    def __init__(self, initial=3, maximum=16, minimum=1):
+        super().__init__(initial, maximum, minimum)
+        self.in_flight = 0
+        self._cond = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+
+    async def release(self):
+        async with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, e_t, e_v, t_b):
+        await self.release()
+
+
+class HedgePolicy:
+    """
+    慢分块重发策略
+    记录最近成功分块的耗时，分块耗时超过中位数的 factor 倍时视为慢分块，
+    由上传协程在另一个连接或 endpoint 上重发同一分块，取先完成的结果
+    """
+
+    def __init__(self, factor: Optional[float] = 3.0, min_samples=5, min_delay=1.0, window=64):
+        """
+        :param factor: 超过耗时中位数的倍数后重发，为 None 时不重发
+        :param min_samples: 至少有这么多个分块耗时后才开始重发
+        :param min_delay: 重发前至少等待的时间（秒），避免分块很快时频繁重发
+        :param window: 计算中位数时使用的最近分块数
+        """
+        self.factor = factor
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self._samples = deque(maxlen=window)
+
+    def record(self, seconds: float):
+        self._samples.append(seconds)
+
+    def delay(self) -> Optional[float]:
+        """分块开始后多久仍未完成就重发，样本不足或不重发时返回 None"""
+        if self.factor is None or len(self._samples) < self.min_samples:
+            return
+        return max(self.factor * statistics.median(self._samples), self.min_delay)
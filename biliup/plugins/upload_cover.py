@@ -0,0 +1,157 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from io import BytesIO
+from json import JSONDecodeError
+from typing import Dict, Optional
+
+logger = logging.getLogger('biliup')
+
+COVER_RATIO = 1.6  # 封面宽高比 16:10
+
+
+def read_image(img) -> bytes:
+    """读取封面原图，img 可以是路径或文件对象"""
+    if hasattr(img, 'read'):
+        return img.read()
+    with open(img, 'rb') as f:
+        return f.read()
+
+
+def crop_cover(data: bytes, ratio=COVER_RATIO) -> bytes:
+    """将封面居中裁剪为 ratio 宽高比，返回原格式编码后的图片"""
+    from PIL import Image
+
+    with Image.open(BytesIO(data)) as im:
+        xsize, ysize = im.size
+        if xsize / ysize > ratio:
+            delta = xsize - ysize * ratio
+            region = im.crop((delta / 2, 0, xsize - delta / 2, ysize))
+        else:
+            delta = ysize - xsize / ratio
+            region = im.crop((0, delta / 2, xsize, ysize - delta / 2))
+        with BytesIO() as buffered:
+            region.save(buffered, format=im.format)
+            return buffered.getvalue()
+
+
+class CoverCache:
+    """
+    封面缓存
+    以原图内容哈希和裁剪参数为键，在磁盘上保存裁剪后的图片和上传后返回的封面地址，
+    同一封面再次投稿时跳过裁剪和上传；条目超过 ttl 或数量超过 max_entries 时按最近使用时间淘汰
+    """
+    _instances: Dict[str, 'CoverCache'] = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, directory: str, ttl=30 * 86400, max_entries=256):
+        """
+        :param directory: 缓存目录
+        :param ttl: 条目有效期（秒）
+        :param max_entries: 最多保留的封面数
+        """
+        self.directory = directory
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._index_path = os.path.join(directory, 'index.json')
+        self._entries = self._load()
+
+    @classmethod
+    def open(cls, directory: str) -> 'CoverCache':
+        directory = os.path.abspath(directory)
+        with cls._instances_lock:
+            if directory not in cls._instances:
+                cls._instances[directory] = cls(directory)
+            return cls._instances[directory]
+
+    @staticmethod
+    def key(data: bytes, ratio=COVER_RATIO) -> str:
+        return hashlib.sha256(data + f'|{ratio}'.encode()).hexdigest()
+
+    def _load(self):
+        try:
+            with open(self._index_path, encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (JSONDecodeError, OSError):
+            logger.exception('加载封面缓存出错')
+            return {}
+
+    def _dump(self):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = f'{self._index_path}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self._entries, f)
+        os.replace(tmp, self._index_path)
+
+    def _image_path(self, key: str):
+        return os.path.join(self.directory, key)
+
+    def _get(self, key: str) -> Optional[dict]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return
+        if time.time() - entry['updated'] > self.ttl:
+            self._remove(key)
+            self._dump()
+            return
+        entry['accessed'] = time.time()
+        return entry
+
+    def _remove(self, key: str):
+        self._entries.pop(key, None)
+        try:
+            os.remove(self._image_path(key))
+        except FileNotFoundError:
+            pass
+
+    def get_url(self, key: str) -> Optional[str]:
+        """已上传过的封面地址"""
+        with self._lock:
+            entry = self._get(key)
+            return entry and entry.get('url')
+
+    def get_image(self, key: str) -> Optional[bytes]:
+        """已裁剪好的封面图片"""
+        with self._lock:
+            if self._get(key) is None:
+                return
+            try:
+                with open(self._image_path(key), 'rb') as f:
+                    return f.read()
+            except OSError:
+                self._remove(key)
+                return
+
+    def put(self, key: str, image: Optional[bytes] = None, url: Optional[str] = None):
+        """保存裁剪后的图片或上传后的封面地址"""
+        with self._lock:
+            now = time.time()
+            entry = self._entries.setdefault(key, {'url': None, 'updated': now})
+            entry['accessed'] = now
+            if image is not None:
+                os.makedirs(self.directory, exist_ok=True)
+                tmp = f'{self._image_path(key)}.tmp'
+                with open(tmp, 'wb') as f:
+                    f.write(image)
+                os.replace(tmp, self._image_path(key))
+                entry['updated'] = now
+            if url is not None:
+                entry['url'] = url
+                entry['updated'] = now
+            self._evict()
+            self._dump()
+
+    def _evict(self):
+        now = time.time()
+        for key in [key for key, entry in self._entries.items() if now - entry['updated'] > self.ttl]:
+            self._remove(key)
+        if len(self._entries) > self.max_entries:
+            lru = sorted(self._entries, key=lambda k: self._entries[k]['accessed'])
+            for key in lru[:len(self._entries) - self.max_entries]:
+                self._remove(key)
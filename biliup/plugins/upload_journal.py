@@ -0,0 +1,127 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from json import JSONDecodeError
+from typing import Dict, Optional
+
+logger = logging.getLogger('biliup')
+
+
+class UploadJournal:
+    """
+    UPOS 上传断点记录
+    以文件路径、大小和修改时间标识同一个文件，保存 preupload 结果、upload_id 以及已完成的分块编号，
+    进程崩溃或合并失败后重新上传同一文件时，只补传缺失的分块再请求合并
+    分块完成只更新内存，攒够 flush_parts 个分块或距上次落盘超过 flush_interval 秒才写文件，
+    写文件在线程中进行，不阻塞事件循环；崩溃时最多丢失最近未落盘的分块，续传时重传即可
+    """
+    _instances: Dict[str, 'UploadJournal'] = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, path: str, ttl: int = 86400, flush_parts: int = 64, flush_interval: float = 5):
+        """
+        :param path: 记录文件路径
+        :param ttl: 记录有效期（秒），超过后 upload_id 和 auth 视为失效
+        :param flush_parts: 累计多少个分块完成后落盘
+        :param flush_interval: 距上次落盘超过多少秒后落盘
+        """
+        self.path = path
+        self.ttl = ttl
+        self.flush_parts = flush_parts
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        # 保证落盘顺序，后取的快照不会被先取的快照覆盖
+        self._dump_lock = threading.Lock()
+        self._entries = self._load()
+        self._pending = 0
+        self._flushed = time.monotonic()
+
+    @classmethod
+    def open(cls, path: str) -> 'UploadJournal':
+        """同一记录文件在进程内只保留一个实例，避免多个上传互相覆盖"""
+        path = os.path.abspath(path)
+        with cls._instances_lock:
+            if path not in cls._instances:
+                cls._instances[path] = cls(path)
+            return cls._instances[path]
+
+    @staticmethod
+    def key(filepath: str) -> str:
+        stat = os.stat(filepath)
+        return f'{os.path.abspath(filepath)}:{stat.st_size}:{stat.st_mtime_ns}'
+
+    def _load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (JSONDecodeError, OSError):
+            logger.exception('加载上传记录出错')
+            return {}
+        now = time.time()
+        entries = {key: entry for key, entry in entries.items() if now - entry['updated'] < self.ttl}
+        for entry in entries.values():
+            entry['parts'] = set(entry['parts'])
+        return entries
+
+    def _dump(self):
+        with self._dump_lock:
+            with self._lock:
+                if not self._pending:
+                    return
+                data = json.dumps({key: {**entry, 'parts': sorted(entry['parts'])}
+                                   for key, entry in self._entries.items()})
+                self._pending = 0
+                self._flushed = time.monotonic()
+            tmp = f'{self.path}.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                f.write(data)
+            os.replace(tmp, self.path)
+
+    def _due(self) -> bool:
+        with self._lock:
+            return self._pending >= self.flush_parts or (
+                    self._pending and time.monotonic() - self._flushed >= self.flush_interval)
+
+    async def save(self, force: bool = True):
+        """
+        在线程中把内存中的记录写入文件
+        :param force: 为 False 时只在攒够分块或超过落盘间隔时写入
+        """
+        if force or self._due():
+            await asyncio.to_thread(self._dump)
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and time.time() - entry['updated'] < self.ttl:
+                return entry
+
+    def begin(self, key: str, ret: dict, upload_id: str):
+        with self._lock:
+            self._entries[key] = {
+                'ret': ret,
+                'upload_id': upload_id,
+                'parts': set(),
+                'updated': time.time(),
+            }
+            self._pending += 1
+
+    def complete_part(self, key: str, part_number: int):
+        with self._lock:
+            entry = self._entries.get(key)
+            # 重发的慢分块可能两次都上传成功
+            if entry is None or part_number in entry['parts']:
+                return
+            entry['parts'].add(part_number)
+            entry['updated'] = time.time()
+            self._pending += 1
+
+    def finish(self, key: str):
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self._pending += 1
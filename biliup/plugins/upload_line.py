@@ -0,0 +1,199 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from json import JSONDecodeError
+from typing import Dict, List, NamedTuple, Optional
+
+import requests
+
+logger = logging.getLogger('biliup')
+
+
+def probe_lines(session: requests.Session, ret: dict, timeout=30, fast_enough: Optional[float] = None):
+    """
+    并发测试 preupload?r=probe 返回的所有线路，返回耗时最短的可用线路
+    响应异常或非200的线路直接跳过，不影响其他线路的选择
+    :param session: 发起测速请求的会话
+    :param ret: preupload?r=probe 的返回值
+    :param timeout: 单条线路的超时时间
+    :param fast_enough: 出现耗时不超过该值（秒）的线路时立即选用，不再等待其余线路
+    :return: 选中的线路，cost 为其耗时；没有可用线路时返回 None
+    """
+    data = None
+    if ret['probe'].get('get'):
+        method = 'get'
+    else:
+        method = 'post'
+        data = bytes(int(1024 * 0.1 * 1024))
+
+    def probe(line):
+        start = time.perf_counter()
+        test = session.request(method, f"https:{line['probe_url']}", data=data, timeout=timeout)
+        return test.status_code, time.perf_counter() - start
+
+    auto_os, min_cost = None, 0
+    executor = ThreadPoolExecutor(max_workers=max(len(ret['lines']), 1), thread_name_prefix='probe')
+    try:
+        futures = {executor.submit(probe, line): line for line in ret['lines']}
+        for future in as_completed(futures):
+            line = futures[future]
+            try:
+                status_code, cost = future.result()
+            except requests.RequestException as e:
+                logger.warning(f"线路 {line['query']} 测速失败: {e}")
+                continue
+            logger.info(f"{line['query']} {cost}")
+            if status_code != 200:
+                logger.warning(f"线路 {line['query']} 测速返回 {status_code}，跳过")
+                continue
+            if not auto_os or min_cost > cost:
+                auto_os = line
+                min_cost = cost
+            if fast_enough is not None and cost <= fast_enough:
+                break
+    finally:
+        # 提前选定时不再等待仍在测速的线路
+        executor.shutdown(wait=False, cancel_futures=True)
+    if auto_os is None:
+        logger.error(f"没有可用的上传线路: {ret['lines']}")
+        return
+    auto_os['cost'] = min_cost
+    return auto_os
+
+
+class LineScoreboard:
+    """
+    上传线路质量记录
+    按线路和 endpoint 记录真实上传中的分块吞吐量(MB/s)、分块失败率和合并失败率（指数加权平均），
+    AUTO 线路优先根据历史记录选择，只有在没有记录时才退回小包测速
+    记录只更新内存，每个文件合并后在线程中落盘，不阻塞事件循环
+    """
+    _instances: Dict[str, 'LineScoreboard'] = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, path: str, alpha=0.2, explore=0.1, ttl=7 * 86400):
+        """
+        :param path: 记录文件路径
+        :param alpha: 指数加权平均中新样本的权重
+        :param explore: 随机尝试其他线路的概率，避免一直停留在旧的最优线路
+        :param ttl: 记录有效期（秒），过期的线路视为没有记录
+        """
+        self.path = path
+        self.alpha = alpha
+        self.explore = explore
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # 保证落盘顺序，后取的快照不会被先取的快照覆盖
+        self._dump_lock = threading.Lock()
+        self._lines = self._load()
+
+    @classmethod
+    def open(cls, path: str) -> 'LineScoreboard':
+        path = os.path.abspath(path)
+        with cls._instances_lock:
+            if path not in cls._instances:
+                cls._instances[path] = cls(path)
+            return cls._instances[path]
+
+    def _load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (JSONDecodeError, OSError):
+            logger.exception('加载线路记录出错')
+            return {}
+
+    def _dump(self):
+        with self._dump_lock:
+            with self._lock:
+                data = json.dumps(self._lines)
+            tmp = f'{self.path}.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                f.write(data)
+            os.replace(tmp, self.path)
+
+    async def save(self):
+        """在线程中把内存中的记录写入文件，写入失败不影响上传结果"""
+        try:
+            await asyncio.to_thread(self._dump)
+        except OSError:
+            logger.exception('保存线路记录出错')
+
+    def _update(self, stats: dict, key: str, value: float):
+        if key in stats:
+            stats[key] += self.alpha * (value - stats[key])
+        else:
+            stats[key] = value
+
+    def _record(self, query: str, endpoint: str, key: str, value: float):
+        with self._lock:
+            line = self._lines.setdefault(query, {'endpoints': {}})
+            for stats in (line, line['endpoints'].setdefault(endpoint, {})):
+                self._update(stats, key, value)
+                if key == 'mbps':
+                    stats['samples'] = stats.get('samples', 0) + 1
+                stats['updated'] = time.time()
+
+    def record_chunk(self, query: str, endpoint: str, size: int, seconds: float):
+        self._record(query, endpoint, 'mbps', size / 1000 / 1000 / max(seconds, 1e-6))
+        self._record(query, endpoint, 'error_rate', 0)
+
+    def record_error(self, query: str, endpoint: str):
+        self._record(query, endpoint, 'error_rate', 1)
+
+    def record_merge(self, query: str, endpoint: str, ok: bool):
+        self._record(query, endpoint, 'merge_failure_rate', 0 if ok else 1)
+
+    def score(self, query: str) -> Optional[float]:
+        """线路得分，约等于扣除失败后的有效吞吐量；没有记录时返回 None"""
+        with self._lock:
+            stats = self._lines.get(query)
+            if not stats or 'mbps' not in stats or time.time() - stats['updated'] > self.ttl:
+                return
+            return (stats['mbps'] * (1 - stats.get('error_rate', 0))
+                    * (1 - stats.get('merge_failure_rate', 0)))
+
+    def choose(self, lines: List[dict]) -> Optional[dict]:
+        """
+        从 preupload?r=probe 返回的线路中选择得分最高的线路，并以 explore 的概率随机尝试其他线路
+        :return: 选中的线路；所有线路都没有记录时返回 None
+        """
+        scored = [(self.score(line['query']), line) for line in lines]
+        known = [(score, line) for score, line in scored if score is not None]
+        if not known:
+            return
+        if random.random() < self.explore:
+            line = random.choice(lines)
+            logger.info(f"线路记录: 随机尝试 {line['query']}")
+            return line
+        score, line = max(known, key=lambda x: x[0])
+        logger.info(f"线路记录: {line['query']} 有效吞吐 {score:.2f}MB/s")
+        return {**line, 'mbps': score}
+
+    def recorder(self, query: str, endpoint: str) -> 'LineRecorder':
+        return LineRecorder(self, query, endpoint)
+
+
+class LineRecorder(NamedTuple):
+    """绑定到某条线路和 endpoint 的记录器，供上传过程逐块记录"""
+    scoreboard: LineScoreboard
+    query: str
+    endpoint: str
+
+    def chunk(self, size: int, seconds: float):
+        self.scoreboard.record_chunk(self.query, self.endpoint, size, seconds)
+
+    def error(self):
+        self.scoreboard.record_error(self.query, self.endpoint)
+
+    async def merge(self, ok: bool):
+        """记录合并结果，并在线程中落盘"""
+        self.scoreboard.record_merge(self.query, self.endpoint, ok)
+        await self.scoreboard.save()
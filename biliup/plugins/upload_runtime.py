@@ -0,0 +1,95 @@
+import asyncio
+import atexit
+import logging
+import threading
+from typing import Optional
+
+import aiohttp
+
+logger = logging.getLogger('biliup')
+
+
+class UploadRuntime:
+    """
+    进程内共享的上传事件循环和连接池
+    事件循环运行在独立的守护线程中，所有 BiliBili 实例的上传协程都提交到这个循环，
+    复用同一个带 keep-alive 和 DNS 缓存的 TCPConnector，
+    不再为每个文件重新创建事件循环、解析域名和进行 TLS 握手
+    """
+    _instance: Optional['UploadRuntime'] = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, linger=60):
+        """
+        :param linger: 最后一个使用者释放后连接池继续保留的时间（秒），便于紧接着的下一个稿件复用连接
+        """
+        self.linger = linger
+        self.loop = asyncio.new_event_loop()
+        self._connector: Optional[aiohttp.TCPConnector] = None
+        self._refs = 0
+        self._linger_handle: Optional[asyncio.TimerHandle] = None
+        self._thread = threading.Thread(target=self.loop.run_forever, daemon=True, name='upload_runtime')
+        self._thread.start()
+
+    @classmethod
+    def acquire(cls) -> 'UploadRuntime':
+        """获取共享的上传运行时，使用完毕后需调用 release"""
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+                atexit.register(cls._instance.shutdown)
+            runtime = cls._instance
+            runtime._refs += 1
+            runtime.loop.call_soon_threadsafe(runtime._cancel_linger)
+            return runtime
+
+    def release(self):
+        with self._instance_lock:
+            self._refs -= 1
+            if self._refs == 0:
+                self.loop.call_soon_threadsafe(self._schedule_linger)
+
+    def run(self, coro):
+        """在共享事件循环中运行协程并阻塞等待结果，可在除事件循环线程外的任意线程调用"""
+        if threading.current_thread() is self._thread:
+            raise RuntimeError('UploadRuntime.run cannot be called from the upload event loop')
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    @property
+    def connector(self) -> aiohttp.TCPConnector:
+        """共享连接池，只能在事件循环中访问"""
+        if self._connector is None or self._connector.closed:
+            self._connector = aiohttp.TCPConnector(ttl_dns_cache=300, keepalive_timeout=60)
+        return self._connector
+
+    def session(self, **kwargs) -> aiohttp.ClientSession:
+        """基于共享连接池创建会话，关闭会话不会关闭连接池"""
+        return aiohttp.ClientSession(connector=self.connector, connector_owner=False, **kwargs)
+
+    def _cancel_linger(self):
+        if self._linger_handle is not None:
+            self._linger_handle.cancel()
+            self._linger_handle = None
+
+    def _schedule_linger(self):
+        self._cancel_linger()
+        self._linger_handle = self.loop.call_later(
+            self.linger, lambda: self.loop.create_task(self._close_connector()))
+
+    async def _close_connector(self):
+        self._linger_handle = None
+        if self._connector is not None:
+            logger.debug('关闭上传连接池')
+            await self._connector.close()
+            self._connector = None
+
+    def shutdown(self):
+        """关闭连接池并停止事件循环"""
+        if not self.loop.is_running():
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self._close_connector(), self.loop).result(timeout=5)
+        except Exception:
+            logger.exception('关闭上传连接池出错')
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
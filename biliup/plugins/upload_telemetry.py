@@ -0,0 +1,215 @@
+import bisect
+import logging
+import sys
+import threading
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+logger = logging.getLogger('biliup')
+
+
+class LineChosen(NamedTuple):
+    """选定上传线路"""
+    os: str
+    query: str
+    cost: Optional[float]
+
+
+class FileStart(NamedTuple):
+    """开始上传文件"""
+    file: str
+    size: int
+    chunks: int
+    query: str
+    endpoint: str
+
+
+class ChunkStart(NamedTuple):
+    file: str
+    part: int
+    size: int
+
+
+class ChunkEnd(NamedTuple):
+    """分块上传成功，seconds 为最后一次尝试的耗时，包含慢分块重发的等待"""
+    file: str
+    part: int
+    size: int
+    seconds: float
+
+
+class ChunkRetry(NamedTuple):
+    file: str
+    part: int
+    attempt: int
+    error: str
+
+
+class ChunkHedged(NamedTuple):
+    """慢分块重发，url 为空时在原地址的新连接上重发"""
+    file: str
+    part: int
+    delay: float
+    url: Optional[str]
+
+
+class MergeEnd(NamedTuple):
+    file: str
+    seconds: float
+    ok: bool
+
+
+class FileEnd(NamedTuple):
+    file: str
+    size: int
+    seconds: float
+    ok: bool
+
+
+class UploadTelemetry:
+    """
+    上传事件分发
+    上传过程中产生的事件依次交给订阅的回调，回调抛出的异常不会影响上传；
+    没有订阅者时实例为假值，调用方应先判断再构造事件，避免在分块热路径上产生额外开销
+    """
+
+    def __init__(self, *listeners: Callable[[NamedTuple], None]):
+        self._listeners: List[Callable[[NamedTuple], None]] = list(listeners)
+
+    def subscribe(self, listener: Callable[[NamedTuple], None]):
+        self._listeners.append(listener)
+        return listener
+
+    def unsubscribe(self, listener: Callable[[NamedTuple], None]):
+        self._listeners.remove(listener)
+
+    def __bool__(self):
+        return bool(self._listeners)
+
+    def emit(self, event: NamedTuple):
+        for listener in self._listeners:
+            try:
+                listener(event)
+            except Exception:
+                logger.exception(f'上传事件回调出错: {event}')
+
+
+class ProgressPrinter:
+    """在终端同一行输出各文件的上传速度和进度"""
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        self._files: Dict[str, list] = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, event: NamedTuple):
+        if isinstance(event, FileStart):
+            with self._lock:
+                self._files[event.file] = [event.size, 0, time.perf_counter()]
+        elif isinstance(event, ChunkEnd):
+            with self._lock:
+                progress = self._files.get(event.file)
+                if progress is None:
+                    return
+                progress[1] += event.size
+                size, done, start = progress
+            self.stream.write(f"\r{done / 1000 / 1000 / max(time.perf_counter() - start, 1e-6):.2f}MB/s "
+                              f"=> {done / max(size, 1):.1%}")
+        elif isinstance(event, FileEnd):
+            with self._lock:
+                self._files.pop(event.file, None)
+
+
+class TelemetryAggregator:
+    """
+    上传事件统计
+    汇总分块耗时直方图、重试和重发次数、合并耗时，以及按文件和线路统计的吞吐量，
+    可订阅到多个 BiliBili 实例上统计整个进程的上传情况
+    """
+    # 分块耗时直方图的桶上界（秒），最后一个桶收集超过 60 秒的分块
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, float('inf'))
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histogram = [0] * len(self.BUCKETS)
+        self.chunks = 0
+        self.bytes = 0
+        self.retries = 0
+        self.hedged = 0
+        self.merges = 0
+        self.merge_failures = 0
+        self.merge_seconds = 0.0
+        self.files: Dict[str, dict] = {}
+        self.lines: Dict[str, dict] = {}
+        self._file_lines: Dict[str, str] = {}
+
+    def __call__(self, event: NamedTuple):
+        with self._lock:
+            if isinstance(event, ChunkEnd):
+                self.histogram[bisect.bisect_left(self.BUCKETS, event.seconds)] += 1
+                self.chunks += 1
+                self.bytes += event.size
+            elif isinstance(event, ChunkRetry):
+                self.retries += 1
+            elif isinstance(event, ChunkHedged):
+                self.hedged += 1
+            elif isinstance(event, FileStart):
+                self._file_lines[event.file] = event.query
+            elif isinstance(event, MergeEnd):
+                self.merges += 1
+                self.merge_failures += not event.ok
+                self.merge_seconds += event.seconds
+            elif isinstance(event, FileEnd):
+                query = self._file_lines.pop(event.file, '')
+                self.files[event.file] = {
+                    'line': query,
+                    'size': event.size,
+                    'seconds': event.seconds,
+                    'mbps': event.size / 1000 / 1000 / max(event.seconds, 1e-6),
+                    'ok': event.ok,
+                }
+                line = self.lines.setdefault(query, {'files': 0, 'failures': 0, 'bytes': 0, 'seconds': 0.0})
+                line['files'] += 1
+                line['failures'] += not event.ok
+                if event.ok:
+                    line['bytes'] += event.size
+                    line['seconds'] += event.seconds
+
+    def percentile(self, q: float) -> Optional[float]:
+        """按直方图估算分块耗时的分位数，返回所在桶的上界"""
+        with self._lock:
+            total = sum(self.histogram)
+            if not total:
+                return
+            rank = q * total
+            count = 0
+            for bound, n in zip(self.BUCKETS, self.histogram):
+                count += n
+                if count >= rank:
+                    return bound
+
+    def summary(self) -> dict:
+        p50, p90, p99 = self.percentile(0.5), self.percentile(0.9), self.percentile(0.99)
+        with self._lock:
+            return {
+                'chunks': self.chunks,
+                'bytes': self.bytes,
+                'retries': self.retries,
+                'hedged': self.hedged,
+                'latency': {
+                    'p50': p50,
+                    'p90': p90,
+                    'p99': p99,
+                    'histogram': {f'<={bound}s' if bound != float('inf') else f'>{self.BUCKETS[-2]}s': n
+                                  for bound, n in zip(self.BUCKETS, self.histogram)},
+                },
+                'merge': {
+                    'count': self.merges,
+                    'failures': self.merge_failures,
+                    'avg_seconds': self.merge_seconds / self.merges if self.merges else None,
+                },
+                'files': dict(self.files),
+                'lines': {query: {**line, 'mbps': line['bytes'] / 1000 / 1000 / line['seconds']
+                                  if line['seconds'] else None}
+                          for query, line in self.lines.items()},
+            }
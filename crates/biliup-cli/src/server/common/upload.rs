@@ -369,24 +369,7 @@ pub async fn upload(
 
     let client = StatelessClient::default();
     let mut videos = Vec::new();
-    let line = match line {
-        Some(UploadLine::Bldsa) => line::bldsa(),
-        Some(UploadLine::Cnbldsa) => line::cnbldsa(),
-        Some(UploadLine::Andsa) => line::andsa(),
-        Some(UploadLine::Atdsa) => line::atdsa(),
-        Some(UploadLine::Bda2) => line::bda2(),
-        Some(UploadLine::Cnbd) => line::cnbd(),
-        Some(UploadLine::Anbd) => line::anbd(),
-        Some(UploadLine::Atbd) => line::atbd(),
-        Some(UploadLine::Tx) => line::tx(),
-        Some(UploadLine::Cntx) => line::cntx(),
-        Some(UploadLine::Antx) => line::antx(),
-        Some(UploadLine::Attx) => line::attx(),
-        // Some(UploadLine::Bda) => line::bda(),
-        Some(UploadLine::Txa) => line::txa(),
-        Some(UploadLine::Alia) => line::alia(),
-        _ => Probe::probe(&client.client).await.unwrap_or_default(),
-    };
+    let line = choose_line(line, &client).await;
     for video_path in video_paths {
         println!(
             "{:?}",
@@ -428,6 +411,28 @@ pub async fn upload(
     Ok((bilibili, videos))
 }
 
+/// 按配置选择上传线路，未指定时测速选择
+pub async fn choose_line(line: Option<UploadLine>, client: &StatelessClient) -> Line {
+    match line {
+        Some(UploadLine::Bldsa) => line::bldsa(),
+        Some(UploadLine::Cnbldsa) => line::cnbldsa(),
+        Some(UploadLine::Andsa) => line::andsa(),
+        Some(UploadLine::Atdsa) => line::atdsa(),
+        Some(UploadLine::Bda2) => line::bda2(),
+        Some(UploadLine::Cnbd) => line::cnbd(),
+        Some(UploadLine::Anbd) => line::anbd(),
+        Some(UploadLine::Atbd) => line::atbd(),
+        Some(UploadLine::Tx) => line::tx(),
+        Some(UploadLine::Cntx) => line::cntx(),
+        Some(UploadLine::Antx) => line::antx(),
+        Some(UploadLine::Attx) => line::attx(),
+        // Some(UploadLine::Bda) => line::bda(),
+        Some(UploadLine::Txa) => line::txa(),
+        Some(UploadLine::Alia) => line::alia(),
+        _ => Probe::probe(&client.client).await.unwrap_or_default(),
+    }
+}
+
 #[cfg(test)]
 mod tests {
     use super::*;
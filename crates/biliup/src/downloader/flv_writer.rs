@@ -11,7 +11,7 @@ use std::io::{BufWriter, Write};
 
 use tracing::info;
 
-const FLV_HEADER: [u8; 9] = [
+pub const FLV_HEADER: [u8; 9] = [
     0x46, // 'F'
     0x4c, //'L'
     0x56, //'V'
@@ -20,6 +20,47 @@ const FLV_HEADER: [u8; 9] = [
     0x00, 0x00, 0x00, 0x09, //flv header size
 ]; // 9
 
+/// parse_flv_into 的输出，按 tag 写入数据，在关键帧处切换到新的分段
+pub trait FlvOutput {
+    fn write_tag(
+        &mut self,
+        tag_header: &TagHeader,
+        body: &[u8],
+        previous_tag_size: &[u8],
+    ) -> std::io::Result<usize>;
+
+    /// 结束当前分段并开始新的分段，新分段以 FLV 头开始
+    fn create_new(&mut self) -> std::io::Result<()>;
+
+    fn file_name(&self) -> &str;
+}
+
+/// 写入 FLV 头和第一个 PreviousTagSize
+pub fn write_header(writer: &mut impl Write) -> std::io::Result<()> {
+    writer.write_all(&FLV_HEADER)?;
+    writer.write_all(&0u32.to_be_bytes())
+}
+
+pub fn write_tag(
+    writer: &mut impl Write,
+    tag_header: &TagHeader,
+    body: &[u8],
+    previous_tag_size: &[u8],
+) -> std::io::Result<usize> {
+    write_tag_header(writer, tag_header)?;
+    writer.write_all(body)?;
+    writer.write(previous_tag_size)
+}
+
+pub fn write_tag_header(writer: &mut impl Write, tag_header: &TagHeader) -> std::io::Result<()> {
+    writer.write_u8(tag_header.tag_type as u8)?;
+    writer.write_u24::<BigEndian>(tag_header.data_size)?;
+    writer.write_u24::<BigEndian>(tag_header.timestamp & 0xffffff)?;
+    let timestamp_ext = ((tag_header.timestamp >> 24) & 0xff) as u8;
+    writer.write_u8(timestamp_ext)?;
+    writer.write_u24::<BigEndian>(tag_header.stream_id)
+}
+
 pub struct FlvFile<'a> {
     pub buf_writer: BufWriter<File>,
     pub file: LifecycleFile<'a>,
@@ -55,8 +96,7 @@ impl<'a> FlvFile<'a> {
         };
         info!("create flv file {}", path.display());
         let mut buf_writer = BufWriter::new(out);
-        buf_writer.write_all(&FLV_HEADER)?;
-        Self::write_previous_tag_size(&mut buf_writer, 0)?;
+        write_header(&mut buf_writer)?;
         Ok(buf_writer)
     }
 
@@ -66,20 +106,11 @@ impl<'a> FlvFile<'a> {
         body: &[u8],
         previous_tag_size: &[u8],
     ) -> std::io::Result<usize> {
-        self.write_tag_header(tag_header)?;
-        self.buf_writer.write_all(body)?;
-        self.buf_writer.write(previous_tag_size)
+        write_tag(&mut self.buf_writer, tag_header, body, previous_tag_size)
     }
 
     pub fn write_tag_header(&mut self, tag_header: &TagHeader) -> std::io::Result<()> {
-        self.buf_writer.write_u8(tag_header.tag_type as u8)?;
-        self.buf_writer
-            .write_u24::<BigEndian>(tag_header.data_size)?;
-        self.buf_writer
-            .write_u24::<BigEndian>(tag_header.timestamp & 0xffffff)?;
-        let timestamp_ext = ((tag_header.timestamp >> 24) & 0xff) as u8;
-        self.buf_writer.write_u8(timestamp_ext)?;
-        self.buf_writer.write_u24::<BigEndian>(tag_header.stream_id)
+        write_tag_header(&mut self.buf_writer, tag_header)
     }
 
     pub fn write_previous_tag_size(
@@ -90,6 +121,25 @@ impl<'a> FlvFile<'a> {
     }
 }
 
+impl FlvOutput for FlvFile<'_> {
+    fn write_tag(
+        &mut self,
+        tag_header: &TagHeader,
+        body: &[u8],
+        previous_tag_size: &[u8],
+    ) -> std::io::Result<usize> {
+        FlvFile::write_tag(self, tag_header, body, previous_tag_size)
+    }
+
+    fn create_new(&mut self) -> std::io::Result<()> {
+        FlvFile::create_new(self)
+    }
+
+    fn file_name(&self) -> &str {
+        &self.file.file_name
+    }
+}
+
 impl Drop for FlvFile<'_> {
     fn drop(&mut self) {
         self.file.rename()
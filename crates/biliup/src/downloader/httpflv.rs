@@ -2,7 +2,7 @@ use crate::downloader::flv_parser::{
     AACPacketType, AVCPacketType, CodecId, FrameType, SoundFormat, TagData, TagHeader,
     aac_audio_packet_header, avc_video_packet_header, script_data, tag_data, tag_header,
 };
-use crate::downloader::flv_writer::{FlvFile, FlvTag, TagDataHeader};
+use crate::downloader::flv_writer::{FlvFile, FlvOutput, FlvTag, TagDataHeader};
 use crate::downloader::util::{LifecycleFile, Segmentable};
 use bytes::{Buf, BufMut, Bytes, BytesMut};
 use nom::{Err, IResult};
@@ -25,15 +25,23 @@ pub async fn download(connection: Connection, file: LifecycleFile<'_>, segment:
 }
 
 pub(crate) async fn parse_flv(
-    mut connection: Connection,
+    connection: Connection,
     file: LifecycleFile<'_>,
+    segment: Segmentable,
+) -> crate::downloader::error::Result<()> {
+    parse_flv_into(connection, FlvFile::new(file)?, segment).await
+}
+
+/// 解析 FLV 头之后的数据，按 tag 写入 out，并在关键帧处按 segment 切换分段
+pub async fn parse_flv_into<O: FlvOutput>(
+    mut connection: Connection,
+    mut out: O,
     mut segment: Segmentable,
 ) -> crate::downloader::error::Result<()> {
     let mut flv_tags_cache: Vec<(TagHeader, Bytes, Bytes)> = Vec::new();
     // println!("parse_flv Segment: {:?}", segment);
     let _previous_tag_size = connection.read_frame(4).await?;
 
-    let mut out = FlvFile::new(file)?;
     segment.set_size_position(9 + 4);
     // let mut downloaded_size = 9 + 4;
     let mut on_meta_data = None;
@@ -194,7 +202,7 @@ pub(crate) async fn parse_flv(
                                 .clone(),
                         );
                     }
-                    info!("{} splitting.{segment:?}", out.file.file_name);
+                    info!("{} splitting.{segment:?}", out.file_name());
                     out.create_new()?;
                     create_new = false;
                 }
@@ -6,6 +6,7 @@ use reqwest::{Body, RequestBuilder};
 use serde::{Deserialize, Serialize};
 use serde_json::json;
 use std::ffi::OsStr;
+use std::path::Path;
 
 use crate::client::StatelessClient;
 use crate::error::Kind::{Custom, RateLimit};
@@ -56,20 +57,24 @@ impl Parcel {
             }
         };
 
-        if video.title.is_none()
-            && let Some(filename) = self.video_file.filepath.file_stem().and_then(OsStr::to_str)
-        {
-            // B站限制分P视频标题不能超过80字符，需要截断
-            video.title = Some(if filename.chars().count() >= 80 {
-                Video::truncate_title(filename, 80)
-            } else {
-                filename.to_string()
-            });
+        if video.title.is_none() {
+            video.title = default_title(&self.video_file.filepath);
         };
         Ok(video)
     }
 }
 
+/// 以文件名作为分P标题
+pub fn default_title(path: &Path) -> Option<String> {
+    let filename = path.file_stem().and_then(OsStr::to_str)?;
+    // B站限制分P视频标题不能超过80字符，需要截断
+    Some(if filename.chars().count() >= 80 {
+        Video::truncate_title(filename, 80)
+    } else {
+        filename.to_string()
+    })
+}
+
 #[derive(Deserialize, Serialize, Debug)]
 pub struct Probe {
     #[serde(rename = "OK")]
@@ -132,8 +137,41 @@ pub struct Line {
 
 impl Line {
     pub async fn pre_upload(&self, bili: &BiliBili, video_file: VideoFile) -> Result<Parcel> {
-        let total_size = video_file.total_size;
-        let file_name = video_file.file_name.clone();
+        let response = self
+            .pre_upload_response(bili, &video_file.file_name, video_file.total_size)
+            .await?;
+        match self.os {
+            Uploader::Upos => Ok(Parcel {
+                line: Bucket::Upos(response.json().await?),
+                video_file,
+            }),
+            // _ => {
+            //     panic!("unsupported")
+            // }
+        }
+    }
+
+    /// 边录边传时预上传，数据大小未知，total_size 为分段大小的上限
+    pub async fn pre_upload_stream(
+        &self,
+        bili: &BiliBili,
+        file_name: &str,
+        total_size: u64,
+    ) -> Result<upos::Bucket> {
+        let response = self
+            .pre_upload_response(bili, file_name, total_size)
+            .await?;
+        match self.os {
+            Uploader::Upos => Ok(response.json().await?),
+        }
+    }
+
+    async fn pre_upload_response(
+        &self,
+        bili: &BiliBili,
+        file_name: &str,
+        total_size: u64,
+    ) -> Result<reqwest::Response> {
         let profile = "ugcupos/bup"; // ugcfx/bup 需上传视频metadata和frame.zip
         let params = json!({
             // "probe_version": "20221109",
@@ -181,16 +219,7 @@ impl Line {
                 response_text
             )));
         }
-
-        match self.os {
-            Uploader::Upos => Ok(Parcel {
-                line: Bucket::Upos(response.json().await?),
-                video_file,
-            }),
-            // _ => {
-            //     panic!("unsupported")
-            // }
-        }
+        Ok(response)
     }
 }
 
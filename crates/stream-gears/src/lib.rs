@@ -1,5 +1,6 @@
 mod danmaku;
 mod login;
+mod record;
 mod server;
 mod uploader;
 
@@ -23,6 +24,7 @@ use biliup::downloader::flv_parser::header;
 use biliup::downloader::httpflv::Connection;
 use biliup_cli::server::common::construct_headers;
 use pyo3::exceptions::PyRuntimeError;
+use pythonize::pythonize;
 use tracing_subscriber::layer::SubscriberExt;
 
 #[tokio::main]
@@ -84,6 +86,23 @@ impl PySegment {
     }
 }
 
+impl From<PySegment> for Segmentable {
+    fn from(segment: PySegment) -> Self {
+        match (segment.time, segment.size) {
+            (Some(time), Some(size)) => {
+                // 已支持同时创建时间和大小
+                Segmentable::new(Some(Duration::from_secs(time)), Some(size))
+            }
+            (Some(time), None) => Segmentable::new(Some(Duration::from_secs(time)), None),
+            (None, Some(size)) => Segmentable::new(None, Some(size)),
+            (None, None) => {
+                // 如果都没有，使用默认值
+                Segmentable::default()
+            }
+        }
+    }
+}
+
 #[pyfunction]
 #[pyo3(signature = (url,header_map,file_name,segment,proxy = None))]
 fn download(
@@ -133,18 +152,7 @@ fn download_with_callback(
         // println!("Input segment: {:?}", segment);
         // println!("Input segment time: {:?}, size: {:?}", segment.time, segment.size);
 
-        let segmentable = match (segment.time, segment.size) {
-            (Some(time), Some(size)) => {
-                // 已支持同时创建时间和大小
-                Segmentable::new(Some(Duration::from_secs(time)), Some(size))
-            }
-            (Some(time), None) => Segmentable::new(Some(Duration::from_secs(time)), None),
-            (None, Some(size)) => Segmentable::new(None, Some(size)),
-            (None, None) => {
-                // 如果都没有，使用默认值
-                Segmentable::default()
-            }
-        };
+        let segmentable = Segmentable::from(segment);
 
         let file_name_hook = file_name_callback_fn.map(|callback_fn| -> CallbackFn {
             Box::new(move |fmt_file_name| {
@@ -177,6 +185,116 @@ fn download_with_callback(
     })
 }
 
+/// 在录制线程中回调已保存完成的文件名
+fn file_name_hook(callback_fn: Option<Py<PyAny>>) -> CallbackFn<'static> {
+    match callback_fn {
+        Some(callback_fn) => Box::new(move |fmt_file_name| {
+            Python::attach(|py| {
+                if callback_fn.call1(py, (fmt_file_name,)).is_err() {
+                    tracing::error!("Unable to invoke the callback function.")
+                }
+            })
+        }),
+        None => Box::new(|_| {}),
+    }
+}
+
+#[allow(clippy::too_many_arguments)]
+#[pyfunction]
+#[pyo3(signature = (url, header_map, file_name, segment, cookie_file, line=None, limit=3, total_size=10 * 1024 * 1024 * 1024, buffer_size=64 * 1024 * 1024, save=false, file_name_callback_fn=None, progress_fn=None, proxy=None))]
+fn record_and_upload<'py>(
+    py: Python<'py>,
+    url: &str,
+    header_map: HashMap<String, String>,
+    file_name: &str,
+    segment: PySegment,
+    cookie_file: PathBuf,
+    line: Option<UploadLine>,
+    limit: usize,
+    total_size: u64,
+    buffer_size: usize,
+    save: bool,
+    file_name_callback_fn: Option<Py<PyAny>>,
+    progress_fn: Option<Py<PyAny>>,
+    proxy: Option<String>,
+) -> PyResult<Bound<'py, PyAny>> {
+    let videos = py.detach(|| {
+        let map = construct_headers(&header_map).map_err(PyRuntimeError::new_err)?;
+        let local_time = tracing_subscriber::fmt::time::LocalTime::new(format_description!(
+            "[year]-[month]-[day] [hour]:[minute]:[second]"
+        ));
+        let formatting_layer = tracing_subscriber::FmtSubscriber::builder()
+            .with_timer(local_time.clone())
+            .finish();
+        let file_appender = tracing_appender::rolling::never("", "record.log");
+        let (non_blocking, _guard) = tracing_appender::non_blocking(file_appender);
+        let file_layer = tracing_subscriber::fmt::layer()
+            .with_ansi(false)
+            .with_timer(local_time)
+            .with_writer(non_blocking);
+
+        // 每个分块上传完成后回调 (文件名, 当前分段已上传字节数)，只在此时短暂持有 GIL
+        let progress: record::ProgressFn = match progress_fn {
+            Some(progress_fn) => Box::new(move |file_name, uploaded| {
+                Python::attach(|py| {
+                    if progress_fn.call1(py, (file_name, uploaded)).is_err() {
+                        tracing::error!("Unable to invoke the progress function.")
+                    }
+                })
+            }),
+            None => Box::new(|_, _| {}),
+        };
+
+        let collector = formatting_layer.with(file_layer);
+        tracing::subscriber::with_default(collector, || {
+            record::record_and_upload(
+                record::RecordOptions::builder()
+                    .url(url.to_string())
+                    .headers(map)
+                    .file_name(file_name.to_string())
+                    .segment(Segmentable::from(segment))
+                    .cookie_file(cookie_file)
+                    .maybe_line(line.map(Into::into))
+                    .limit(limit)
+                    .total_size(total_size)
+                    .buffer_size(buffer_size)
+                    .save(save)
+                    .file_name_hook(file_name_hook(file_name_callback_fn))
+                    .progress(progress)
+                    .maybe_proxy(proxy)
+                    .build(),
+            )
+        })
+    })?;
+    Ok(pythonize(py, &videos)?)
+}
+
+#[allow(clippy::too_many_arguments)]
+#[pyfunction]
+#[pyo3(signature = (url, header_map, file_name, segment, buffer_size=64 * 1024 * 1024, save=false, file_name_callback_fn=None, proxy=None))]
+fn open_stream(
+    url: &str,
+    header_map: HashMap<String, String>,
+    file_name: &str,
+    segment: PySegment,
+    buffer_size: usize,
+    save: bool,
+    file_name_callback_fn: Option<Py<PyAny>>,
+    proxy: Option<String>,
+) -> PyResult<record::LiveStream> {
+    let map = construct_headers(&header_map).map_err(PyRuntimeError::new_err)?;
+    Ok(record::LiveStream::open(
+        url.to_string(),
+        map,
+        file_name.to_string(),
+        Segmentable::from(segment),
+        buffer_size,
+        save,
+        file_name_hook(file_name_callback_fn),
+        proxy,
+    )?)
+}
+
 #[pyfunction]
 fn login_by_cookies(file: String, proxy: Option<String>) -> PyResult<bool> {
     let rt = tokio::runtime::Runtime::new().unwrap();
@@ -430,6 +548,8 @@ fn stream_gears(m: &Bound<'_, PyModule>) -> PyResult<()> {
     // m.add_function(wrap_pyfunction!(upload_by_app, m)?)?;
     m.add_function(wrap_pyfunction!(download, m)?)?;
     m.add_function(wrap_pyfunction!(download_with_callback, m)?)?;
+    m.add_function(wrap_pyfunction!(record_and_upload, m)?)?;
+    m.add_function(wrap_pyfunction!(open_stream, m)?)?;
     m.add_function(wrap_pyfunction!(login_by_cookies, m)?)?;
     m.add_function(wrap_pyfunction!(send_sms, m)?)?;
     m.add_function(wrap_pyfunction!(login_by_qrcode, m)?)?;
@@ -441,6 +561,7 @@ fn stream_gears(m: &Bound<'_, PyModule>) -> PyResult<()> {
     m.add_function(wrap_pyfunction!(server::config_bindings, m)?)?;
     m.add_class::<UploadLine>()?;
     m.add_class::<PySegment>()?;
+    m.add_class::<record::LiveStream>()?;
     Ok(())
 }
 
@@ -0,0 +1,492 @@
+use axum::http::HeaderMap;
+use biliup::bilibili::{BiliBili, Video};
+use biliup::client::StatelessClient;
+use biliup::credential::login_by_cookies;
+use biliup::downloader::flv_parser::{TagHeader, header};
+use biliup::downloader::flv_writer::{self, FlvFile, FlvOutput};
+use biliup::downloader::httpflv::{self, Connection};
+use biliup::downloader::util::{CallbackFn, LifecycleFile, Segmentable, format_filename};
+use biliup::error::Kind;
+use biliup::uploader::line::upos::Upos;
+use biliup::uploader::line::{self, Line};
+use biliup_cli::server::common::upload::choose_line;
+use bon::Builder;
+use bytes::{Bytes, BytesMut};
+use futures::{Stream, StreamExt, TryStreamExt};
+use pyo3::exceptions::{PyBlockingIOError, PyRuntimeError, PyStopAsyncIteration};
+use pyo3::prelude::*;
+use pyo3::types::PyBytes;
+use std::io;
+use std::path::{Path, PathBuf};
+use std::sync::Mutex;
+use std::thread::JoinHandle;
+use std::time::Instant;
+use tracing::{info, warn};
+
+/// 录制数据交给上传端的块大小
+const BLOCK_SIZE: usize = 1024 * 1024;
+
+pub type ProgressFn = Box<dyn Fn(&str, u64) + Send + Sync>;
+
+/// 录制线程发送给上传端的数据
+enum Piece {
+    /// 新分段开始，参数为上传使用的文件名
+    Start(String),
+    Data(Bytes),
+    End,
+}
+
+/// 把录制的 FLV 数据按分段交给上传端，可同时写入本地文件
+struct UploadSink<'a> {
+    fmt_file_name: String,
+    file_name: String,
+    buf: Vec<u8>,
+    tx: async_channel::Sender<Piece>,
+    tee: Option<FlvFile<'a>>,
+}
+
+impl<'a> UploadSink<'a> {
+    fn new(
+        fmt_file_name: &str,
+        tx: async_channel::Sender<Piece>,
+        tee: Option<FlvFile<'a>>,
+    ) -> io::Result<Self> {
+        let mut sink = Self {
+            fmt_file_name: fmt_file_name.to_string(),
+            file_name: String::new(),
+            buf: Vec::with_capacity(BLOCK_SIZE),
+            tx,
+            tee,
+        };
+        sink.start()?;
+        Ok(sink)
+    }
+
+    fn start(&mut self) -> io::Result<()> {
+        self.file_name = format!("{}.flv", format_filename(&self.fmt_file_name));
+        self.send(Piece::Start(self.file_name.clone()))?;
+        flv_writer::write_header(&mut self.buf)
+    }
+
+    fn send(&self, piece: Piece) -> io::Result<()> {
+        // 上传跟不上时阻塞录制线程，不再读取直播流，由 TCP 把压力传回服务器
+        self.tx
+            .send_blocking(piece)
+            .map_err(|_| io::Error::new(io::ErrorKind::BrokenPipe, "upload stopped"))
+    }
+
+    fn flush(&mut self) -> io::Result<()> {
+        if self.buf.is_empty() {
+            return Ok(());
+        }
+        let block = std::mem::replace(&mut self.buf, Vec::with_capacity(BLOCK_SIZE));
+        self.send(Piece::Data(Bytes::from(block)))
+    }
+}
+
+impl FlvOutput for UploadSink<'_> {
+    fn write_tag(
+        &mut self,
+        tag_header: &TagHeader,
+        body: &[u8],
+        previous_tag_size: &[u8],
+    ) -> io::Result<usize> {
+        if let Some(tee) = &mut self.tee {
+            tee.write_tag(tag_header, body, previous_tag_size)?;
+        }
+        let n = flv_writer::write_tag(&mut self.buf, tag_header, body, previous_tag_size)?;
+        if self.buf.len() >= BLOCK_SIZE {
+            self.flush()?;
+        }
+        Ok(n)
+    }
+
+    fn create_new(&mut self) -> io::Result<()> {
+        if let Some(tee) = &mut self.tee {
+            tee.create_new()?;
+        }
+        self.flush()?;
+        self.send(Piece::End)?;
+        self.start()
+    }
+
+    fn file_name(&self) -> &str {
+        &self.file_name
+    }
+}
+
+impl Drop for UploadSink<'_> {
+    fn drop(&mut self) {
+        if let Err(e) = self.flush().and_then(|_| self.send(Piece::End)) {
+            warn!("{} {e}", self.file_name)
+        }
+    }
+}
+
+#[derive(Builder)]
+pub struct RecordOptions {
+    url: String,
+    headers: HeaderMap,
+    file_name: String,
+    segment: Segmentable,
+    cookie_file: PathBuf,
+    line: Option<biliup_cli::UploadLine>,
+    limit: usize,
+    /// 每个分段预上传时声明的大小上限
+    total_size: u64,
+    /// 录制和上传之间最多缓存的字节数
+    buffer_size: usize,
+    /// 同时保存到本地文件
+    save: bool,
+    file_name_hook: CallbackFn<'static>,
+    progress: ProgressFn,
+    proxy: Option<String>,
+}
+
+/// 边录边传：录制线程解析 http-flv 直播流并按 segment 分段，
+/// 上传端把每个分段的数据直接切成 UPOS 分块上传，返回已上传的分P
+pub fn record_and_upload(options: RecordOptions) -> PyResult<Vec<Video>> {
+    let RecordOptions {
+        url,
+        headers,
+        file_name,
+        segment,
+        cookie_file,
+        line,
+        limit,
+        total_size,
+        buffer_size,
+        save,
+        file_name_hook,
+        progress,
+        proxy,
+    } = options;
+    let (rx, recorder) = spawn_recorder(
+        url,
+        headers,
+        file_name,
+        segment,
+        buffer_size,
+        save,
+        file_name_hook,
+        proxy.clone(),
+    )?;
+
+    let rt = tokio::runtime::Builder::new_current_thread()
+        .enable_all()
+        .build()?;
+    // 上传出错时 rx 随之释放，录制线程写入失败后退出
+    let uploaded = rt.block_on(async {
+        let bilibili = login_by_cookies(&cookie_file, proxy.as_deref())
+            .await
+            .map_err(runtime_err)?;
+        // 测速和分块上传与登录使用同一代理
+        let client = StatelessClient::new(HeaderMap::new(), proxy.as_deref());
+        let line = choose_line(line, &client).await;
+        info!("{line:?}");
+        upload_segments(&bilibili, client, &line, rx, total_size, limit, &progress)
+            .await
+            .map_err(runtime_err)
+    });
+    let recorded = recorder
+        .join()
+        .map_err(|_| PyRuntimeError::new_err("record thread panicked"))?;
+    let videos = uploaded?;
+    recorded?;
+    Ok(videos)
+}
+
+/// 在单独的线程中录制，录制数据通过容量为 buffer_size 的通道交给返回的 Receiver
+#[allow(clippy::too_many_arguments)]
+fn spawn_recorder(
+    url: String,
+    headers: HeaderMap,
+    file_name: String,
+    segment: Segmentable,
+    buffer_size: usize,
+    save: bool,
+    file_name_hook: CallbackFn<'static>,
+    proxy: Option<String>,
+) -> io::Result<(async_channel::Receiver<Piece>, JoinHandle<PyResult<()>>)> {
+    let (tx, rx) = async_channel::bounded((buffer_size / BLOCK_SIZE).max(1));
+    let dispatch = tracing::dispatcher::get_default(Clone::clone);
+    let recorder = std::thread::Builder::new()
+        .name("record".to_string())
+        .spawn(move || {
+            tracing::dispatcher::with_default(&dispatch, || {
+                let tee = save.then(|| LifecycleFile::with_hook(&file_name, "flv", file_name_hook));
+                record(
+                    &url,
+                    headers,
+                    &file_name,
+                    segment,
+                    tee,
+                    tx,
+                    proxy.as_deref(),
+                )
+            })
+        })?;
+    Ok((rx, recorder))
+}
+
+/// 直播流数据的迭代器，依次返回录制的 FLV 数据块，分段结束时返回 None，与 BiliWebAsync.video_queue 的约定相同
+/// 不及时读取时录制线程暂停读取直播流，最多缓存 buffer_size 字节
+#[pyclass]
+pub struct LiveStream {
+    rx: async_channel::Receiver<Piece>,
+    recorder: Mutex<Option<JoinHandle<PyResult<()>>>>,
+    file_name: Mutex<String>,
+}
+
+impl LiveStream {
+    #[allow(clippy::too_many_arguments)]
+    pub fn open(
+        url: String,
+        headers: HeaderMap,
+        file_name: String,
+        segment: Segmentable,
+        buffer_size: usize,
+        save: bool,
+        file_name_hook: CallbackFn<'static>,
+        proxy: Option<String>,
+    ) -> io::Result<Self> {
+        let (rx, recorder) = spawn_recorder(
+            url,
+            headers,
+            file_name,
+            segment,
+            buffer_size,
+            save,
+            file_name_hook,
+            proxy,
+        )?;
+        Ok(Self {
+            rx,
+            recorder: Mutex::new(Some(recorder)),
+            file_name: Mutex::new(String::new()),
+        })
+    }
+
+    /// 把收到的数据转换为 Python 对象，Start 不返回给调用方
+    fn convert(&self, py: Python<'_>, piece: Piece) -> Option<Py<PyAny>> {
+        match piece {
+            Piece::Start(file_name) => {
+                *self.file_name.lock().unwrap() = file_name;
+                None
+            }
+            // abi3 在 Python 3.11 之前不支持由 pyclass 提供缓冲区协议，以 1MB 的块复制为 bytes，而不是每个 tag 一次
+            Piece::Data(block) => Some(PyBytes::new(py, &block).into_any().unbind()),
+            Piece::End => Some(py.None()),
+        }
+    }
+
+    /// 通道已关闭，录制线程出错时抛出其异常
+    fn finish(&self, py: Python<'_>) -> PyResult<()> {
+        let recorder = self.recorder.lock().unwrap().take();
+        match recorder {
+            Some(recorder) => py
+                .detach(|| recorder.join())
+                .map_err(|_| PyRuntimeError::new_err("record thread panicked"))?,
+            None => Ok(()),
+        }
+    }
+}
+
+#[pymethods]
+impl LiveStream {
+    /// 当前分段的文件名
+    #[getter]
+    fn file_name(&self) -> String {
+        self.file_name.lock().unwrap().clone()
+    }
+
+    fn __iter__(slf: PyRef<'_, Self>) -> PyRef<'_, Self> {
+        slf
+    }
+
+    fn __next__(&self, py: Python<'_>) -> PyResult<Option<Py<PyAny>>> {
+        loop {
+            // 等待数据时释放 GIL
+            match py.detach(|| self.rx.recv_blocking()) {
+                Ok(piece) => {
+                    if let Some(item) = self.convert(py, piece) {
+                        return Ok(Some(item));
+                    }
+                }
+                Err(_) => {
+                    self.finish(py)?;
+                    return Ok(None);
+                }
+            }
+        }
+    }
+
+    /// 非阻塞读取，没有数据时抛出 BlockingIOError，供 __anext__ 先行尝试
+    fn next_nowait(&self, py: Python<'_>) -> PyResult<Py<PyAny>> {
+        loop {
+            match self.rx.try_recv() {
+                Ok(piece) => {
+                    if let Some(item) = self.convert(py, piece) {
+                        return Ok(item);
+                    }
+                }
+                Err(async_channel::TryRecvError::Empty) => {
+                    return Err(PyBlockingIOError::new_err("no data"));
+                }
+                Err(async_channel::TryRecvError::Closed) => {
+                    self.finish(py)?;
+                    return Err(PyStopAsyncIteration::new_err(()));
+                }
+            }
+        }
+    }
+
+    /// 阻塞读取，结束时抛出 StopAsyncIteration，供 __anext__ 在线程池中等待
+    fn next_blocking(&self, py: Python<'_>) -> PyResult<Py<PyAny>> {
+        match self.__next__(py)? {
+            Some(item) => Ok(item),
+            None => Err(PyStopAsyncIteration::new_err(())),
+        }
+    }
+
+    fn __aiter__(slf: PyRef<'_, Self>) -> PyRef<'_, Self> {
+        slf
+    }
+
+    /// 已有数据时直接返回已完成的 Future，否则在默认线程池中等待
+    fn __anext__(slf: Bound<'_, Self>) -> PyResult<Bound<'_, PyAny>> {
+        let py = slf.py();
+        let event_loop = py.import("asyncio")?.call_method0("get_running_loop")?;
+        let future = event_loop.call_method0("create_future")?;
+        let next = slf.borrow().next_nowait(py);
+        match next {
+            Ok(item) => {
+                future.call_method1("set_result", (item,))?;
+                Ok(future)
+            }
+            Err(e) if e.is_instance_of::<PyBlockingIOError>(py) => event_loop.call_method1(
+                "run_in_executor",
+                (py.None(), slf.getattr("next_blocking")?),
+            ),
+            // 包括已结束时的 StopAsyncIteration
+            Err(e) => Err(e),
+        }
+    }
+
+    /// 停止录制，已缓存的数据被丢弃
+    fn close(&self, py: Python<'_>) -> PyResult<()> {
+        self.rx.close();
+        self.finish(py)
+    }
+}
+
+fn runtime_err(e: impl std::fmt::Display) -> pyo3::PyErr {
+    PyRuntimeError::new_err(e.to_string())
+}
+
+#[tokio::main(flavor = "current_thread")]
+async fn record(
+    url: &str,
+    headers: HeaderMap,
+    file_name: &str,
+    segment: Segmentable,
+    tee: Option<LifecycleFile<'static>>,
+    tx: async_channel::Sender<Piece>,
+    proxy: Option<&str>,
+) -> PyResult<()> {
+    let client = StatelessClient::new(headers, proxy);
+    let response = client.retryable(url).await.map_err(runtime_err)?;
+    let mut connection = Connection::new(response);
+    let bytes = connection.read_frame(9).await.map_err(runtime_err)?;
+    if let Err(e) = header(&bytes) {
+        return Err(PyRuntimeError::new_err(format!(
+            "only http-flv streams are supported: {e:?}"
+        )));
+    }
+    info!("Recording {}...", url);
+    let tee = tee.map(FlvFile::new).transpose()?;
+    let sink = UploadSink::new(file_name, tx, tee)?;
+    // 与 httpflv::download 相同，直播流中断视为录制结束，已录制的分段照常上传
+    match httpflv::parse_flv_into(connection, sink, segment).await {
+        Ok(_) => info!("Done... {}", url),
+        Err(e) => warn!("{e}"),
+    }
+    Ok(())
+}
+
+async fn upload_segments(
+    bilibili: &BiliBili,
+    client: StatelessClient,
+    line: &Line,
+    rx: async_channel::Receiver<Piece>,
+    total_size: u64,
+    limit: usize,
+    progress: &ProgressFn,
+) -> biliup::error::Result<Vec<Video>> {
+    let mut videos = Vec::new();
+    while let Ok(piece) = rx.recv().await {
+        let Piece::Start(file_name) = piece else {
+            continue;
+        };
+        let bucket = line
+            .pre_upload_stream(bilibili, &file_name, total_size)
+            .await?;
+        let chunk_size = bucket.chunk_size;
+        let upos = Upos::from(client.clone(), bucket).await?;
+        // 读到 End 时当前分段结束
+        let blocks = futures::stream::unfold(&rx, |rx| async move {
+            match rx.recv().await {
+                Ok(Piece::Data(block)) => Some((block, rx)),
+                _ => None,
+            }
+        });
+        let chunks = rechunk(blocks, chunk_size).map(|chunk| {
+            let len = chunk.len();
+            Ok::<_, Kind>((chunk, len))
+        });
+        let instant = Instant::now();
+        let stream = upos.upload_stream(chunks, total_size, limit).await?;
+        tokio::pin!(stream);
+        let mut parts = Vec::new();
+        let mut uploaded = 0;
+        while let Some((part, size)) = stream.try_next().await? {
+            parts.push(part);
+            uploaded += size as u64;
+            progress(&file_name, uploaded);
+        }
+        if parts.is_empty() {
+            warn!("{file_name} is empty, skipped");
+            continue;
+        }
+        let path = Path::new(&file_name);
+        let mut video = upos.get_ret_video_info(&parts, path).await?;
+        video.title = line::default_title(path);
+        let t = instant.elapsed().as_millis();
+        info!(
+            "Upload completed: {file_name} => cost {:.2}s, {:.2} MB/s.",
+            t as f64 / 1000.,
+            uploaded as f64 / 1000. / t as f64
+        );
+        videos.push(video);
+    }
+    Ok(videos)
+}
+
+/// 把录制数据块合并为 chunk_size 大小的上传分块，只有最后一块可以不足 chunk_size
+fn rechunk(blocks: impl Stream<Item = Bytes>, chunk_size: usize) -> impl Stream<Item = Bytes> {
+    let state = (Box::pin(blocks), BytesMut::with_capacity(chunk_size), false);
+    futures::stream::unfold(state, move |(mut blocks, mut buf, done)| async move {
+        if done {
+            return None;
+        }
+        while buf.len() < chunk_size {
+            match blocks.next().await {
+                Some(block) => buf.extend_from_slice(&block),
+                None if buf.is_empty() => return None,
+                None => return Some((buf.split().freeze(), (blocks, buf, true))),
+            }
+        }
+        let chunk = buf.split_to(chunk_size).freeze();
+        Some((chunk, (blocks, buf, false)))
+    })
+}
@@ -1,4 +1,4 @@
-from typing import Dict, List, Optional, Callable
+from typing import AsyncIterator, Awaitable, Dict, Iterator, List, Optional, Callable
 from enum import Enum
 
 from .pyobject import Segment, Credit
@@ -38,6 +38,84 @@ def download_with_callback(url: str,
     """
 
 
+def record_and_upload(url: str,
+                      header_map: Dict[str, str],
+                      file_name: str,
+                      segment: Segment,
+                      cookie_file: str,
+                      line: Optional[UploadLine] = None,
+                      limit: int = 3,
+                      total_size: int = 10 * 1024 * 1024 * 1024,
+                      buffer_size: int = 64 * 1024 * 1024,
+                      save: bool = False,
+                      file_name_callback_fn: Optional[Callable[[str], None]] = None,
+                      progress_fn: Optional[Callable[[str, int], None]] = None,
+                      proxy: Optional[str] = None) -> List[Dict[str, Optional[str]]]:
+    """
+    边录边传，录制的 http-flv 数据在 Rust 中直接切成分块上传，不经过 Python
+
+    :param str url: 直播流地址
+    :param Dict[str, str] header_map: HTTP请求头
+    :param str file_name: 文件名格式
+    :param Segment segment: 视频分段设置，每个分段上传为一个分P
+    :param str cookie_file: cookie文件路径
+    :param Optional[UploadLine] line: 上传线路
+    :param int limit: 单个分段最大并发数
+    :param int total_size: 每个分段预上传时声明的大小上限
+    :param int buffer_size: 录制和上传之间最多缓存的字节数，上传跟不上时暂停读取直播流
+    :param bool save: 同时保存到本地文件
+    :param Callable[[str], None] file_name_callback_fn: 回调已保存完成的本地文件名
+    :param Callable[[str, int], None] progress_fn: 回调分段文件名和已上传字节数
+    :param Optional[str] proxy: 代理
+    :return: 已上传的分P，可用于投稿
+    """
+
+
+class LiveStream:
+    """
+    直播流数据迭代器，依次返回录制的 FLV 数据块（约 1MB 的 bytes），每个分段结束时返回 None，
+    可直接写入 BiliWebAsync.video_queue；不及时读取时录制线程暂停读取直播流
+    每个数据块都会从 Rust 复制一次到新的 bytes 对象（abi3 在 Python 3.11 之前不支持缓冲区协议，无法零拷贝），
+    按块而不是按 tag 复制，开销约为每 MB 一次 1MB 的内存复制
+    """
+
+    file_name: str
+    """当前分段的文件名"""
+
+    def __iter__(self) -> Iterator[Optional[bytes]]: ...
+
+    def __next__(self) -> Optional[bytes]: ...
+
+    def __aiter__(self) -> AsyncIterator[Optional[bytes]]: ...
+
+    def __anext__(self) -> Awaitable[Optional[bytes]]: ...
+
+    def close(self) -> None:
+        """停止录制，已缓存的数据被丢弃"""
+
+
+def open_stream(url: str,
+                header_map: Dict[str, str],
+                file_name: str,
+                segment: Segment,
+                buffer_size: int = 64 * 1024 * 1024,
+                save: bool = False,
+                file_name_callback_fn: Optional[Callable[[str], None]] = None,
+                proxy: Optional[str] = None) -> LiveStream:
+    """
+    开始录制 http-flv 直播流，返回可迭代（或 async for）读取数据的 LiveStream
+
+    :param str url: 直播流地址
+    :param Dict[str, str] header_map: HTTP请求头
+    :param str file_name: 文件名格式
+    :param Segment segment: 视频分段设置
+    :param int buffer_size: 未读取的数据最多缓存的字节数
+    :param bool save: 同时保存到本地文件
+    :param Callable[[str], None] file_name_callback_fn: 回调已保存完成的本地文件名
+    :param Optional[str] proxy: 代理
+    """
+
+
 def login_by_cookies(proxy: Optional[str]) -> bool:
     """
     cookie登录
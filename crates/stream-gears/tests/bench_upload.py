@@ -0,0 +1,214 @@
+"""
+上传性能测试
+
+在本地模拟的 B 站接口（fake_bilibili.py）上用同一个文件分别测试：
+- bili_webup: BiliBili.upload_file（aiohttp 异步上传）
+- bili_webup_sync: BiliBili.upos_stream（直播边录边传，在独立的事件循环中调用，队列为 queue.SimpleQueue）
+- bili_webup_stream: BiliBili.upos_stream_async（直播边录边传在共享事件循环中上传）
+- stream_gears: stream_gears.upload（Rust 实现，需要已安装 stream_gears）
+每个实现在独立的子进程中运行，输出吞吐量、峰值内存、每 GB 消耗的 CPU 时间和服务端统计的分块耗时分位数。
+
+示例:
+    python bench_upload.py --size 512 --chunk-size 4 --bandwidth 200 --latency 0.02 --error-rate 0.01
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import queue
+import re
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..'))
+
+from fake_bilibili import FakeBilibili, write_cookie_file  # noqa: E402
+
+BACKENDS = ('bili_webup', 'bili_webup_sync', 'bili_webup_stream', 'stream_gears')
+API_HOSTS = re.compile(r'https?://(member|api|passport)\.bilibili\.com')
+
+
+def redirect(bili, base_url):
+    """把 BiliBili 实例访问的 B 站接口改写到本地模拟服务"""
+    from requests.adapters import HTTPAdapter
+
+    class Redirect(HTTPAdapter):
+        def send(self, request, **kwargs):
+            request.url = API_HOSTS.sub(base_url, request.url)
+            return super().send(request, **kwargs)
+
+    session = bili._BiliBili__session
+    session.mount('https://', Redirect())
+    session.mount('http://', Redirect())
+    bili._BiliBili__bili_jct = 'bench'
+    if hasattr(bili, '_request'):
+        request = bili._request
+
+        async def _request(method, url, *args, **kwargs):
+            return await request(method, API_HOSTS.sub(base_url, url), *args, **kwargs)
+
+        bili._request = _request
+    return session
+
+
+def bench_bili_webup(path, base_url, proxy_url, args):
+    from biliup.plugins.bili_webup import BiliBili, Data
+    from biliup.plugins.upload_telemetry import UploadTelemetry
+
+    with BiliBili(Data()) as bili:
+        redirect(bili, base_url)
+        bili.telemetry = UploadTelemetry()  # 不输出进度
+        return bili.upload_file(path, 'AUTO', args.threads, args.max_threads)
+
+
+def stream_upload(path, base_url, args, stream_queue):
+    """准备 bili_webup_sync 的直播上传，在后台线程中把文件按 1MB 分包写入 stream_queue"""
+    from biliup.plugins import bili_webup_sync
+
+    bili = bili_webup_sync.BiliBili(bili_webup_sync.Data())
+    session = redirect(bili, base_url)
+    bili.threads, bili.max_threads = args.threads, max(args.max_threads, args.threads)
+    bili._auto_os = {'os': 'upos', 'query': 'upcdn=bench&probe_version=20221109'}
+    name = os.path.basename(path)
+    total_size = os.path.getsize(path)
+    ret = session.get('https://member.bilibili.com/preupload?upcdn=bench', timeout=5, params={
+        'r': 'upos', 'profile': 'ugcupos/bup', 'name': name, 'size': total_size}).json()
+
+    def produce():
+        with open(path, 'rb') as f:
+            while data := f.read(1024 * 1024):
+                stream_queue.put(data)
+        stream_queue.put(None)
+
+    threading.Thread(target=produce, daemon=True).start()
+    return bili, name, total_size, ret
+
+
+def bench_bili_webup_sync(path, base_url, proxy_url, args):
+    stream_queue = queue.SimpleQueue()
+    bili, name, total_size, ret = stream_upload(path, base_url, args, stream_queue)
+    with bili:
+        return asyncio.run(bili.upos_stream(stream_queue, name, total_size, ret))
+
+
+def bench_bili_webup_stream(path, base_url, proxy_url, args):
+    from biliup.plugins.upload_buffer import StreamQueue
+
+    # 生产者一次性写入整个文件，放宽内存上限避免测到暂存文件的开销
+    stream_queue = StreamQueue(1024 ** 3)
+    bili, name, total_size, ret = stream_upload(path, base_url, args, stream_queue)
+    with bili:
+        return bili.runtime.run(bili.upos_stream_async(stream_queue, name, total_size, ret))
+
+
+def bench_stream_gears(path, base_url, proxy_url, args):
+    import stream_gears
+
+    cookie_file = write_cookie_file(os.path.join(os.path.dirname(path), 'bench_cookies.json'))
+    # stream_gears 只能通过代理访问模拟服务
+    return stream_gears.upload(video_path=[path], cookie_file=cookie_file, title='bench', tag='bench',
+                               copyright=1, limit=args.threads, submit='web', proxy=proxy_url)
+
+
+def run_backend(backend, path, base_url, proxy_url, args, results):
+    start_usage = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    try:
+        globals()[f'bench_{backend}'](path, base_url, proxy_url, args)
+        error = None
+    except ImportError as e:
+        error = f'skipped: {e}'
+    except Exception as e:
+        error = f'{type(e).__name__}: {e}'
+    seconds = time.perf_counter() - start
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    # Linux 上 ru_maxrss 单位为 KB，macOS 上为字节
+    max_rss = usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    results.put({
+        'seconds': seconds,
+        'cpu': (usage.ru_utime - start_usage.ru_utime) + (usage.ru_stime - start_usage.ru_stime),
+        'max_rss': max_rss,
+        'error': error,
+    })
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='本地上传性能测试')
+    parser.add_argument('--size', type=float, default=256, help='测试文件大小（MB）')
+    parser.add_argument('--chunk-size', type=float, default=4, help='服务端返回的分块大小（MB）')
+    parser.add_argument('--threads', type=int, default=3, help='初始分块并发数')
+    parser.add_argument('--max-threads', type=int, default=16, help='分块并发数上限')
+    parser.add_argument('--latency', type=float, default=0.0, help='每个请求的额外延迟（秒）')
+    parser.add_argument('--bandwidth', type=float, default=None, help='总带宽上限（MB/s）')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='分块 PUT 失败率')
+    parser.add_argument('--stall-rate', type=float, default=0.0, help='慢分块比例')
+    parser.add_argument('--stall', type=float, default=5.0, help='慢分块额外耗时（秒）')
+    parser.add_argument('--repeat', type=int, default=1, help='每个实现运行的次数')
+    parser.add_argument('--backends', nargs='+', choices=BACKENDS, default=list(BACKENDS))
+    parser.add_argument('--json', action='store_true', help='以 json 输出结果')
+    args = parser.parse_args()
+
+    fake = FakeBilibili(chunk_size=int(args.chunk_size * 1024 * 1024), latency=args.latency,
+                        bandwidth=args.bandwidth and args.bandwidth * 1000 * 1000, error_rate=args.error_rate,
+                        stall_rate=args.stall_rate, stall=args.stall)
+    context = multiprocessing.get_context('spawn')
+    report = []
+    # 子进程启动时即信任模拟服务的证书，aiohttp 在导入时就会创建默认的 SSL 上下文
+    os.environ['SSL_CERT_FILE'] = fake.cafile
+    os.environ['REQUESTS_CA_BUNDLE'] = fake.cafile
+    with fake, tempfile.TemporaryDirectory(prefix='bench_upload_') as directory:
+        path = os.path.join(directory, 'bench.flv')
+        with open(path, 'wb') as f:
+            remaining = int(args.size * 1024 * 1024)
+            while remaining > 0:
+                f.write(os.urandom(min(remaining, 16 * 1024 * 1024)))
+                remaining -= 16 * 1024 * 1024
+        size = os.path.getsize(path)
+        for backend in args.backends:
+            for _ in range(args.repeat):
+                fake.reset()
+                results = context.Queue()
+                process = context.Process(target=run_backend, args=(
+                    backend, path, fake.base_url, fake.proxy_url, args, results))
+                process.start()
+                result = results.get()
+                process.join()
+                report.append({
+                    'backend': backend,
+                    'mb_per_s': size / 1000 / 1000 / result['seconds'],
+                    'seconds': result['seconds'],
+                    'max_rss_mb': result['max_rss'] / 1024 / 1024,
+                    'cpu_s_per_gb': result['cpu'] / (size / 1024 ** 3),
+                    'chunk_p50': percentile(fake.chunk_latencies, 0.5),
+                    'chunk_p99': percentile(fake.chunk_latencies, 0.99),
+                    'injected_errors': fake.errors,
+                    'merged_bytes': sum(fake.merged.values()),
+                    'error': result['error'],
+                })
+    if args.json:
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+        return
+    print(f"{'backend':<16}{'MB/s':>9}{'RSS MB':>9}{'CPU s/GB':>10}{'p50 s':>8}{'p99 s':>8}{'errors':>8}  merged")
+    for row in report:
+        if row['error']:
+            print(f"{row['backend']:<16}  {row['error']}")
+            continue
+        print(f"{row['backend']:<16}{row['mb_per_s']:>9.2f}{row['max_rss_mb']:>9.1f}{row['cpu_s_per_gb']:>10.2f}"
+              f"{row['chunk_p50'] or 0:>8.3f}{row['chunk_p99'] or 0:>8.3f}{row['injected_errors']:>8}"
+              f"  {row['merged_bytes']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,325 @@
+"""
+本地模拟的 B 站投稿接口，供上传性能测试使用
+
+实现 preupload、UPOS 的 ?uploads、分块 PUT 和合并接口，以及 x/vu/web/add|edit 等投稿接口，
+可配置请求延迟、总带宽上限、分块失败率和慢分块，并在服务端记录每个分块的耗时。
+/live.flv 提供生成的 http-flv 直播流，供边录边传测试使用。
+服务使用临时生成的 CA 签发的证书提供 HTTPS：
+- Python 上传代码可以把 member.bilibili.com 等地址改写为 base_url 后直接访问
+- 只能通过代理访问的客户端（如 stream_gears）可以使用 proxy_url 提供的 CONNECT 代理，
+  所有目标地址都会被转发到本服务，此时需要通过 SSL_CERT_FILE 信任 cafile
+"""
+import asyncio
+import json
+import os
+import random
+import ssl
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+
+from aiohttp import web
+
+# 证书中包含的域名，通过 CONNECT 代理访问时 TLS 校验使用
+CERT_NAMES = ('member.bilibili.com', '*.bilibili.com', '*.bilivideo.com', '*.hdslb.com')
+
+
+def make_certificates(directory: str):
+    """用 openssl 生成 CA 和由其签发的服务端证书，返回 (cafile, certfile, keyfile)"""
+    cafile = os.path.join(directory, 'ca.pem')
+    cakey = os.path.join(directory, 'ca.key')
+    certfile = os.path.join(directory, 'cert.pem')
+    keyfile = os.path.join(directory, 'key.pem')
+    csr = os.path.join(directory, 'cert.csr')
+    ext = os.path.join(directory, 'cert.ext')
+    with open(ext, 'w') as f:
+        f.write('basicConstraints=CA:FALSE\nextendedKeyUsage=serverAuth\n'
+                f"subjectAltName=IP:127.0.0.1,{','.join(f'DNS:{name}' for name in CERT_NAMES)}\n")
+    run = lambda *args: subprocess.run(['openssl', *args], check=True, capture_output=True)
+    run('req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '2', '-subj', '/CN=biliup bench CA',
+        '-keyout', cakey, '-out', cafile)
+    run('req', '-newkey', 'rsa:2048', '-nodes', '-subj', '/CN=127.0.0.1', '-keyout', keyfile, '-out', csr)
+    run('x509', '-req', '-days', '2', '-in', csr, '-CA', cafile, '-CAkey', cakey, '-CAcreateserial',
+        '-extfile', ext, '-out', certfile)
+    return cafile, certfile, keyfile
+
+
+def write_cookie_file(path: str):
+    """写入模拟服务接受的登录信息，供 stream_gears 使用"""
+    with open(path, 'w') as f:
+        json.dump({
+            'cookie_info': {'cookies': [{'name': 'bili_jct', 'value': 'bench'},
+                                        {'name': 'SESSDATA', 'value': 'bench'}]},
+            'sso': [],
+            'token_info': {'access_token': 'bench', 'expires_in': 86400 * 30, 'mid': 1, 'refresh_token': 'bench'},
+            'platform': 'Android',
+        }, f)
+    return path
+
+
+def flv_tag(tag_type: int, timestamp: int, data: bytes) -> bytes:
+    """FLV tag 及其后的 PreviousTagSize"""
+    header = (bytes([tag_type]) + len(data).to_bytes(3, 'big') + (timestamp & 0xffffff).to_bytes(3, 'big')
+              + bytes([timestamp >> 24 & 0xff]) + b'\0\0\0')
+    return header + data + struct.pack('>I', len(header) + len(data))
+
+
+def flv_stream(gops: int, frame_size: int, fps: int = 25):
+    """
+    生成 H.264 + AAC 的 FLV 数据，先返回 FLV 头、onMetaData 和音视频 sequence header，
+    之后每次返回一个 GOP（1 秒，以关键帧开始），帧内容为填充数据，只保证能被录制端解析和分段
+    """
+    key = b'duration'
+    meta = (b'\x02' + struct.pack('>H', 10) + b'onMetaData' + b'\x08' + struct.pack('>I', 1)
+            + struct.pack('>H', len(key)) + key + b'\x00' + struct.pack('>d', 0) + b'\x00\x00\x09')
+    yield b''.join((
+        b'FLV\x01\x05\x00\x00\x00\x09' + struct.pack('>I', 0),
+        flv_tag(18, 0, meta),
+        flv_tag(8, 0, b'\xaf\x00\x12\x10'),
+        flv_tag(9, 0, b'\x17\x00\x00\x00\x00' + b'\x01\x64\x00\x1f\xff\xe1\x00\x00\x01\x00\x00'),
+    ))
+    interval = 1000 // fps
+    for gop in range(gops):
+        tags = []
+        for frame in range(fps):
+            timestamp = (gop * fps + frame) * interval
+            kind = b'\x17' if frame == 0 else b'\x27'
+            size = frame_size * 4 if frame == 0 else frame_size
+            tags.append(flv_tag(9, timestamp, kind + b'\x01\x00\x00\x00' + bytes([gop & 0xff]) * size))
+            tags.append(flv_tag(8, timestamp, b'\xaf\x01' + b'\x21' * 64))
+        yield b''.join(tags)
+
+
+class TokenBucket:
+    """所有连接共享的带宽上限"""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = 0.0
+        self.last = time.monotonic()
+
+    async def consume(self, n: int):
+        now = time.monotonic()
+        self.tokens = min(self.tokens + (now - self.last) * self.rate, self.rate)
+        self.last = now
+        self.tokens -= n
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+
+class FakeBilibili:
+    def __init__(self, chunk_size=4 * 1024 * 1024, latency=0.0, bandwidth=None, error_rate=0.0,
+                 stall_rate=0.0, stall=5.0):
+        """
+        :param chunk_size: preupload 返回的分块大小
+        :param latency: 每个请求额外的延迟（秒）
+        :param bandwidth: 所有上传合计的带宽上限（字节/秒），为 None 时不限速
+        :param error_rate: 分块 PUT 读完请求体后返回 500 的概率
+        :param stall_rate: 分块 PUT 额外等待 stall 秒的概率，模拟慢连接
+        """
+        self.chunk_size = chunk_size
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.stall_rate = stall_rate
+        self.stall = stall
+        self.port = None
+        self.proxy_port = None
+        self._dir = tempfile.TemporaryDirectory(prefix='fake_bilibili_')
+        self.cafile, self._certfile, self._keyfile = make_certificates(self._dir.name)
+        self._loop = asyncio.new_event_loop()
+        self._runner = None
+        self._proxy = None
+        self.reset()
+
+    def reset(self):
+        """清空上一轮的上传记录和统计"""
+        self.parts = {}
+        self.merged = {}
+        self.submits = []
+        self.aborted = []  # 被取消的上传
+        self.chunk_latencies = []
+        self.errors = 0
+        self._uploads = 0
+        self._bucket = TokenBucket(self.bandwidth) if self.bandwidth else None
+
+    @property
+    def base_url(self):
+        return f'https://127.0.0.1:{self.port}'
+
+    @property
+    def proxy_url(self):
+        return f'http://127.0.0.1:{self.proxy_port}'
+
+    def _json(self, data):
+        return web.json_response({'code': 0, 'message': '0', 'ttl': 1, **data})
+
+    async def _delay(self):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def _endpoint(self, request):
+        # 直接访问时返回本服务地址，通过代理访问时返回 UPOS 域名，由代理转发
+        if request.host.startswith('127.0.0.1'):
+            return f'//{request.host}'
+        return '//upos-cs-upcdnbench.bilivideo.com'
+
+    async def preupload(self, request):
+        await self._delay()
+        if request.query.get('r') == 'probe':
+            return web.json_response({'OK': 1, 'probe': {'get': True}, 'lines': [{
+                'os': 'upos', 'query': 'upcdn=bench&probe_version=20221109',
+                'probe_url': f'{self._endpoint(request)}/OK'}]})
+        self._uploads += 1
+        name = os.path.splitext(os.path.basename(request.query.get('name', 'video')))[0]
+        return web.json_response({
+            'OK': 1, 'chunk_size': self.chunk_size, 'auth': 'bench', 'biz_id': self._uploads,
+            'endpoint': self._endpoint(request), 'endpoints': [self._endpoint(request)],
+            'upos_uri': f'upos://ugc/n{self._uploads}{name}.mp4',
+        })
+
+    async def probe(self, request):
+        await self._delay()
+        return web.Response(text='OK')
+
+    async def upos_post(self, request):
+        await self._delay()
+        name = request.match_info['name']
+        if 'uploads' in request.query:
+            self.parts[name] = {}
+            return web.json_response({'OK': 1, 'upload_id': f'upload-{name}', 'bucket': 'ugc', 'key': name})
+        numbers = sorted(part['partNumber'] for part in (await request.json())['parts'])
+        parts = self.parts.get(name, {})
+        if not numbers or any(n not in parts for n in numbers):
+            return web.json_response({'OK': 0, 'message': 'missing parts'})
+        self.merged[name] = sum(parts[n] for n in numbers)
+        return web.json_response({'OK': 1, 'location': f'upos://ugc/{name}'})
+
+    async def upos_delete(self, request):
+        await self._delay()
+        name = request.match_info['name']
+        self.parts.pop(name, None)
+        self.aborted.append(name)
+        return web.json_response({'OK': 1})
+
+    async def upos_put(self, request):
+        start = time.perf_counter()
+        await self._delay()
+        if self.stall_rate and random.random() < self.stall_rate:
+            await asyncio.sleep(self.stall)
+        size = 0
+        async for data in request.content.iter_chunked(256 * 1024):
+            size += len(data)
+            if self._bucket:
+                await self._bucket.consume(len(data))
+        if self.error_rate and random.random() < self.error_rate:
+            self.errors += 1
+            return web.Response(status=500, text='injected error')
+        # 只记录分块大小，不保留数据
+        self.parts.setdefault(request.match_info['name'], {})[int(request.query['partNumber'])] = size
+        self.chunk_latencies.append(time.perf_counter() - start)
+        return web.Response(text='MULTIPART_PUT_SUCCESS')
+
+    async def submit(self, request):
+        await self._delay()
+        if request.content_type == 'application/json':
+            self.submits.append(await request.json())
+        return self._json({'data': {'aid': 1, 'bvid': 'BV1bench'}})
+
+    async def cover(self, request):
+        await self._delay()
+        return self._json({'data': {'url': 'http://i0.hdslb.com/bfs/archive/bench.jpg'}})
+
+    async def oauth_info(self, request):
+        return self._json({'data': {'mid': 1, 'access_token': 'bench', 'expires_in': 86400 * 30, 'refresh': False}})
+
+    async def other(self, request):
+        await self._delay()
+        return self._json({'data': {'isLogin': True, 'mid': 1, 'uname': 'bench', 'level': 5, 'follower': 0}})
+
+    async def live(self, request):
+        """
+        http-flv 直播流，gops 为关键帧间隔（1 秒）的个数，frame_size 为非关键帧的字节数，
+        pace 为每个关键帧间隔实际发送的秒数（录制端按秒生成文件名，分段不能太快），
+        发送完毕后断开连接，相当于直播结束
+        """
+        response = web.StreamResponse(headers={'Content-Type': 'video/x-flv'})
+        await response.prepare(request)
+        gops = int(request.query.get('gops', 20))
+        frame_size = int(request.query.get('frame_size', 16 * 1024))
+        pace = float(request.query.get('pace', 0))
+        for i, data in enumerate(flv_stream(gops, frame_size)):
+            if i and pace:
+                await asyncio.sleep(pace)
+            await response.write(data)
+        await response.write_eof()
+        return response
+
+    async def _tunnel(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """HTTP CONNECT 代理，不论目标地址都转发到本服务"""
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+            if not head.startswith(b'CONNECT '):
+                writer.write(b'HTTP/1.1 405 Method Not Allowed\r\ncontent-length: 0\r\n\r\n')
+                return
+            upstream_reader, upstream_writer = await asyncio.open_connection('127.0.0.1', self.port)
+            writer.write(b'HTTP/1.1 200 Connection established\r\n\r\n')
+
+            async def pipe(src, dst):
+                try:
+                    while data := await src.read(256 * 1024):
+                        dst.write(data)
+                        await dst.drain()
+                finally:
+                    dst.close()
+
+            await asyncio.gather(pipe(reader, upstream_writer), pipe(upstream_reader, writer),
+                                 return_exceptions=True)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _start(self):
+        app = web.Application(client_max_size=1024 ** 3)
+        app.router.add_get('/preupload', self.preupload)
+        app.router.add_route('*', '/OK', self.probe)
+        app.router.add_post('/ugc/{name}', self.upos_post)
+        app.router.add_put('/ugc/{name}', self.upos_put)
+        app.router.add_delete('/ugc/{name}', self.upos_delete)
+        app.router.add_get('/live.flv', self.live)
+        app.router.add_post('/x/vu/web/cover/up', self.cover)
+        app.router.add_get('/x/passport-login/oauth2/info', self.oauth_info)
+        app.router.add_post('/x/vu/{path:.*}', self.submit)
+        app.router.add_route('*', '/{path:.*}', self.other)
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.load_cert_chain(self._certfile, self._keyfile)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0, ssl_context=context)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        self._proxy = await asyncio.start_server(self._tunnel, '127.0.0.1', 0)
+        self.proxy_port = self._proxy.sockets[0].getsockname()[1]
+
+    def start(self):
+        threading.Thread(target=self._loop.run_forever, daemon=True, name='fake_bilibili').start()
+        asyncio.run_coroutine_threadsafe(self._start(), self._loop).result()
+        return self
+
+    def stop(self):
+        async def stop():
+            self._proxy.close()
+            await self._runner.cleanup()
+
+        asyncio.run_coroutine_threadsafe(stop(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._dir.cleanup()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, e_t, e_v, t_b):
+        self.stop()
@@ -0,0 +1,92 @@
+"""
+stream_gears.open_stream 冒烟测试
+
+从本地模拟服务（fake_bilibili.py）录制其生成的 http-flv 直播流，分别用 for 和 async for 读取 LiveStream，检查：
+1. 每个分段以 FLV 头开始、以 None 结束，直播结束后迭代停止
+2. 同时保存的本地文件与读取到的分段逐字节一致
+3. 两种读取方式得到的数据相同
+
+运行前请先在 crates/stream-gears 中执行 maturin develop 安装 stream_gears，然后：
+    python test_live_stream.py
+"""
+import asyncio
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_bilibili import FakeBilibili  # noqa: E402
+
+# 每秒约 450KB，1MB 分段时 8 秒的直播流约为 3 个分段；按实际时间发送，分段文件名（精确到秒）不会重复
+SEGMENT_SIZE = 1024 * 1024
+LIVE_QUERY = 'gops=8&frame_size=16384&pace=1'
+
+
+def open_stream(stream_gears, fake, saved):
+    segment = stream_gears.PySegment()
+    segment.size = SEGMENT_SIZE
+    return stream_gears.open_stream(
+        url=f'{fake.base_url}/live.flv?{LIVE_QUERY}',
+        header_map={},
+        file_name='live%Y-%m-%dT%H_%M_%S',
+        segment=segment,
+        buffer_size=4 * 1024 * 1024,
+        save=saved is not None,
+        file_name_callback_fn=saved.append if saved is not None else None,
+    )
+
+
+def split_parts(items):
+    """按 None 把读取到的数据块合并为分段"""
+    parts, current = [], []
+    for item in items:
+        if item is None:
+            parts.append(b''.join(current))
+            current = []
+        else:
+            assert isinstance(item, bytes) and len(item) <= 2 * 1024 * 1024, type(item)
+            current.append(item)
+    assert not current, '最后一个分段没有以 None 结束'
+    return parts
+
+
+async def read_async(stream):
+    return [item async for item in stream]
+
+
+def main():
+    with FakeBilibili() as fake, tempfile.TemporaryDirectory() as directory:
+        os.environ['SSL_CERT_FILE'] = fake.cafile
+        import stream_gears
+
+        os.chdir(directory)
+        saved = []
+        stream = open_stream(stream_gears, fake, saved)
+        parts = split_parts(list(stream))
+        assert stream.file_name, '没有收到分段文件名'
+        # 结束后再次读取仍然停止
+        assert next(stream, 'end') == 'end'
+        print(f'for: {len(parts)} parts {[len(part) for part in parts]}')
+        assert len(parts) >= 2, parts
+        assert all(part.startswith(b'FLV\x01') for part in parts)
+        local = []
+        for name in saved:
+            with open(os.path.join(directory, name), 'rb') as f:
+                local.append(f.read())
+        assert local == parts, ([len(part) for part in local], [len(part) for part in parts])
+
+        stream = open_stream(stream_gears, fake, None)
+        async_parts = split_parts(asyncio.run(read_async(stream)))
+        print(f'async for: {len(async_parts)} parts {[len(part) for part in async_parts]}')
+        assert async_parts == parts
+
+        # 提前关闭时录制线程退出，不再阻塞
+        stream = open_stream(stream_gears, fake, None)
+        assert next(stream)
+        stream.close()
+    print('open_stream 测试通过')
+
+
+if __name__ == '__main__':
+    main()
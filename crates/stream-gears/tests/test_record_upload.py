@@ -0,0 +1,64 @@
+"""
+stream_gears.record_and_upload 冒烟测试
+
+在本地模拟的 B 站接口（fake_bilibili.py）上边录边传其生成的 http-flv 直播流，检查：
+1. 按 segment.size 分段，每个分段各自预上传、合并并作为一个分P返回
+2. 同时保存的本地文件与服务端合并的大小一致
+3. 进度回调最终的已上传字节数等于分段大小
+
+运行前请先在 crates/stream-gears 中执行 maturin develop 安装 stream_gears，然后：
+    python test_record_upload.py
+"""
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_bilibili import FakeBilibili, write_cookie_file  # noqa: E402
+
+# 每秒约 450KB，1MB 分段时 8 秒的直播流约为 3 个分段；按实际时间发送，分段文件名（精确到秒）不会重复
+SEGMENT_SIZE = 1024 * 1024
+LIVE_QUERY = 'gops=8&frame_size=16384&pace=1'
+
+
+def main():
+    with FakeBilibili(chunk_size=1024 * 1024) as fake, tempfile.TemporaryDirectory() as directory:
+        # 模拟服务的证书由临时 CA 签发，必须在 stream_gears 创建 HTTP 客户端前设置
+        os.environ['SSL_CERT_FILE'] = fake.cafile
+        import stream_gears
+
+        os.chdir(directory)
+        segment = stream_gears.PySegment()
+        segment.size = SEGMENT_SIZE
+        saved = []
+        progress = {}
+        videos = stream_gears.record_and_upload(
+            url=f'{fake.base_url}/live.flv?{LIVE_QUERY}',
+            header_map={},
+            file_name='record%Y-%m-%dT%H_%M_%S',
+            segment=segment,
+            cookie_file=write_cookie_file(os.path.join(directory, 'cookies.json')),
+            limit=3,
+            total_size=64 * 1024 * 1024,
+            buffer_size=4 * 1024 * 1024,
+            save=True,
+            file_name_callback_fn=saved.append,
+            progress_fn=progress.__setitem__,
+            proxy=fake.proxy_url,
+        )
+
+        merged = sorted(fake.merged.values())
+        local = sorted(os.path.getsize(os.path.join(directory, name)) for name in saved)
+        print(f'{len(videos)} parts, merged {merged}, saved {local}')
+        assert len(videos) >= 2, videos
+        assert len(videos) == len(merged)
+        assert all(video['filename'] for video in videos), videos
+        assert local == merged, (local, merged)
+        assert sorted(progress.values()) == merged, progress
+        assert not fake.aborted
+    print('record_and_upload 测试通过')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+import asyncio
+import functools
+import gc
+import weakref
+
+from biliup.plugins import bili_webup
+from biliup.plugins.bili_webup import ChunkReader
+from biliup.plugins.upload_concurrency import AsyncAimdLimiter, HedgePolicy
+
+
+def test_chunk_reader_table_and_views(tmp_path):
+    path = tmp_path / 'video.flv'
+    path.write_bytes(bytes(range(10)))
+    with open(path, 'rb') as file, ChunkReader(file, 4) as reader:
+        assert [(chunk.index, chunk.start, chunk.end) for chunk in reader] == [(0, 0, 4), (1, 4, 8), (2, 8, 10)]
+        with reader.read(reader.chunks[2]) as view:
+            assert bytes(view) == b'\x08\x09'
+
+
+def test_chunk_reader_close_defers_while_view_is_alive(tmp_path):
+    path = tmp_path / 'video.flv'
+    path.write_bytes(b'x' * 10)
+    with open(path, 'rb') as file:
+        reader = ChunkReader(file, 4)
+        mapping = weakref.ref(reader._mmap)
+        # 模拟被取消的请求仍然引用着分块视图
+        leftover = reader.read(reader.chunks[0])[1:]
+        reader.close()
+        assert bytes(leftover) == b'xxx'
+        del leftover
+        gc.collect()
+        assert mapping() is None
+
+
+def test_upload_hedges_straggler_and_cancels_loser(tmp_path, monkeypatch):
+    monkeypatch.setattr(bili_webup, 'HedgePolicy', functools.partial(HedgePolicy, min_samples=2, min_delay=0.2))
+    path = tmp_path / 'video.flv'
+    path.write_bytes(b'0123456789abcdef')
+    calls = []
+    cancelled = []
+
+    async def upload_chunk(session, chunks_data, params, url=None):
+        calls.append((params['partNumber'], url, bytes(chunks_data)))
+        if params['partNumber'] == 3 and url is None:
+            try:
+                await asyncio.sleep(30)
+            except asyncio.CancelledError:
+                cancelled.append(params['partNumber'])
+                raise
+        await asyncio.sleep(0.01)
+
+    with bili_webup.BiliBili(bili_webup.Data()) as bili, open(path, 'rb') as file:
+        bili.telemetry = None
+        bili.runtime.run(bili._upload({}, file, 4, upload_chunk, limiter=AsyncAimdLimiter(1, 1),
+                                      hedge_urls=['https://upos-alternate.example.com/n1.flv']))
+    assert [call for call in calls if call[0] == 3] == [
+        (3, None, b'89ab'), (3, 'https://upos-alternate.example.com/n1.flv', b'89ab')]
+    assert cancelled == [3]
+    assert [call[0] for call in calls].count(4) == 1
@@ -0,0 +1,162 @@
+import asyncio
+import concurrent.futures
+import os
+import threading
+import types
+
+from biliup.plugins import bili_webup_sync
+from biliup.plugins.bili_webup_sync import BiliWebAsync
+from biliup.plugins.upload_buffer import DiskRing, StreamQueue
+
+
+def ring_uploader(directory):
+    return BiliWebAsync('test', {}, queue_max_bytes=4096, queue_policy='ring', ring_dir=str(directory))
+
+
+def test_leftover_ring_is_kept_under_unique_names(tmp_path):
+    uploader = ring_uploader(tmp_path)
+    path = tmp_path / 'live_1.mkv.ring'
+    for payload in (b'first', b'second'):
+        ring = DiskRing(str(path), 4096)
+        ring.put(payload)
+        ring.close()
+        uploader._open_part_queue('live_1.mkv').close(remove=True)
+    kept = sorted(name for name in os.listdir(tmp_path) if name != 'live_1.mkv.ring')
+    assert len(kept) == 2
+    payloads = []
+    for name in kept:
+        ring = DiskRing(str(tmp_path / name), 4096)
+        payloads.append(ring.get(timeout=1))
+        ring.close()
+    assert sorted(payloads) == [b'first', b'second']
+
+
+def test_upload_stream_reports_part_that_was_not_uploaded(monkeypatch):
+    with bili_webup_sync.BiliBili(bili_webup_sync.Data()) as bili:
+        monkeypatch.setattr(bili, 'prepare_stream', lambda *args: None)
+        assert bili.upload_stream(None, 'live_1.mkv', 1024) is False
+
+
+def test_put_part_gives_up_when_upload_has_ended():
+    part_queue = StreamQueue(4, 'block')
+    part_queue.put(b'full')
+    upload = concurrent.futures.Future()
+    result = []
+    producer = threading.Thread(
+        target=lambda: result.append(BiliWebAsync._put_part(part_queue, b'more', upload, threading.Event())))
+    producer.start()
+    producer.join(1.5)
+    assert producer.is_alive()
+    upload.set_result(True)
+    producer.join(3)
+    assert result == [False]
+    assert part_queue.get(timeout=1) == b'full'
+    assert part_queue.empty()
+
+
+def test_put_part_gives_up_when_stopped(tmp_path):
+    ring = DiskRing(str(tmp_path / 'part.ring'), 64)
+    ring.put(b'x' * 40)
+    stop_event = threading.Event()
+    stop_event.set()
+    assert not BiliWebAsync._put_part(ring, b'y' * 40, concurrent.futures.Future(), stop_event)
+    ring.close(remove=True)
+
+
+def test_drain_part_returns_unread_packets_in_order():
+    part_queue = StreamQueue(4, 'spill')
+    for data in (b'ab', b'cd', b'ef', None):
+        part_queue.put(data)
+    assert BiliWebAsync._drain_part(part_queue) == [b'ab', b'cd', b'ef', None]
+    assert BiliWebAsync._drain_part(part_queue) == []
+    part_queue.close()
+
+
+class FakeResponse:
+    def __init__(self, status=200, body=None):
+        self.status = status
+        self.body = body
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, e_t, e_v, t_b):
+        pass
+
+    async def read(self):
+        return b''
+
+    async def json(self, content_type=None):
+        return self.body
+
+
+class FakeUpos:
+    """记录分块上传和合并请求，failures 为各分块前几次上传返回 500 的次数"""
+
+    def __init__(self, failures=None):
+        self.failures = dict(failures or {})
+        self.puts = []
+        self.merged = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, e_t, e_v, t_b):
+        pass
+
+    def put(self, url, params, data, headers, timeout):
+        part_number = params['partNumber']
+        self.puts.append((part_number, params['start'], params['end'], bytes(data)))
+        if self.failures.get(part_number, 0) > 0:
+            self.failures[part_number] -= 1
+            return FakeResponse(500)
+        return FakeResponse()
+
+    def post(self, url, params, json, headers, timeout):
+        self.merged = json['parts']
+        return FakeResponse(body={'OK': 1})
+
+
+def upload_stream_parts(monkeypatch, packets, chunk_size, failures=None):
+    async def sleep(delay, result=None):
+        return await original_sleep(0, result)
+
+    original_sleep = asyncio.sleep
+    monkeypatch.setattr(asyncio, 'sleep', sleep)
+    upos = FakeUpos(failures)
+    stream_queue = StreamQueue(1024, 'block')
+    for data in packets + [None]:
+        stream_queue.put(data)
+    ret = {'chunk_size': chunk_size, 'endpoint': '//upos.example.com', 'upos_uri': 'upos://ugcfx2lf/n1.flv',
+           'auth': 'auth', 'biz_id': 1, 'upload_id': 'upload'}
+    with bili_webup_sync.BiliBili(bili_webup_sync.Data()) as bili:
+        bili.telemetry = None
+        bili._runtime = types.SimpleNamespace(session=lambda: upos, release=lambda: None)
+        video_part = asyncio.run(bili.upos_stream_async(stream_queue, 'live_1.flv', 1024, ret))
+    stream_queue.close()
+    return video_part, upos
+
+
+def test_upos_stream_uploads_real_size_without_padding(monkeypatch):
+    video_part, upos = upload_stream_parts(monkeypatch, [b'abc', b'defgh', b'ij'], 4)
+    assert video_part['filename'] == 'n1'
+    assert sorted(upos.puts) == [(1, 0, 4, b'abcd'), (2, 4, 8, b'efgh'), (3, 8, 10, b'ij')]
+    assert upos.merged == [{'partNumber': number, 'eTag': 'etag'} for number in (1, 2, 3)]
+
+
+def test_upos_stream_repairs_only_failed_chunks(monkeypatch):
+    # 分块 2 在 _put_chunk_async 的 3 次重试中都失败，第一轮重传成功
+    video_part, upos = upload_stream_parts(monkeypatch, [b'abcdefghij'], 4, failures={2: 3})
+    assert video_part
+    assert [put[0] for put in upos.puts].count(2) == 4
+    assert [put[0] for put in upos.puts].count(1) == 1 and [put[0] for put in upos.puts].count(3) == 1
+    assert upos.puts[-1] == (2, 4, 8, b'efgh')
+    assert [part['partNumber'] for part in upos.merged] == [1, 2, 3]
+
+
+def test_upos_stream_merges_only_verified_chunks(monkeypatch):
+    video_part, upos = upload_stream_parts(monkeypatch, [b'abcdefghij'], 4, failures={3: 100})
+    assert video_part
+    # 首次上传和 2 轮重传各重试 3 次
+    assert [put[0] for put in upos.puts].count(3) == 9
+    assert [part['partNumber'] for part in upos.merged] == [1, 2]
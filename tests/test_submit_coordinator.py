@@ -0,0 +1,62 @@
+import threading
+import time
+
+import pytest
+
+from biliup.plugins.bili_webup_sync import SubmitCoordinator
+
+
+class Recorder:
+    def __init__(self, fail=False):
+        self.calls = []
+        self.fail = fail
+        self.lock = threading.Lock()
+
+    def submit_parts(self, parts, videos, submit_api=None):
+        with self.lock:
+            self.calls.append([part['title'] for part in parts])
+        if self.fail:
+            raise RuntimeError('submit failed')
+        return {'aid': len(self.calls)}
+
+
+def part(title):
+    return {'title': title}
+
+
+def test_later_part_waits_for_earlier_ticket():
+    bili = Recorder()
+    coordinator = SubmitCoordinator(bili, debounce=0.01)
+    first, second = coordinator.begin(), coordinator.begin()
+    later = coordinator.submit(second, part('p2'), None)
+    time.sleep(0.1)
+    assert bili.calls == []
+    assert not later.done()
+    earlier = coordinator.submit(first, part('p1'), None)
+    assert earlier.result(timeout=1) == later.result(timeout=1) == {'aid': 1}
+    assert bili.calls == [['p1', 'p2']]
+
+
+def test_cancel_out_of_order_releases_tickets_in_order():
+    bili = Recorder()
+    coordinator = SubmitCoordinator(bili, debounce=0.01)
+    tickets = [coordinator.begin() for _ in range(4)]
+    third = coordinator.submit(tickets[2], part('p3'), None)
+    coordinator.cancel(tickets[1])
+    time.sleep(0.1)
+    assert bili.calls == []
+    first = coordinator.submit(tickets[0], part('p1'), None)
+    assert first.result(timeout=1) == third.result(timeout=1)
+    coordinator.cancel(tickets[3])
+    fifth = coordinator.begin()
+    coordinator.submit(fifth, part('p5'), None).result(timeout=1)
+    assert bili.calls == [['p1', 'p3'], ['p5']]
+
+
+def test_submit_error_is_delivered_to_every_part():
+    coordinator = SubmitCoordinator(Recorder(fail=True), debounce=0.01)
+    tickets = [coordinator.begin() for _ in range(2)]
+    futures = [coordinator.submit(ticket, part(f'p{ticket}'), None) for ticket in tickets]
+    for future in futures:
+        with pytest.raises(RuntimeError):
+            future.result(timeout=1)
@@ -0,0 +1,208 @@
+import asyncio
+import queue
+
+import pytest
+
+from biliup.plugins.upload_buffer import ByteBudget, ChunkAssembler, DiskRing, StreamQueue
+
+
+def drain(q):
+    items = []
+    while True:
+        data = q.get(timeout=1)
+        items.append(data)
+        if data is None:
+            return items
+
+
+def test_chunk_assembler_reuses_released_buffer():
+    assembler = ChunkAssembler(4)
+    chunk, = assembler.feed(b'abcd')
+    buffer = chunk.obj
+    assembler.recycle(chunk)
+    chunk, = assembler.feed(b'efgh')
+    assert chunk.obj is buffer
+    assert bytes(chunk) == b'efgh'
+
+
+def test_chunk_assembler_keeps_buffer_with_exported_view():
+    assembler = ChunkAssembler(4)
+    chunk, = assembler.feed(b'abcd')
+    held = chunk[1:3]
+    assembler.recycle(chunk)
+    chunk, = assembler.feed(b'wxyz')
+    assert chunk.obj is not held.obj
+    assert bytes(held) == b'bc'
+
+
+def test_chunk_assembler_keeps_chunk_with_exports():
+    assembler = ChunkAssembler(4)
+    chunk, = assembler.feed(b'abcd')
+    held = memoryview(chunk)
+    assembler.recycle(chunk)
+    assembler.feed(b'wx')
+    assert bytes(held) == b'abcd'
+
+
+def test_chunk_assembler_splits_packets_and_flushes_tail():
+    assembler = ChunkAssembler(4)
+    chunks = [bytes(chunk) for data in (b'ab', b'cdefghi', b'j') for chunk in assembler.feed(data)]
+    assert chunks == [b'abcd', b'efgh']
+    assert assembler.pending == 2
+    assert bytes(assembler.flush()) == b'ij'
+    assert assembler.flush() is None
+
+
+def test_stream_queue_spills_then_drains_in_order():
+    q = StreamQueue(max_bytes=8, policy='spill')
+    packets = [bytes([i]) * 3 for i in range(10)]
+    for packet in packets[:6]:
+        q.put(packet)
+    # 内存中的数据读完后从临时文件按顺序读出，期间新数据继续写入文件
+    assert q.get() == packets[0]
+    for packet in packets[6:]:
+        q.put(packet)
+    q.put(None)
+    assert drain(q) == packets[1:] + [None]
+    stats = q.stats()
+    assert stats['high_water'] <= 8
+    assert stats['spill_high_water'] > 0
+    assert stats['spilled_bytes'] == 0
+    q.close()
+
+
+def test_stream_queue_returns_to_memory_after_spill_is_drained():
+    q = StreamQueue(max_bytes=4, policy='spill')
+    for packet in (b'aaaa', b'bbbb', b'cccc'):
+        q.put(packet)
+    assert [q.get(), q.get(), q.get()] == [b'aaaa', b'bbbb', b'cccc']
+    q.put(b'dddd')
+    assert q.bytes == 4 and q.spilled_bytes == 0
+    q.put(None)
+    assert drain(q) == [b'dddd', None]
+    q.close()
+
+
+def test_stream_queue_sentinel_is_not_limited():
+    q = StreamQueue(max_bytes=4, policy='block')
+    q.put(b'aaaa')
+    q.put(None)
+    with pytest.raises(queue.Full):
+        q.put(b'b', timeout=0.01)
+    assert drain(q) == [b'aaaa', None]
+
+
+def test_stream_queue_get_async_reads_sentinel():
+    q = StreamQueue(max_bytes=4, policy='spill')
+
+    async def read():
+        loop = asyncio.get_running_loop()
+        loop.call_later(0.01, q.put, b'abcdef')
+        loop.call_later(0.02, q.put, None)
+        return [await q.get_async(timeout=1), await q.get_async(timeout=1)]
+
+    assert asyncio.run(read()) == [b'abcdef', None]
+    with pytest.raises(queue.Empty):
+        asyncio.run(q.get_async(timeout=0.01))
+    q.close()
+
+
+def test_stream_queue_drop_records_gaps():
+    q = StreamQueue(max_bytes=4, policy='drop')
+    for packet in (b'aaaa', b'bb', b'cc', b'dddd'):
+        q.put(packet)
+    assert q.get() == b'aaaa'
+    q.put(b'eeee')
+    q.put(None)
+    assert drain(q) == [b'eeee', None]
+    assert q.dropped_bytes == 8
+    assert q.gaps == [(4, 8)]
+
+
+def test_disk_ring_wraps_around(tmp_path):
+    ring = DiskRing(str(tmp_path / 'part.ring'), capacity=32)
+    packets = [bytes([i]) * (5 + i % 6) for i in range(50)]
+    ring.put(packets[0])
+    got = []
+    # 始终保留一个分包不读出，写位置不会回到开头，分包跨越文件末尾
+    for packet in packets[1:]:
+        ring.put(packet)
+        got.append(ring.get())
+    ring.put(None)
+    got += [ring.get(), ring.get()]
+    assert got == packets + [None]
+    assert ring.used == 0
+    ring.close(remove=True)
+    assert not (tmp_path / 'part.ring').exists()
+
+
+def test_disk_ring_reopen_recovers_unread_data(tmp_path):
+    path = str(tmp_path / 'part.ring')
+    ring = DiskRing(path, capacity=32)
+    for packet in (b'a' * 10, b'b' * 10):
+        ring.put(packet)
+    assert ring.get() == b'a' * 10
+    ring.put(b'c' * 10)  # 跨越文件末尾
+    ring.close()
+    ring = DiskRing(path, capacity=1024)
+    assert ring.capacity == 32
+    ring.put(None)
+    assert drain(ring) == [b'b' * 10, b'c' * 10, None]
+    ring.close(remove=True)
+
+
+def test_disk_ring_limits(tmp_path):
+    ring = DiskRing(str(tmp_path / 'part.ring'), capacity=16)
+    with pytest.raises(ValueError):
+        ring.put(b'x' * 13)
+    ring.put(b'x' * 8)
+    with pytest.raises(queue.Full):
+        ring.put(b'y' * 8, block=False)
+    with pytest.raises(queue.Full):
+        ring.put(b'y' * 8, timeout=0.01)
+    assert ring.get() == b'x' * 8
+    with pytest.raises(queue.Empty):
+        ring.get(timeout=0.01)
+    ring.close(remove=True)
+
+
+def test_disk_ring_get_async(tmp_path):
+    ring = DiskRing(str(tmp_path / 'part.ring'), capacity=64)
+
+    async def read():
+        loop = asyncio.get_running_loop()
+        loop.call_later(0.01, ring.put, b'abc')
+        loop.call_later(0.02, ring.put, None)
+        return [await ring.get_async(timeout=1), await ring.get_async(timeout=1)]
+
+    assert asyncio.run(read()) == [b'abc', None]
+    ring.close(remove=True)
+
+
+def test_byte_budget_waits_until_release():
+    async def run():
+        budget = ByteBudget(10)
+        await budget.acquire_async(6)
+        waiter = asyncio.ensure_future(budget.acquire_async(6))
+        await asyncio.sleep(0.01)
+        assert not waiter.done() and budget.stats()['waiting'] == 1
+        budget.release(6)
+        await asyncio.wait_for(waiter, 1)
+        assert budget.stats() == {'limit': 10, 'used': 6, 'peak': 6, 'waiting': 0}
+
+    asyncio.run(run())
+
+
+def test_byte_budget_cancelled_waiter_takes_nothing():
+    async def run():
+        budget = ByteBudget(10)
+        await budget.acquire_async(20)  # 没有其他在途数据时允许超过上限
+        waiter = asyncio.ensure_future(budget.acquire_async(1))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        budget.release(20)
+        assert budget.stats()['used'] == 0
+
+    asyncio.run(run())
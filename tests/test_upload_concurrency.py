@@ -0,0 +1,83 @@
+import asyncio
+
+import pytest
+
+from biliup.plugins import upload_concurrency
+from biliup.plugins.upload_concurrency import AimdConcurrency, AsyncAimdLimiter, HedgePolicy
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(upload_concurrency.time, 'perf_counter', lambda: now[0])
+    return now
+
+
+def test_aimd_halves_on_failure_once_per_batch(clock):
+    limiter = AimdConcurrency(initial=8, maximum=16)
+    limiter.failure()
+    assert limiter.limit == 4
+    # 同一批在途分块的失败不再减半
+    clock[0] += 0.5
+    limiter.failure()
+    assert limiter.limit == 4
+    clock[0] += 1
+    limiter.failure()
+    assert limiter.limit == 2
+    for _ in range(3):
+        clock[0] += 1
+        limiter.failure()
+    assert limiter.limit == 1
+
+
+def test_aimd_grows_while_throughput_rises(clock):
+    limiter = AimdConcurrency(initial=2, maximum=4)
+    for limit, seconds in ((3, 1.0), (4, 0.5), (4, 0.25)):
+        clock[0] += seconds
+        for _ in range(limiter.limit):
+            limiter.success(1_000_000, seconds)
+        assert limiter.limit == limit
+
+
+def test_aimd_shrinks_when_throughput_drops(clock):
+    limiter = AimdConcurrency(initial=2, maximum=4)
+    clock[0] += 1
+    limiter.success(1_000_000, 1)
+    limiter.success(1_000_000, 1)
+    assert limiter.limit == 3
+    clock[0] += 10
+    for _ in range(3):
+        limiter.success(1_000_000, 10)
+    assert limiter.limit == 2
+
+
+def test_async_limiter_caps_in_flight():
+    async def run():
+        limiter = AsyncAimdLimiter(2, 4)
+        peak = 0
+
+        async def work():
+            nonlocal peak
+            async with limiter:
+                peak = max(peak, limiter.in_flight)
+                await asyncio.sleep(0.01)
+
+        await asyncio.gather(*(work() for _ in range(6)))
+        return peak, limiter.in_flight
+
+    assert asyncio.run(run()) == (2, 0)
+
+
+def test_hedge_delay_needs_samples():
+    hedge = HedgePolicy(3.0, min_samples=3, min_delay=1.0)
+    for seconds in (2.0, 4.0):
+        hedge.record(seconds)
+        assert hedge.delay() is None
+    hedge.record(1.0)
+    assert hedge.delay() == 6.0
+    assert HedgePolicy(3.0, min_samples=1, min_delay=1.0).delay() is None
+    hedge = HedgePolicy(None, min_samples=0)
+    assert hedge.delay() is None
+    hedge = HedgePolicy(3.0, min_samples=1, min_delay=1.0)
+    hedge.record(0.1)
+    assert hedge.delay() == 1.0
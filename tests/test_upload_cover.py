@@ -0,0 +1,77 @@
+import asyncio
+import threading
+from io import BytesIO
+
+from PIL import Image
+
+from biliup.plugins import bili_webup
+from biliup.plugins.upload_cover import CoverCache, crop_cover
+
+
+def image(width, height):
+    with BytesIO() as buffered:
+        Image.new('RGB', (width, height)).save(buffered, format='PNG')
+        return buffered.getvalue()
+
+
+def test_crop_cover_keeps_16_10():
+    with Image.open(BytesIO(crop_cover(image(320, 100)))) as im:
+        assert im.size == (160, 100)
+    with Image.open(BytesIO(crop_cover(image(160, 400)))) as im:
+        assert im.size == (160, 100)
+
+
+def test_cover_cache_hit_survives_reopen(tmp_path):
+    cache = CoverCache(str(tmp_path))
+    key = CoverCache.key(b'source')
+    assert cache.get_url(key) is None and cache.get_image(key) is None
+    cache.put(key, image=b'cropped')
+    cache.put(key, url='https://example.com/cover.jpg')
+    cache = CoverCache(str(tmp_path))
+    assert cache.get_image(key) == b'cropped'
+    assert cache.get_url(key) == 'https://example.com/cover.jpg'
+    assert CoverCache.key(b'source', ratio=1) != key
+
+
+def test_cover_cache_expires_after_ttl(tmp_path):
+    cache = CoverCache(str(tmp_path), ttl=-1)
+    cache.put('expired', image=b'cropped', url='https://example.com/cover.jpg')
+    assert cache.get_url('expired') is None
+    assert not (tmp_path / 'expired').exists()
+
+
+def test_cover_cache_evicts_least_recently_used(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr('biliup.plugins.upload_cover.time.time', lambda: now[0])
+    cache = CoverCache(str(tmp_path), max_entries=2)
+    for key in ('a', 'b'):
+        now[0] += 1
+        cache.put(key, image=key.encode())
+    now[0] += 1
+    assert cache.get_image('a') == b'a'
+    now[0] += 1
+    cache.put('c', image=b'c')
+    assert cache.get_image('b') is None
+    assert not (tmp_path / 'b').exists()
+    assert cache.get_image('a') == b'a' and cache.get_image('c') == b'c'
+
+
+def test_cover_up_async_uses_cache_off_the_loop(tmp_path, monkeypatch):
+    source = image(320, 100)
+    with bili_webup.BiliBili(bili_webup.Data()) as bili:
+        bili.cover_cache = cache = CoverCache(str(tmp_path))
+        loop_threads = []
+        put = cache.put
+        monkeypatch.setattr(cache, 'put', lambda *args, **kwargs: (
+            loop_threads.append(threading.current_thread()), put(*args, **kwargs)))
+        requests = []
+
+        async def request(method, url, **kwargs):
+            requests.append(kwargs['data']['cover'])
+            return {'data': {'url': 'https://example.com/cover.jpg'}}
+
+        monkeypatch.setattr(bili, '_request', request)
+        assert asyncio.run(bili.cover_up_async(BytesIO(source))) == 'https://example.com/cover.jpg'
+        assert asyncio.run(bili.cover_up_async(BytesIO(source))) == 'https://example.com/cover.jpg'
+        assert len(requests) == 1
+        assert len(loop_threads) == 2 and threading.main_thread() not in loop_threads
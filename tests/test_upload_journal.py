@@ -0,0 +1,90 @@
+import asyncio
+import types
+
+from biliup.plugins import bili_webup
+from biliup.plugins.upload_journal import UploadJournal
+
+RET = {'chunk_size': 4, 'auth': 'auth', 'endpoint': '//upos.example.com', 'biz_id': 1,
+       'upos_uri': 'upos://ugcfx2lf/n1.flv'}
+
+
+def test_journal_survives_reload(tmp_path):
+    path = str(tmp_path / 'journal.json')
+    journal = UploadJournal(path)
+    journal.begin('video', RET, 'upload')
+    journal.complete_part('video', 2)
+    journal.complete_part('video', 2)
+    asyncio.run(journal.save())
+    entry = UploadJournal(path).get('video')
+    assert entry['upload_id'] == 'upload' and entry['parts'] == {2}
+    journal.finish('video')
+    asyncio.run(journal.save())
+    assert UploadJournal(path).get('video') is None
+
+
+def test_journal_batches_writes(tmp_path):
+    path = str(tmp_path / 'journal.json')
+    journal = UploadJournal(path, flush_parts=3, flush_interval=3600)
+    journal.begin('video', RET, 'upload')
+    journal.complete_part('video', 1)
+    asyncio.run(journal.save(force=False))
+    assert UploadJournal(path).get('video') is None
+    journal.complete_part('video', 2)
+    asyncio.run(journal.save(force=False))
+    assert UploadJournal(path).get('video')['parts'] == {1, 2}
+
+
+def test_journal_drops_expired_entries(tmp_path):
+    path = str(tmp_path / 'journal.json')
+    journal = UploadJournal(path)
+    journal.begin('video', RET, 'upload')
+    asyncio.run(journal.save())
+    assert UploadJournal(path, ttl=-1).get('video') is None
+
+
+class FakeUpos:
+    def __init__(self):
+        self.puts = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, e_t, e_v, t_b):
+        pass
+
+    def put(self, url, params, raise_for_status, data, headers):
+        self.puts.append((params['partNumber'], params['uploadId'], bytes(data)))
+        return self
+
+
+def test_upos_resume_uploads_only_missing_parts(tmp_path, monkeypatch):
+    video = tmp_path / 'video.flv'
+    video.write_bytes(b'0123456789abcd')
+    path = str(tmp_path / 'journal.json')
+    journal = UploadJournal(path)
+    key = UploadJournal.key(str(video))
+    journal.begin(key, RET, 'upload')
+    journal.complete_part(key, 1)
+    journal.complete_part(key, 3)
+    asyncio.run(journal.save())
+
+    upos = FakeUpos()
+    requests = []
+
+    async def request(method, url, **kwargs):
+        requests.append((url, kwargs.get('params'), kwargs.get('json')))
+        return {'OK': 1}
+
+    with bili_webup.BiliBili(bili_webup.Data()) as bili, open(video, 'rb') as file:
+        bili.telemetry = None
+        bili.journal = UploadJournal(path)
+        bili._runtime = types.SimpleNamespace(session=lambda: upos, release=lambda: None)
+        monkeypatch.setattr(bili, '_request', request)
+        video_part = asyncio.run(bili.upos(file, len(video.read_bytes()), RET))
+    assert video_part['filename'] == 'n1'
+    assert sorted(upos.puts) == [(2, 'upload', b'4567'), (4, 'upload', b'cd')]
+    # 只请求合并，没有重新申请上传id
+    (url, params, body), = requests
+    assert params['uploadId'] == 'upload'
+    assert [part['partNumber'] for part in body['parts']] == [1, 2, 3, 4]
+    assert UploadJournal(path).get(key) is None
@@ -0,0 +1,49 @@
+import asyncio
+import json
+import threading
+
+import pytest
+
+from biliup.plugins.upload_line import LineScoreboard
+
+LINES = [{'query': 'upcdn=bda2&probe_version=20221109'}, {'query': 'upcdn=qn&probe_version=20221109'}]
+
+
+def test_scoreboard_ewma(tmp_path):
+    scoreboard = LineScoreboard(str(tmp_path / 'lines.json'), alpha=0.5)
+    bda2 = LINES[0]['query']
+    scoreboard.record_chunk(bda2, 'upos-cs-upcdnbda2.bilivideo.com', 10_000_000, 1)
+    scoreboard.record_chunk(bda2, 'upos-cs-upcdnbda2.bilivideo.com', 10_000_000, 2)
+    assert scoreboard.score(bda2) == pytest.approx(7.5)
+    scoreboard.record_error(bda2, 'upos-cs-upcdnbda2.bilivideo.com')
+    assert scoreboard.score(bda2) == pytest.approx(7.5 * 0.5)
+    scoreboard.record_merge(bda2, 'upos-cs-upcdnbda2.bilivideo.com', False)
+    assert scoreboard.score(bda2) == pytest.approx(7.5 * 0.5 * 0)
+    endpoint = scoreboard._lines[bda2]['endpoints']['upos-cs-upcdnbda2.bilivideo.com']
+    assert endpoint['samples'] == 2
+
+
+def test_scoreboard_choose(tmp_path, monkeypatch):
+    scoreboard = LineScoreboard(str(tmp_path / 'lines.json'), explore=0)
+    assert scoreboard.choose(LINES) is None
+    scoreboard.record_chunk(LINES[0]['query'], 'a', 2_000_000, 1)
+    scoreboard.record_chunk(LINES[1]['query'], 'b', 8_000_000, 1)
+    assert scoreboard.choose(LINES) == {**LINES[1], 'mbps': pytest.approx(8)}
+    scoreboard.record_merge(LINES[1]['query'], 'b', False)
+    assert scoreboard.choose(LINES)['query'] == LINES[0]['query']
+    monkeypatch.setattr(scoreboard, 'ttl', -1)
+    assert scoreboard.choose(LINES) is None
+
+
+def test_recorder_merge_saves_off_the_loop(tmp_path, monkeypatch):
+    path = tmp_path / 'lines.json'
+    scoreboard = LineScoreboard(str(path))
+    dumped = []
+    dump = scoreboard._dump
+    monkeypatch.setattr(scoreboard, '_dump', lambda: (dumped.append(threading.current_thread()), dump()))
+    recorder = scoreboard.recorder(LINES[0]['query'], 'a')
+    recorder.chunk(1_000_000, 1)
+    asyncio.run(recorder.merge(True))
+    assert dumped and dumped[0] is not threading.main_thread()
+    assert json.loads(path.read_text())[LINES[0]['query']]['merge_failure_rate'] == 0
+    assert LineScoreboard(str(path)).score(LINES[0]['query']) == pytest.approx(1)